@@ -0,0 +1,116 @@
+"""Compare local prototype categorization with the remote zero-shot model.
+
+Runs every labelled listing below through `CategoryPredictor.predict_text`
+and, when HF_API is set, through `facebook/bart-large-mnli` on the HF
+inference API (the previous `/predict_categories` text path). Reports top-1
+accuracy and median / p95 latency for each.
+
+    python benchmarks/bench_categories.py [--repeat 20] [--skip-remote]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from dotenv import load_dotenv
+from sentence_transformers import SentenceTransformer
+
+from category_predictor import CATEGORY_MAPPING, CategoryPredictor
+
+TEXT_API_URL = "https://api-inference.huggingface.co/models/facebook/bart-large-mnli"
+
+SAMPLES = [
+    ("Dell Inspiron 15 laptop, 8GB RAM, 256GB SSD, barely used", "electronics"),
+    ("iPhone 12 with cracked back glass, screen perfect", "electronics"),
+    ("Sony noise cancelling headphones WH-1000XM4", "electronics"),
+    ("Canon DSLR with 18-55mm kit lens and bag", "electronics"),
+    ("Bluetooth speaker, waterproof, 10h battery", "electronics"),
+    ("32 inch Samsung smart TV with remote", "electronics"),
+    ("Wooden study table with two drawers", "furniture"),
+    ("Three seater fabric sofa, grey, pet free home", "furniture"),
+    ("Queen size bed frame with headboard", "furniture"),
+    ("Office chair with lumbar support, adjustable height", "furniture"),
+    ("Bookshelf, 5 tiers, white", "furniture"),
+    ("Men's denim jacket size L, worn twice", "clothing"),
+    ("Nike running shoes size 9, lightly used", "clothing"),
+    ("Summer floral dress, medium", "clothing"),
+    ("Pack of 3 cotton t-shirts, never worn", "clothing"),
+    ("Woollen sweater hand knitted, kids size", "clothing"),
+    ("Engineering mathematics textbook 3rd edition", "books"),
+    ("Harry Potter complete novel set, paperback", "books"),
+    ("Stack of old National Geographic magazines", "books"),
+    ("Marvel comic collection, 20 issues", "books"),
+    ("Honda Activa scooter 2018, 20k km", "automobile"),
+    ("Mountain bicycle with 21 gears and disc brakes", "automobile"),
+    ("Maruti Swift car, diesel, single owner", "automobile"),
+    ("Royal Enfield motorcycle, well maintained", "automobile"),
+    ("Cricket bat, English willow, with cover", "sports"),
+    ("Set of 2 badminton rackets and shuttlecocks", "sports"),
+    ("Size 5 football, barely used", "sports"),
+    ("Golf club set with bag", "sports"),
+    ("Tennis racket, Wilson, strung", "sports"),
+    ("Yoga mat and resistance bands", "sports"),
+]
+
+
+def timed(fn, text):
+    start = time.perf_counter()
+    result = fn(text)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def evaluate(name, fn, repeat=1):
+    correct = 0
+    timings = []
+    for text, expected in SAMPLES:
+        for i in range(repeat):
+            predicted, elapsed = timed(fn, text)
+            timings.append(elapsed)
+        correct += predicted == expected
+    timings.sort()
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{name:28s} accuracy {correct}/{len(SAMPLES)} ({correct / len(SAMPLES):.0%})  "
+          f"median {statistics.median(timings):.1f} ms  p95 {p95:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--skip-remote", action="store_true")
+    args = parser.parse_args()
+
+    load_dotenv()
+    model = SentenceTransformer('all-MiniLM-L6-v2')
+    start = time.perf_counter()
+    predictor = CategoryPredictor(model)
+    print(f"prototypes built in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    # Warm up the model before timing
+    predictor.predict_text("warm up")
+    evaluate("local prototypes", lambda text: predictor.predict_text(text)[0], args.repeat)
+
+    hf_api = os.getenv("HF_API")
+    if args.skip_remote or not hf_api:
+        print("remote zero-shot skipped (set HF_API to compare)")
+        return
+
+    session = requests.Session()
+    headers = {"Authorization": f"Bearer {hf_api}"}
+
+    def remote(text):
+        response = session.post(TEXT_API_URL, headers=headers, json={
+            "inputs": text,
+            "parameters": {"candidate_labels": list(CATEGORY_MAPPING.keys())}
+        })
+        response.raise_for_status()
+        return response.json()["labels"][0]
+
+    evaluate("remote bart-large-mnli", remote)
+
+
+if __name__ == "__main__":
+    main()
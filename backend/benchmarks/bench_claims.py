@@ -0,0 +1,138 @@
+"""Claim-storm check for donation claiming.
+
+Creates `--donations` available donations on a scratch database of a local
+mongod. Then `--claimants` users per donation all claim at once from
+`--threads` threads, released together by a barrier. Afterwards it checks
+that every donation has exactly one winner, and that the stored claimant is
+that winner. It reports claim attempts per second and per-call latency.
+
+    python benchmarks/bench_claims.py [--mode atomic|reserve|legacy] [--claimants 50]
+
+`atomic` calls `donation_service.claim` directly. `reserve` first calls
+`reserve` (one holder, the rest waitlisted) and then `claim`. `legacy` is the
+previous find / check / update sequence and shows the double claims this
+replaced. The exit status is non-zero if any donation does not end up with
+exactly one winner.
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import MongoClient
+
+import donation_service
+
+
+def legacy_claim(donation_id, claimant):
+    """The previous claim_donation logic, for comparison"""
+    collection = donation_service.donated_products_collection
+    donation = collection.find_one({"id": donation_id})
+    if not donation.get("is_available", False):
+        return "unavailable", None
+    collection.update_one({"id": donation_id}, {"$set": {
+        "is_available": False, "updated_at": datetime.utcnow(),
+        "claim": {"claimed_at": datetime.utcnow(), "claimed_by": claimant}
+    }})
+    return "claimed", None
+
+
+def attempt(mode, donation_id, claimant):
+    if mode == "legacy":
+        return legacy_claim(donation_id, claimant)[0]
+    if mode == "reserve":
+        outcome, _ = donation_service.reserve(donation_id, claimant)
+        if outcome != "reserved":
+            return outcome
+    return donation_service.claim(donation_id, claimant)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["atomic", "reserve", "legacy"], default="atomic")
+    parser.add_argument("--donations", type=int, default=20)
+    parser.add_argument("--claimants", type=int, default=50, help="claimants per donation")
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--mongodb-uri", default=os.getenv("BENCH_MONGODB_URI", "mongodb://localhost:27017"))
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongodb_uri, maxPoolSize=args.threads + 4)
+    db_name = f"bench_claims_{uuid.uuid4().hex[:8]}"
+    db = client[db_name]
+    donation_service.setup_collection(db)
+    collection = db["donated_products"]
+    collection.create_index("id", unique=True)
+
+    now = datetime.utcnow()
+    donation_ids = [f"donation-{i}" for i in range(args.donations)]
+    collection.insert_many([
+        {"id": donation_id, "name": f"Free item {i}", "is_available": True, "created_at": now,
+         "claim": None, "reservation": None, "waitlist": []}
+        for i, donation_id in enumerate(donation_ids)
+    ])
+
+    jobs = [(donation_id, {"id": f"user-{donation_id}-{n}", "name": f"User {n}", "email": "", "avatar": ""})
+            for n in range(args.claimants) for donation_id in donation_ids]
+    barrier = threading.Barrier(min(args.threads, len(jobs)))
+    timings = []
+    winners = Counter()
+    winner_ids = {}
+    outcomes = Counter()
+    lock = threading.Lock()
+
+    def run(job):
+        donation_id, claimant = job
+        try:
+            barrier.wait(timeout=5)
+        except threading.BrokenBarrierError:
+            pass
+        start = time.perf_counter()
+        outcome = attempt(args.mode, donation_id, claimant)
+        elapsed = time.perf_counter() - start
+        with lock:
+            timings.append(elapsed)
+            outcomes[outcome] += 1
+            if outcome == "claimed":
+                winners[donation_id] += 1
+                winner_ids[donation_id] = claimant["id"]
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as pool:
+            list(pool.map(run, jobs))
+        elapsed = time.perf_counter() - started
+
+        failures = []
+        for donation_id in donation_ids:
+            stored = collection.find_one({"id": donation_id}, {"_id": 0, "claim.claimed_by.id": 1})
+            stored_id = ((stored.get("claim") or {}).get("claimed_by") or {}).get("id")
+            if winners[donation_id] != 1:
+                failures.append(f"{donation_id}: {winners[donation_id]} winners")
+            elif stored_id != winner_ids[donation_id]:
+                failures.append(f"{donation_id}: stored claimant {stored_id} is not the winner")
+    finally:
+        client.drop_database(db_name)
+
+    timings.sort()
+    print(f"mode={args.mode} donations={args.donations} claimants/donation={args.claimants} threads={args.threads}")
+    print(f"{len(jobs)} attempts in {elapsed:.2f}s: {len(jobs) / elapsed:.0f} attempts/s, "
+          f"p50 {statistics.median(timings) * 1000:.1f} ms, "
+          f"p95 {timings[int(len(timings) * 0.95) - 1] * 1000:.1f} ms, "
+          f"p99 {timings[int(len(timings) * 0.99) - 1] * 1000:.1f} ms")
+    print("outcomes: " + ", ".join(f"{k}={v}" for k, v in sorted(outcomes.items())))
+    for failure in failures[:10]:
+        print(f"FAIL {failure}")
+    print("exactly one winner per donation" if not failures else f"{len(failures)} donations without exactly one winner")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+"""Microbenchmarks for the in-process models: MiniLM embeddings and ViT labels.
+
+Sweeps the dimensions that decide serving capacity:
+
+    MiniLM  `model.encode`          threads x batch size x input length (words)
+    ViT     `get_top_prediction`    threads x batch size x image size (long edge, px)
+
+`torch.set_num_threads` is applied per cell. Each cell runs for at least
+`--min-time` seconds and reports items/sec, per-call p50 / p95 / p99 and the
+peak RSS of the process during the cell. The ViT path is timed the way
+main.py runs it: processor, forward pass, then argmax.
+
+From the cells at the typical input (`--typical-words`, `--typical-image-size`)
+it recommends a layout for each core count: threads per worker, worker
+processes and batch size with the best estimated throughput whose p95 stays
+within the latency budget. The estimate assumes that worker processes scale
+linearly.
+
+    python benchmarks/bench_inference.py [--only minilm|vit] [--threads 1,2,4] [--min-time 2]
+
+Results go to stdout and to a JSON file named after the current commit.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import torch
+from PIL import Image
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+SAMPLE_IMAGE = os.path.join(BACKEND_DIR, "car.jpg")
+
+TEXT_MODEL = "all-MiniLM-L6-v2"
+VISION_MODEL = "google/vit-base-patch16-224"
+
+WORDS = ("used laptop phone chair table sofa bike car shoes jacket book novel camera speaker "
+         "good condition barely scratches original box charger included works perfectly pickup "
+         "only negotiable price size medium large wooden steel leather cotton black white").split()
+
+
+def parse_ints(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def percentile(sorted_values, p):
+    rank = max(int(round(p / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def git_commit():
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=BACKEND_DIR, capture_output=True, text=True).stdout.strip()
+    commit = git("rev-parse", "--short", "HEAD") or "unknown"
+    return commit + ("-dirty" if git("status", "--porcelain", "--untracked-files=no") else "")
+
+
+class PeakRSS:
+    """Samples the resident set size while a cell runs (Linux /proc;
+    elsewhere falls back to the process-lifetime peak)"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == "darwin" else peak * 1024
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def measure(fn, items, min_time, min_calls=3):
+    """Call fn repeatedly for at least min_time seconds (after one warm-up call)"""
+    fn()
+    timings = []
+    with PeakRSS() as rss:
+        started = time.perf_counter()
+        while len(timings) < min_calls or time.perf_counter() - started < min_time:
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - started
+    timings.sort()
+    return {
+        "calls": len(timings),
+        "items_per_sec": round(items * len(timings) / elapsed, 2),
+        "p50_ms": round(percentile(timings, 50) * 1000, 2),
+        "p95_ms": round(percentile(timings, 95) * 1000, 2),
+        "p99_ms": round(percentile(timings, 99) * 1000, 2),
+        "peak_rss_mb": round(rss.peak / 2 ** 20, 1),
+    }
+
+
+def listing_text(words):
+    return " ".join(random.choice(WORDS) for _ in range(words))
+
+
+def sample_image(long_edge):
+    with Image.open(SAMPLE_IMAGE) as image:
+        image = image.convert("RGB")
+        scale = long_edge / max(image.size)
+        size = (max(int(image.width * scale), 1), max(int(image.height * scale), 1))
+        resized = image.resize(size, Image.BICUBIC)
+    # Round-trip through JPEG so the decode cost matches an upload
+    buffer = io.BytesIO()
+    resized.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def bench_minilm(args, report):
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(TEXT_MODEL)
+    cells = []
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for words in args.words:
+            for batch_size in args.batch_sizes:
+                texts = [listing_text(words) for _ in range(batch_size)]
+                tokens = len(model.tokenizer(texts[0])["input_ids"])
+                result = measure(lambda: model.encode(texts, batch_size=batch_size), batch_size, args.min_time)
+                cell = dict(threads=threads, batch_size=batch_size, words=words, tokens=tokens, **result)
+                cells.append(cell)
+                print(f"minilm threads={threads:<2d} batch={batch_size:<4d} words={words:<4d} tokens={tokens:<4d} "
+                      f"{cell['items_per_sec']:9.1f} items/s  p50 {cell['p50_ms']:8.1f} ms  "
+                      f"p95 {cell['p95_ms']:8.1f} ms  p99 {cell['p99_ms']:8.1f} ms  rss {cell['peak_rss_mb']:7.1f} MB")
+    report["minilm"] = {"model": TEXT_MODEL, "cells": cells}
+    report["recommendations"]["minilm"] = recommend(
+        [c for c in cells if c["words"] == args.typical_words], args.text_budget_ms, args.cores
+    )
+
+
+def bench_vit(args, report):
+    from transformers import ViTForImageClassification, ViTImageProcessor
+
+    processor = ViTImageProcessor.from_pretrained(VISION_MODEL)
+    classifier = ViTForImageClassification.from_pretrained(VISION_MODEL)
+
+    def predict(contents):
+        # As in main.get_top_prediction, plus the decode of the uploaded bytes
+        images = [Image.open(io.BytesIO(c)) for c in contents]
+        inputs = processor(images=images, return_tensors="pt")
+        logits = classifier(**inputs).logits
+        return [classifier.config.id2label[i] for i in logits.argmax(-1).tolist()]
+
+    cells = []
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for size in args.image_sizes:
+            contents = sample_image(size)
+            for batch_size in args.image_batch_sizes:
+                batch = [contents] * batch_size
+                result = measure(lambda: predict(batch), batch_size, args.min_time)
+                cell = dict(threads=threads, batch_size=batch_size, image_size=size,
+                            image_bytes=len(contents), **result)
+                cells.append(cell)
+                print(f"vit    threads={threads:<2d} batch={batch_size:<4d} size={size:<5d} "
+                      f"{cell['items_per_sec']:9.1f} items/s  p50 {cell['p50_ms']:8.1f} ms  "
+                      f"p95 {cell['p95_ms']:8.1f} ms  p99 {cell['p99_ms']:8.1f} ms  rss {cell['peak_rss_mb']:7.1f} MB")
+    report["vit"] = {"model": VISION_MODEL, "cells": cells}
+    report["recommendations"]["vit"] = recommend(
+        [c for c in cells if c["image_size"] == args.typical_image_size], args.image_budget_ms, args.cores
+    )
+
+
+def recommend(cells, budget_ms, max_cores):
+    """Best (threads per worker, workers, batch size) for each core count"""
+    recommendations = {}
+    cores = 1
+    while cores <= max_cores:
+        best = None
+        for cell in cells:
+            if cell["threads"] > cores or cell["p95_ms"] > budget_ms:
+                continue
+            workers = cores // cell["threads"]
+            estimate = cell["items_per_sec"] * workers
+            if best is None or estimate > best["est_items_per_sec"]:
+                best = {"threads_per_worker": cell["threads"], "workers": workers,
+                        "batch_size": cell["batch_size"], "p95_ms": cell["p95_ms"],
+                        "est_items_per_sec": round(estimate, 1),
+                        "est_peak_rss_mb": round(cell["peak_rss_mb"] * workers, 1)}
+        recommendations[str(cores)] = best
+        cores = cores * 2 if cores * 2 <= max_cores or cores == max_cores else max_cores
+    return recommendations
+
+
+def print_recommendations(recommendations, budgets):
+    for name, by_cores in recommendations.items():
+        print(f"\n{name}: recommended layout (p95 <= {budgets[name]} ms)")
+        for cores, best in by_cores.items():
+            if best is None:
+                print(f"  {cores:>3s} cores: nothing within budget")
+                continue
+            print(f"  {cores:>3s} cores: {best['workers']} worker(s) x {best['threads_per_worker']} thread(s), "
+                  f"batch {best['batch_size']}  ~{best['est_items_per_sec']} items/s  "
+                  f"p95 {best['p95_ms']} ms  ~{best['est_peak_rss_mb']} MB")
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    default_threads = sorted({t for t in (1, 2, 4, 8, cpu_count) if t <= cpu_count})
+
+    parser = argparse.ArgumentParser(description="MiniLM / ViT inference microbenchmarks")
+    parser.add_argument("--only", choices=["minilm", "vit"])
+    parser.add_argument("--threads", type=parse_ints, default=default_threads)
+    parser.add_argument("--batch-sizes", type=parse_ints, default=[1, 8, 32, 128, 256])
+    parser.add_argument("--words", type=parse_ints, default=[8, 32, 128, 256])
+    parser.add_argument("--image-batch-sizes", type=parse_ints, default=[1, 4, 16])
+    parser.add_argument("--image-sizes", type=parse_ints, default=[224, 640, 1280, 3000])
+    parser.add_argument("--typical-words", type=int, default=32)
+    parser.add_argument("--typical-image-size", type=int, default=1280)
+    parser.add_argument("--text-budget-ms", type=float, default=100)
+    parser.add_argument("--image-budget-ms", type=float, default=1000)
+    parser.add_argument("--cores", type=int, default=cpu_count, help="largest core count to recommend for")
+    parser.add_argument("--min-time", type=float, default=2.0)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    random.seed(0)
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "started_at": datetime.utcnow().isoformat() + "Z",
+        "host": {"cpu_count": cpu_count, "machine": platform.machine(), "processor": platform.processor(),
+                 "python": platform.python_version(), "torch": torch.__version__},
+        "config": vars(args),
+        "recommendations": {},
+    }
+    if args.only in (None, "minilm"):
+        bench_minilm(args, report)
+    if args.only in (None, "vit"):
+        bench_vit(args, report)
+
+    print_recommendations(report["recommendations"],
+                          {"minilm": args.text_budget_ms, "vit": args.image_budget_ms})
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"inference-{commit}-{cpu_count}cpu-{datetime.utcnow():%Y%m%dT%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nresults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""Endpoint load benchmark against local stand-ins for every external service.
+
+Boots `main:app` (see standins.py) against a local mongod, or an in-memory
+one with `--in-memory` (needs `pymongo_inmemory`), the in-memory vector
+store, and the stub Cloudinary / HF inference server with the given
+latencies. It then seeds users, products and chat rooms, and drives a
+request mix at a fixed concurrency:
+
+    browse        GET  /products?skip=..&limit=20
+    product_view  GET  /products/{product_id}
+    upload        POST /upload_product (a unique JPEG each time)
+    chat_send     POST /chat/messages
+
+While it runs, `--sse-listeners` connections hold `/chat/events` open for
+the recipients of the chat rooms being written to. The time from a send to
+each listener's `new_message` event is reported as `sse_fanout`.
+
+Throughput and p50 / p95 / p99 per route go to stdout and to a JSON file
+named after the current commit. Two result files can be compared:
+
+    python benchmarks/bench_load.py run [--mix default] [--concurrency 32] [--duration 60]
+    python benchmarks/bench_load.py compare results/load-abc1234-....json results/load-def5678-....json
+
+Change streams need a replica set. Against a standalone mongod the
+app's vector_sync consumer only logs retries, which does not affect these
+routes.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+from pymongo import MongoClient
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+SAMPLE_IMAGE = os.path.join(BACKEND_DIR, "car.jpg")
+
+MIXES = {
+    "default": {"browse": 40, "product_view": 35, "chat_send": 15, "upload": 10},
+    "read": {"browse": 55, "product_view": 45},
+    "write": {"chat_send": 60, "upload": 40},
+    "chat": {"chat_send": 100},
+}
+ROUTES = {
+    "browse": "GET /products",
+    "product_view": "GET /products/{product_id}",
+    "upload": "POST /upload_product",
+    "chat_send": "POST /chat/messages",
+}
+CATEGORIES = ["electronics", "furniture", "clothing", "books", "automobile", "sports", "other"]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    rank = max(int(round(p / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    ms = lambda value: None if value is None else round(value * 1000, 2)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_commit():
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=BACKEND_DIR, capture_output=True, text=True).stdout.strip()
+    commit = git("rev-parse", "--short", "HEAD") or "unknown"
+    return commit + ("-dirty" if git("status", "--porcelain", "--untracked-files=no") else "")
+
+
+def seed(db, users: int, products: int, rooms: int) -> dict:
+    """Users, products around one city, and chat rooms between them"""
+    now = datetime.utcnow()
+    user_docs = [{"id": f"bench-user-{i}", "email": f"user{i}@example.com", "name": f"User {i}",
+                  "avatar": "", "created_at": now} for i in range(users)]
+    product_docs = []
+    for i in range(products):
+        owner = user_docs[i % users]
+        category = CATEGORIES[i % len(CATEGORIES)]
+        url = f"https://res.cloudinary.com/bench/image/upload/v1/barter_trade/p{i}.jpg"
+        product_docs.append({
+            "id": f"bench-product-{i}",
+            "name": f"{category.title()} item {i}",
+            "description": f"A gently used {category} item in good condition, listing {i}",
+            "price": float(random.randint(5, 2000)),
+            "categories": [category],
+            "images": [url],
+            "image_details": [{"url": url, "public_id": f"barter_trade/p{i}", "format": "jpg",
+                               "width": 1080, "height": 1440, "resource_type": "image"}],
+            "created_at": now - timedelta(minutes=i),
+            "updated_at": now,
+            "user": {"id": owner["id"], "email": owner["email"], "name": owner["name"], "avatar": ""},
+            "location": {"type": "Point", "coordinates": [77.59 + random.uniform(-0.2, 0.2),
+                                                          12.97 + random.uniform(-0.2, 0.2)]},
+            "address": "Bengaluru",
+            "image_categories": ["laptop, laptop computer"],
+        })
+    room_docs = []
+    for i in range(rooms):
+        product = product_docs[i % products]
+        buyer = user_docs[(i * 7 + 1) % users]
+        room_docs.append({"id": f"bench-room-{i}", "product_id": product["id"], "buyer_id": buyer["id"],
+                          "seller_id": product["user"]["id"], "created_at": now, "updated_at": now})
+
+    db["users"].insert_many(user_docs)
+    db["products"].insert_many(product_docs)
+    db["chat_rooms"].insert_many(room_docs)
+    return {"products": [p["id"] for p in product_docs], "rooms": room_docs, "users": [u["id"] for u in user_docs]}
+
+
+def start_process(args, name, ready_url, log_dir, timeout=600):
+    log = open(os.path.join(log_dir, f"{name}.log"), "w")
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "standins.py"), *args],
+                               stdout=log, stderr=subprocess.STDOUT, cwd=BACKEND_DIR)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{name} exited early, see {log.name}")
+        try:
+            if httpx.get(ready_url, timeout=2).status_code < 500:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"{name} did not come up within {timeout}s, see {log.name}")
+
+
+class LoadRun:
+    def __init__(self, base_url: str, data: dict, mix: dict, image: bytes):
+        self.base_url = base_url
+        self.data = data
+        self.scenarios = list(mix)
+        self.weights = [mix[s] for s in self.scenarios]
+        self.image = image
+        self.recording = False
+        self.latencies = {s: [] for s in self.scenarios}
+        self.errors = {s: 0 for s in self.scenarios}
+        self.sent_at = {}
+        self.fanout = []
+        self.fanout_events = 0
+        # Sends go to rooms whose recipients are listening
+        self.listened_rooms = []
+
+    async def browse(self, client):
+        return await client.get("/products", params={"skip": random.randint(0, 200), "limit": 20})
+
+    async def product_view(self, client):
+        return await client.get(f"/products/{random.choice(self.data['products'])}")
+
+    async def upload(self, client):
+        # Trailing bytes keep the JPEG valid but give every upload a new hash
+        contents = self.image + uuid.uuid4().bytes
+        category = random.choice(CATEGORIES)
+        return await client.post("/upload_product", files={"file1": ("photo.jpg", contents, "image/jpeg")}, data={
+            "productName": f"Bench {category} {uuid.uuid4().hex[:6]}",
+            "productDescription": f"A {category} listed by the load benchmark",
+            "productPrice": str(random.randint(5, 2000)),
+            "categories": json.dumps([category]),
+            "userId": random.choice(self.data["users"]),
+            "latitude": "12.97", "longitude": "77.59",
+        })
+
+    async def chat_send(self, client):
+        room = random.choice(self.listened_rooms or self.data["rooms"])
+        text = f"bench {uuid.uuid4().hex}"
+        if self.recording:
+            self.sent_at[text] = time.perf_counter()
+        return await client.post("/chat/messages", json={
+            "chat_room_id": room["id"], "sender_id": room["buyer_id"], "message": text
+        })
+
+    async def worker(self, client, stop_at):
+        while time.perf_counter() < stop_at:
+            scenario = random.choices(self.scenarios, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                response = await getattr(self, scenario)(client)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            if self.recording:
+                self.latencies[scenario].append(time.perf_counter() - start)
+                self.errors[scenario] += failed
+
+    async def listen(self, client, user_id):
+        try:
+            async with client.stream("GET", "/chat/events", params={"user_id": user_id}, timeout=None) as response:
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    event = json.loads(line[6:])
+                    if event.get("type") != "new_message":
+                        continue
+                    sent = self.sent_at.get(event["message"]["message"])
+                    if self.recording and sent is not None:
+                        self.fanout.append(time.perf_counter() - sent)
+                        self.fanout_events += 1
+        except (httpx.HTTPError, asyncio.CancelledError):
+            pass
+
+    async def run(self, concurrency, warmup, duration, sse_listeners, sse_users):
+        limits = httpx.Limits(max_connections=concurrency + sse_listeners + 8)
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=60, limits=limits) as client:
+            listeners = []
+            if sse_listeners and "chat_send" in self.scenarios:
+                self.listened_rooms = self.data["rooms"][:sse_users]
+                recipients = [room["seller_id"] for room in self.listened_rooms]
+                listeners = [asyncio.create_task(self.listen(client, recipients[i % len(recipients)]))
+                             for i in range(sse_listeners)]
+                await asyncio.sleep(1)
+
+            if warmup:
+                print(f"warming up for {warmup}s")
+                stop_at = time.perf_counter() + warmup
+                await asyncio.gather(*[self.worker(client, stop_at) for _ in range(concurrency)])
+
+            print(f"measuring for {duration}s at concurrency {concurrency}")
+            self.recording = True
+            started = time.perf_counter()
+            stop_at = started + duration
+            await asyncio.gather(*[self.worker(client, stop_at) for _ in range(concurrency)])
+            elapsed = time.perf_counter() - started
+            # Let in-flight fan-out events arrive
+            await asyncio.sleep(1)
+            self.recording = False
+
+            for task in listeners:
+                task.cancel()
+            await asyncio.gather(*listeners, return_exceptions=True)
+
+        routes = {ROUTES[s]: summarize(self.latencies[s], self.errors[s], elapsed) for s in self.scenarios}
+        total = summarize([l for s in self.scenarios for l in self.latencies[s]], sum(self.errors.values()), elapsed)
+        result = {"routes": routes, "total": total}
+        if listeners:
+            fanout = summarize(self.fanout, 0, elapsed)
+            fanout.pop("errors")
+            fanout["events"] = fanout.pop("requests")
+            fanout["listeners"] = sse_listeners
+            fanout["listened_users"] = len(self.listened_rooms)
+            result["sse_fanout"] = fanout
+        return result
+
+
+def print_result(result):
+    print(f"{'route':34s} {'req/s':>9s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'errors':>7s}")
+    rows = list(result["routes"].items()) + [("total", result["total"])]
+    if "sse_fanout" in result:
+        rows.append(("sse_fanout (send -> event)", dict(result["sse_fanout"], errors=0)))
+    for name, row in rows:
+        print(f"{name:34s} {row['throughput_rps']:9.1f} {row['p50_ms'] or 0:9.1f} "
+              f"{row['p95_ms'] or 0:9.1f} {row['p99_ms'] or 0:9.1f} {row['errors']:7d}")
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix="bench-load-")
+    db_name = f"bench_load_{uuid.uuid4().hex[:8]}"
+    processes = []
+    mongod = None
+    try:
+        mongodb_uri = args.mongodb_uri
+        if args.in_memory:
+            from pymongo_inmemory import Mongod
+            mongod = Mongod()
+            mongod.start()
+            mongodb_uri = mongod.connection_string
+
+        client = MongoClient(mongodb_uri)
+        print(f"seeding {db_name}: {args.users} users, {args.products} products, {args.rooms} rooms")
+        data = seed(client[db_name], args.users, args.products, args.rooms)
+
+        services_port, app_port = free_port(), free_port()
+        services_url = f"http://127.0.0.1:{services_port}"
+        app_url = f"http://127.0.0.1:{app_port}"
+        processes.append(start_process(
+            ["services", "--port", str(services_port), "--media-latency-ms", str(args.media_latency_ms),
+             "--inference-latency-ms", str(args.inference_latency_ms)],
+            "services", services_url, work_dir
+        ))
+        print("starting the app (loads the embedding model and seeds the vector index)")
+        processes.append(start_process(
+            ["app", "--port", str(app_port), "--mongodb-uri", mongodb_uri, "--db", db_name,
+             "--services-url", services_url, "--vector-latency-ms", str(args.vector_latency_ms),
+             "--work-dir", work_dir],
+            "app", f"{app_url}/cache/stats", work_dir
+        ))
+
+        with open(SAMPLE_IMAGE, "rb") as f:
+            image = f.read()
+        load = LoadRun(app_url, data, MIXES[args.mix], image)
+        result = asyncio.run(load.run(args.concurrency, args.warmup, args.duration,
+                                      args.sse_listeners, args.sse_users))
+        print_result(result)
+
+        commit = git_commit()
+        report = dict(result, commit=commit, mix=args.mix, mix_weights=MIXES[args.mix],
+                      started_at=datetime.utcnow().isoformat() + "Z", config=vars(args))
+        output = args.output or os.path.join(
+            RESULTS_DIR, f"load-{commit}-{args.mix}-c{args.concurrency}-{datetime.utcnow():%Y%m%dT%H%M%S}.json"
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {output}")
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if mongod is not None:
+            mongod.stop()
+        else:
+            try:
+                MongoClient(args.mongodb_uri).drop_database(db_name)
+            except Exception as e:
+                print(f"Warning: could not drop {db_name}: {str(e)}")
+        if args.keep_logs or sys.exc_info()[0] is not None:
+            print(f"logs kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, True)
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print(f"{before['commit']} ({before['mix']}) -> {after['commit']} ({after['mix']})")
+    print(f"{'route':34s} {'req/s':>17s} {'p95 ms':>17s} {'p99 ms':>17s}")
+
+    def change(old, new):
+        if not old or new is None:
+            return f"{'-':>17s}"
+        return f"{new:9.1f} ({(new - old) / old:+6.1%})"
+
+    rows = [(route, before["routes"].get(route), stats) for route, stats in after["routes"].items()]
+    rows.append(("total", before["total"], after["total"]))
+    if "sse_fanout" in after:
+        rows.append(("sse_fanout", before.get("sse_fanout"), after["sse_fanout"]))
+    for name, old, new in rows:
+        old = old or {}
+        print(f"{name:34s} {change(old.get('throughput_rps'), new['throughput_rps'])} "
+              f"{change(old.get('p95_ms'), new['p95_ms'])} {change(old.get('p99_ms'), new['p99_ms'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Endpoint load benchmark with local stand-ins")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--mix", choices=sorted(MIXES), default="default")
+    run_parser.add_argument("--concurrency", type=int, default=32)
+    run_parser.add_argument("--duration", type=float, default=60)
+    run_parser.add_argument("--warmup", type=float, default=10)
+    run_parser.add_argument("--mongodb-uri", default=os.getenv("BENCH_MONGODB_URI", "mongodb://localhost:27017"))
+    run_parser.add_argument("--in-memory", action="store_true", help="start a throwaway in-memory mongod")
+    run_parser.add_argument("--users", type=int, default=200)
+    run_parser.add_argument("--products", type=int, default=2000)
+    run_parser.add_argument("--rooms", type=int, default=200)
+    run_parser.add_argument("--sse-listeners", type=int, default=100)
+    run_parser.add_argument("--sse-users", type=int, default=10, help="recipients the listeners are spread over")
+    run_parser.add_argument("--media-latency-ms", type=float, default=80)
+    run_parser.add_argument("--inference-latency-ms", type=float, default=250)
+    run_parser.add_argument("--vector-latency-ms", type=float, default=20)
+    run_parser.add_argument("--output")
+    run_parser.add_argument("--keep-logs", action="store_true")
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Benchmark list-response serialization on 1,000 product documents.
+
+Compares the previous path (per-document `_id` fix-up, FastAPI's
+`jsonable_encoder`, then `JSONResponse.render`) with `BSONResponse` on the
+projected documents.
+
+    python benchmarks/bench_responses.py [--docs 1000] [--repeat 50]
+"""
+import argparse
+import copy
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from bson_response import BSONResponse, PRODUCT_LIST_PROJECTION, orjson
+
+
+def make_products(count):
+    now = datetime.utcnow()
+    products = []
+    for i in range(count):
+        image_details = [
+            {"url": f"https://res.cloudinary.com/demo/image/upload/v1/p{i}_{j}.jpg",
+             "public_id": f"barter_trade/p{i}_{j}", "format": "jpg",
+             "width": 1080, "height": 1440, "resource_type": "image"}
+            for j in range(3)
+        ]
+        products.append({
+            "_id": ObjectId(),
+            "id": f"product-{i}",
+            "name": f"Product {i}",
+            "description": "A gently used item in good condition. " * 4,
+            "price": float(i % 500),
+            "categories": ["electronics", "other"],
+            "images": [d["url"] for d in image_details],
+            "image_details": image_details,
+            "created_at": now - timedelta(minutes=i),
+            "updated_at": now,
+            "user": {"id": f"user-{i % 50}", "email": "someone@example.com",
+                     "name": "Someone", "avatar": ""},
+            "location": {"type": "Point", "coordinates": [77.59, 12.97]},
+            "address": "Bengaluru",
+            "image_categories": ["laptop, laptop computer", "notebook, notebook computer",
+                                 "desktop computer", "screen, CRT screen", "monitor"],
+            "view_count": i,
+        })
+    return products
+
+
+def project(doc, projection):
+    excluded = {field for field, flag in projection.items() if not flag}
+    return {k: v for k, v in doc.items() if k not in excluded}
+
+
+def legacy(products):
+    for product in products:
+        if "_id" in product:
+            product["_id"] = str(product["_id"])
+    return JSONResponse(jsonable_encoder(products)).body
+
+
+def pipeline(products):
+    return BSONResponse(products).body
+
+
+def run(name, fn, make_input, repeat):
+    timings = []
+    size = 0
+    for _ in range(repeat):
+        docs = make_input()
+        start = time.perf_counter()
+        size = len(fn(docs))
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f"{name:<28} p50={statistics.median(timings):8.2f}ms "
+          f"p95={timings[int(len(timings) * 0.95) - 1]:8.2f}ms  body={size / 1024:8.1f}KiB")
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    products = make_products(args.docs)
+    projected = [project(p, PRODUCT_LIST_PROJECTION) for p in products]
+
+    print(f"{args.docs} documents, {args.repeat} runs, orjson={'yes' if orjson else 'no'}")
+    before = run("jsonable_encoder (full)", legacy, lambda: copy.deepcopy(products), args.repeat)
+    run("BSONResponse (full)", pipeline, lambda: products, args.repeat)
+    after = run("BSONResponse (projected)", pipeline, lambda: projected, args.repeat)
+    print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
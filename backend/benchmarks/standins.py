@@ -0,0 +1,271 @@
+"""Local stand-ins for the backend's external services, for load benchmarks.
+
+* `FakePinecone` / `FakeIndex`: an in-memory vector store with the parts of
+  the Pinecone index API the backend uses (upsert, query with metadata
+  filters, delete), brute-force cosine scoring and optional added latency.
+* A stub HTTP server that answers Cloudinary uploads
+  (`/v1_1/<cloud>/<type>/upload`) and HF inference calls (`/models/...`)
+  after a configurable delay.
+* An app launcher that points `main:app` at a given MongoDB, the stub server
+  and the fake vector store, seeds the index from `products`, and serves it
+  with uvicorn.
+
+Used by bench_load.py, which starts both as subprocesses:
+
+    python benchmarks/standins.py services --port 9100 --media-latency-ms 80 --inference-latency-ms 250
+    python benchmarks/standins.py app --port 9000 --mongodb-uri mongodb://localhost:27017 \\
+        --db bench --services-url http://127.0.0.1:9100 --work-dir /tmp/bench
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VISION_LABELS = [
+    {"label": "laptop, laptop computer", "score": 0.62},
+    {"label": "notebook, notebook computer", "score": 0.21},
+    {"label": "desktop computer", "score": 0.07},
+    {"label": "monitor", "score": 0.04},
+    {"label": "screen, CRT screen", "score": 0.02},
+]
+
+
+def _matches(value, condition) -> bool:
+    if not isinstance(condition, dict):
+        condition = {"$eq": condition}
+    values = value if isinstance(value, list) else [value]
+    for op, operand in condition.items():
+        if op == "$eq" and operand not in values:
+            return False
+        if op == "$ne" and operand in values:
+            return False
+        if op == "$in" and not any(v in operand for v in values):
+            return False
+        if op == "$nin" and any(v in operand for v in values):
+            return False
+        if op in ("$gt", "$gte", "$lt", "$lte"):
+            if value is None or isinstance(value, list):
+                return False
+            if ((op == "$gt" and not value > operand) or (op == "$gte" and not value >= operand)
+                    or (op == "$lt" and not value < operand) or (op == "$lte" and not value <= operand)):
+                return False
+    return True
+
+
+def metadata_filter_matches(metadata: dict, flt: dict) -> bool:
+    """Pinecone metadata filter semantics for the operators the backend uses"""
+    for key, condition in flt.items():
+        if key == "$and":
+            if not all(metadata_filter_matches(metadata, f) for f in condition):
+                return False
+        elif key == "$or":
+            if not any(metadata_filter_matches(metadata, f) for f in condition):
+                return False
+        elif key not in metadata or not _matches(metadata[key], condition):
+            return False
+    return True
+
+
+class FakeIndex:
+    def __init__(self, name: str, latency: float = 0.0):
+        self.name = name
+        self.latency = latency
+        self.vectors = {}
+        self.lock = threading.Lock()
+        self._matrix = None
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def upsert(self, vectors, **kwargs):
+        self._wait()
+        with self.lock:
+            for record in vectors:
+                if isinstance(record, (tuple, list)):
+                    record = {"id": record[0], "values": record[1], "metadata": record[2] if len(record) > 2 else {}}
+                values = np.asarray(record["values"], dtype=np.float32)
+                norm = np.linalg.norm(values)
+                self.vectors[record["id"]] = (values / norm if norm else values, record.get("metadata") or {})
+            self._matrix = None
+        return {"upserted_count": len(vectors)}
+
+    def delete(self, ids=None, **kwargs):
+        self._wait()
+        with self.lock:
+            for vector_id in ids or []:
+                self.vectors.pop(vector_id, None)
+            self._matrix = None
+        return {}
+
+    def query(self, vector=None, top_k=10, filter=None, include_values=False, include_metadata=False, **kwargs):
+        self._wait()
+        with self.lock:
+            if self._matrix is None:
+                ids = list(self.vectors)
+                matrix = np.vstack([self.vectors[i][0] for i in ids]) if ids else np.zeros((0, 1), np.float32)
+                self._matrix = (ids, matrix)
+            ids, matrix = self._matrix
+            metadata = [self.vectors[i][1] for i in ids]
+        if not ids:
+            return {"matches": []}
+
+        scores = matrix @ np.asarray(vector, dtype=np.float32)
+        matches = []
+        for position in np.argsort(-scores):
+            if filter and not metadata_filter_matches(metadata[position], filter):
+                continue
+            match = {"id": ids[position], "score": float(scores[position])}
+            if include_metadata:
+                match["metadata"] = metadata[position]
+            if include_values:
+                match["values"] = matrix[position].tolist()
+            matches.append(match)
+            if len(matches) >= top_k:
+                break
+        return {"matches": matches}
+
+    def describe_index_stats(self, **kwargs):
+        return {"total_vector_count": len(self.vectors)}
+
+
+class FakePinecone:
+    """Drop-in for `pinecone.Pinecone`: every index name gets an in-memory index"""
+    latency = 0.0
+    indexes = {}
+
+    def __init__(self, api_key=None, **kwargs):
+        pass
+
+    def Index(self, name=None, host=None, **kwargs):
+        name = name or host
+        if name not in self.indexes:
+            self.indexes[name] = FakeIndex(name, self.latency)
+        return self.indexes[name]
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    media_latency = 0.0
+    inference_latency = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) >= 4 and parts[0] == "v1_1" and parts[-1] == "upload":
+            time.sleep(self.media_latency)
+            asset = uuid.uuid4().hex
+            url = f"https://res.cloudinary.com/{parts[1]}/image/upload/v1/barter_trade/{asset}.jpg"
+            self._reply(200, {"public_id": f"barter_trade/{asset}", "secure_url": url, "url": url,
+                              "format": "jpg", "width": 1080, "height": 1440, "resource_type": "image",
+                              "bytes": length})
+        elif parts[0] == "models":
+            time.sleep(self.inference_latency)
+            self._reply(200, VISION_LABELS)
+        else:
+            self._reply(404, {"error": f"no stub for {self.path}"})
+
+    def do_GET(self):
+        self._reply(200, {"status": "ok"})
+
+
+def serve_services(port: int, media_latency_ms: float, inference_latency_ms: float):
+    _StubHandler.media_latency = media_latency_ms / 1000
+    _StubHandler.inference_latency = inference_latency_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", port), _StubHandler)
+    server.daemon_threads = True
+    print(f"stub services on http://127.0.0.1:{port} "
+          f"(media {media_latency_ms} ms, inference {inference_latency_ms} ms)", flush=True)
+    server.serve_forever()
+
+
+def serve_app(port: int, mongodb_uri: str, db_name: str, services_url: str, vector_latency_ms: float,
+              workers_dir: str):
+    """Import main:app wired to the stand-ins and serve it"""
+    os.environ.update({
+        "MONGODB_URI": mongodb_uri,
+        "MONGODB_DB": db_name,
+        "API_KEY": "bench",
+        "HF_API": "bench",
+        "HF_VISION_API_URL": f"{services_url}/models/google/vit-base-patch16-224",
+        "CLOUDINARY_CLOUD_NAME": "bench",
+        "CLOUDINARY_API_KEY": "bench",
+        "CLOUDINARY_API_SECRET": "bench",
+        "MEDIA_BACKEND": "cloudinary",
+        "UPLOAD_SPOOL_DIR": os.path.join(workers_dir, "ingest"),
+        "CLASSIFICATION_CACHE_PATH": "",
+    })
+    sys.path.insert(0, BACKEND_DIR)
+    os.chdir(BACKEND_DIR)
+
+    import cloudinary
+    import pinecone
+
+    FakePinecone.latency = vector_latency_ms / 1000
+    pinecone.Pinecone = FakePinecone
+
+    import main
+    import vector_sync
+
+    cloudinary.config(upload_prefix=services_url)
+
+    # The index starts empty; fill it from the seeded products (no added latency)
+    index = FakePinecone.indexes[main.index_name]
+    index.latency = 0.0
+    products = list(main.products_collection.find({}, {"_id": 0}))
+    for start in range(0, len(products), 256):
+        index.upsert(vector_sync.vector_records(products[start:start + 256]))
+    index.latency = FakePinecone.latency
+    print(f"fake vector index seeded with {len(products)} products", flush=True)
+
+    import uvicorn
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-ins for load benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    services = commands.add_parser("services")
+    services.add_argument("--port", type=int, default=9100)
+    services.add_argument("--media-latency-ms", type=float, default=80)
+    services.add_argument("--inference-latency-ms", type=float, default=250)
+
+    app = commands.add_parser("app")
+    app.add_argument("--port", type=int, default=9000)
+    app.add_argument("--mongodb-uri", required=True)
+    app.add_argument("--db", required=True)
+    app.add_argument("--services-url", required=True)
+    app.add_argument("--vector-latency-ms", type=float, default=20)
+    app.add_argument("--work-dir", required=True)
+
+    args = parser.parse_args()
+    if args.command == "services":
+        serve_services(args.port, args.media_latency_ms, args.inference_latency_ms)
+    else:
+        serve_app(args.port, args.mongodb_uri, args.db, args.services_url, args.vector_latency_ms, args.work_dir)
+
+
+if __name__ == "__main__":
+    main()
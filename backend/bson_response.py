@@ -0,0 +1,69 @@
+"""JSON responses straight from Mongo documents.
+
+List endpoints return `BSONResponse(docs)` instead of the plain list, which
+skips FastAPI's generic `jsonable_encoder` pass and the per-document
+`doc["_id"] = str(doc["_id"])` loops. ObjectId, datetime and the other BSON
+scalar types are handled by the serializer's `default` hook. orjson is used
+when it is installed; otherwise we fall back to the stdlib encoder.
+
+The *_PROJECTION constants keep large internal fields (full Cloudinary
+upload details, raw vision labels) out of list payloads. Detail endpoints
+still return the full document.
+"""
+import json
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+PRODUCT_LIST_PROJECTION = {"image_details": 0, "image_categories": 0, "image_embeddings": 0}
+DONATION_LIST_PROJECTION = {"image_details": 0, "reservation": 0, "waitlist": 0}
+
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal128):
+        return float(obj.to_decimal())
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, bytes):
+        return obj.decode("utf-8", errors="replace")
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(content) -> bytes:
+        return orjson.dumps(content, default=_default, option=_ORJSON_OPTIONS)
+else:
+    def dumps(content) -> bytes:
+        return json.dumps(
+            content,
+            default=_default,
+            ensure_ascii=False,
+            allow_nan=False,
+            separators=(",", ":"),
+        ).encode("utf-8")
+
+
+class BSONResponse(JSONResponse):
+    """JSONResponse that serializes Mongo documents without pre-processing"""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,553 @@
+"""Bulk product import.
+
+Onboards a whole catalog (JSONL, or CSV with a header row) instead of one
+`/upload_product` call per listing. Rows are validated as the file streams
+in and imported in batches:
+
+    validate -> store images (thread pool) -> products.insert_many(ordered=False)
+             -> owners' items_listed bumped -> checkpoint saved on the job
+
+Images of the next batch are fetched while the current batch is written.
+vector_sync picks the inserts up from the change stream and embeds and
+upserts them in batches. Rows use the `/upload_product` field names (`productName`,
+`productDescription`, `productPrice`, `categories`, `userId`, ...) plus
+`images`: URLs or, for CLI imports, paths relative to the catalog file. In
+CSV, list fields are JSON or `|`-separated. Image classification is not run
+on imported images; `imageCategories` can be supplied per row instead.
+
+Product ids are derived from the job id and row number, so a batch that is
+replayed after a crash has its inserts come back as duplicates. Resuming simply continues after the last checkpoint:
+
+    python bulk_import.py run catalog.jsonl [--format csv] [--batch-size 512] [--keep-image-urls]
+    python bulk_import.py resume <job_id>
+    python bulk_import.py status <job_id>
+"""
+import asyncio
+import csv
+import ipaddress
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Iterator, List, Optional
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from pymongo.errors import BulkWriteError
+
+import ingestion
+import media_store
+import user_stats
+from response_cache import response_cache
+from upload_spool import MAX_FILE_BYTES, SpooledUpload
+
+IMPORT_DIR = os.getenv(
+    "IMPORT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads", "imports")
+)
+BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "512"))
+IMAGE_WORKERS = int(os.getenv("IMPORT_IMAGE_WORKERS", "32"))
+MAX_SOURCE_BYTES = int(os.getenv("IMPORT_MAX_SOURCE_BYTES", str(512 * 1024 * 1024)))
+MAX_IMAGES_PER_ROW = 10
+# Only the first errors are kept on the job document; the count is exact
+MAX_STORED_ERRORS = 1000
+IMAGE_FETCH_TIMEOUT = 30
+MAX_IMAGE_REDIRECTS = 5
+# Optional comma-separated host allowlist for image URLs (suffix match)
+IMAGE_HOSTS = [h.strip().lower() for h in os.getenv("IMPORT_IMAGE_HOSTS", "").split(",") if h.strip()]
+
+FIELD_ALIASES = {
+    "name": "productName",
+    "description": "productDescription",
+    "price": "productPrice",
+}
+
+# Duplicate key: the row was already imported by an earlier (interrupted) run
+_DUPLICATE_KEY = 11000
+
+# This will be set in setup_importer
+jobs_collection = None
+
+_stop = threading.Event()
+_tasks = set()
+_sessions = threading.local()
+
+
+def setup_importer(db):
+    global jobs_collection
+    jobs_collection = db["import_jobs"]
+
+
+def detect_format(filename: str) -> str:
+    extension = os.path.splitext(filename or "")[1].lower()
+    return "csv" if extension == ".csv" else "jsonl"
+
+
+def read_records(path: str, fmt: str, position: dict) -> Iterator[tuple]:
+    """Yield (record_number, row) from a catalog file, streaming.
+
+    `row` is a dict, or a ValueError for a record that could not be decoded.
+    `position["bytes"]` tracks how far into the file the reader is.
+    """
+    with open(path, "rb") as f:
+        def lines():
+            for raw in f:
+                position["bytes"] += len(raw)
+                yield raw.decode("utf-8", errors="replace")
+
+        if fmt == "csv":
+            for number, row in enumerate(csv.DictReader(lines()), start=1):
+                yield number, row
+            return
+
+        number = 0
+        for line in lines():
+            if not line.strip():
+                continue
+            number += 1
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield number, ValueError(f"Invalid JSON: {str(e)}")
+                continue
+            yield number, row if isinstance(row, dict) else ValueError("Row is not a JSON object")
+
+
+def _text(value) -> str:
+    return value.strip() if isinstance(value, str) else ("" if value is None else str(value))
+
+
+def _list(value) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return []
+        if value.startswith("["):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                raise ValueError(f"Invalid JSON list: {value[:80]}")
+        else:
+            return [part.strip() for part in value.split("|") if part.strip()]
+    if not isinstance(value, list):
+        raise ValueError("Expected a list")
+    return [_text(item) for item in value if _text(item)]
+
+
+def validate_row(row: dict) -> dict:
+    """Normalize a catalog row into an ingestion listing, or raise ValueError"""
+    row = {FIELD_ALIASES.get(key, key): value for key, value in row.items() if key is not None}
+
+    name = _text(row.get("productName"))
+    description = _text(row.get("productDescription"))
+    if not name:
+        raise ValueError("productName is required")
+    if not description:
+        raise ValueError("productDescription is required")
+
+    price = _text(row.get("productPrice")) or "0"
+    try:
+        float(price)
+    except ValueError:
+        raise ValueError(f"productPrice is not a number: {price[:40]}")
+
+    latitude = _text(row.get("latitude")) or None
+    longitude = _text(row.get("longitude")) or None
+    if bool(latitude) != bool(longitude):
+        raise ValueError("latitude and longitude must be given together")
+    if latitude and ingestion.parse_location(latitude, longitude) is None:
+        raise ValueError("latitude/longitude are not numbers")
+
+    images = _list(row.get("images"))
+    if len(images) > MAX_IMAGES_PER_ROW:
+        raise ValueError(f"At most {MAX_IMAGES_PER_ROW} images per row")
+
+    return {
+        "productName": name,
+        "productDescription": description,
+        "productPrice": price,
+        "categories": _list(row.get("categories")),
+        "imageCategories": _list(row.get("imageCategories")),
+        "images": images,
+        "userId": _text(row.get("userId")) or None,
+        "userEmail": _text(row.get("userEmail")) or None,
+        "userName": _text(row.get("userName")) or None,
+        "userAvatar": _text(row.get("userAvatar")),
+        "latitude": latitude,
+        "longitude": longitude,
+        "address": _text(row.get("address")) or None
+    }
+
+
+def product_id_for(job_id: str, record_number: int) -> str:
+    """Stable product id for a row, so replays are idempotent"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"import:{job_id}:{record_number}"))
+
+
+def _session() -> requests.Session:
+    # One pooled session per image worker thread
+    if not hasattr(_sessions, "session"):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+
+def check_image_url(url: str):
+    """Reject URLs that would make the server fetch from inside its own network.
+
+    Every address the host resolves to must be public: no private,
+    loopback, link-local (cloud metadata), multicast or reserved ranges.
+    """
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if parts.scheme not in ("http", "https") or not host:
+        raise ValueError(f"Unsupported image URL: {url}")
+    if IMAGE_HOSTS and not any(host == h or host.endswith("." + h) for h in IMAGE_HOSTS):
+        raise ValueError(f"Image host is not allowed: {host}")
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parts.port or None)}
+    except socket.gaierror:
+        raise ValueError(f"Image host does not resolve: {host}")
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%")[0])
+        if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"Image URL points to a non-public address: {url}")
+
+
+def _download(url: str) -> bytes:
+    # Redirects are followed by hand so every hop is checked
+    for _ in range(MAX_IMAGE_REDIRECTS + 1):
+        check_image_url(url)
+        with _session().get(url, stream=True, timeout=IMAGE_FETCH_TIMEOUT, allow_redirects=False) as response:
+            if response.is_redirect:
+                url = urljoin(url, response.headers["location"])
+                continue
+            response.raise_for_status()
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > MAX_FILE_BYTES:
+                    raise ValueError(f"Image is larger than {MAX_FILE_BYTES} bytes: {url}")
+                chunks.append(chunk)
+            return b"".join(chunks)
+    raise ValueError(f"Too many redirects fetching image: {url}")
+
+
+def store_image(ref: str, job: dict) -> dict:
+    """Image details for one image reference of a row"""
+    if ref.startswith(("http://", "https://")):
+        if job["keep_image_urls"]:
+            return {"url": ref, "public_id": "", "format": "", "width": 0, "height": 0,
+                    "resource_type": "image"}
+        return media_store.store.put(_download(ref), folder="barter_trade_products")
+
+    if not job["allow_local_paths"]:
+        raise ValueError(f"Local image paths are not allowed for this import: {ref}")
+    path = ref if os.path.isabs(ref) else os.path.join(os.path.dirname(job["source"]), ref)
+    if not os.path.isfile(path):
+        raise ValueError(f"Image not found: {ref}")
+    upload = SpooledUpload(path, os.path.basename(path), os.path.getsize(path), None, "")
+    with upload.view() as contents:
+        return media_store.store.put(contents, folder="barter_trade_products")
+
+
+class _Importer:
+    """Runs one import job from its checkpoint to the end of the file"""
+
+    def __init__(self, job: dict):
+        self.job = job
+        self.job_id = job["id"]
+        self.counts = {key: job.get(key, 0) for key in ("rows_read", "imported", "duplicates", "failed")}
+        self.position = {"bytes": 0}
+        self.started_at = time.time()
+        self.session_rows = 0
+        self.session_bytes_start = job.get("bytes_read", 0)
+
+    def batches(self) -> Iterator[dict]:
+        checkpoint = self.job.get("checkpoint", 0)
+        batch = {"rows": [], "errors": [], "last": checkpoint}
+        for number, row in read_records(self.job["source"], self.job["format"], self.position):
+            if number <= checkpoint:
+                continue
+            batch["last"] = number
+            try:
+                if isinstance(row, Exception):
+                    raise row
+                batch["rows"].append((number, validate_row(row)))
+            except ValueError as e:
+                batch["errors"].append({"row": number, "error": str(e)})
+
+            if len(batch["rows"]) + len(batch["errors"]) >= self.job["batch_size"]:
+                yield self._close(batch)
+                batch = {"rows": [], "errors": [], "last": number}
+
+        if batch["rows"] or batch["errors"]:
+            yield self._close(batch)
+
+    def _close(self, batch: dict) -> dict:
+        batch["size"] = len(batch["rows"]) + len(batch["errors"])
+        batch["bytes"] = self.position["bytes"]
+        return batch
+
+    def prepare(self, batch: dict, images: ThreadPoolExecutor) -> dict:
+        """Store every image of the batch; rows with a failed image become errors"""
+        futures = [
+            (number, listing, [images.submit(store_image, ref, self.job) for ref in listing["images"]])
+            for number, listing in batch["rows"]
+        ]
+        ready = []
+        for number, listing, image_futures in futures:
+            try:
+                ready.append((number, listing, [future.result() for future in image_futures]))
+            except Exception as e:
+                batch["errors"].append({"row": number, "error": f"Image failed: {str(e)}"})
+        batch["ready"] = ready
+        return batch
+
+    def commit(self, batch: dict):
+        ready = batch["ready"]
+        inserted_owners = []
+        if ready:
+            documents = [
+                ingestion.build_product_document(
+                    listing, product_id_for(self.job_id, number), image_details, listing["imageCategories"]
+                )
+                for number, listing, image_details in ready
+            ]
+
+            failed = {}
+            try:
+                user_stats.products_collection.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                failed = {error["index"]: error for error in e.details.get("writeErrors", [])}
+
+            for i, document in enumerate(documents):
+                error = failed.get(i)
+                if error is None:
+                    self.counts["imported"] += 1
+                    inserted_owners.append((document.get("user") or {}).get("id"))
+                elif error.get("code") == _DUPLICATE_KEY:
+                    self.counts["duplicates"] += 1
+                else:
+                    batch["errors"].append({"row": ready[i][0], "error": error.get("errmsg", "Insert failed")})
+
+        user_stats.count_listings(Counter(owner for owner in inserted_owners if owner))
+        if inserted_owners:
+            response_cache.invalidate("products", *{f"user:{owner}" for owner in inserted_owners if owner})
+
+        self.counts["failed"] += len(batch["errors"])
+        self.counts["rows_read"] = batch["last"]
+        self.session_rows += batch["size"]
+        self.save_checkpoint(batch)
+
+    def save_checkpoint(self, batch: dict):
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        bytes_done = batch["bytes"] - self.session_bytes_start
+        remaining = self.job["source_bytes"] - batch["bytes"]
+        eta = remaining / (bytes_done / elapsed) if bytes_done > 0 else None
+
+        update = {
+            "$set": dict(
+                self.counts,
+                checkpoint=batch["last"],
+                bytes_read=batch["bytes"],
+                progress=round(batch["bytes"] / self.job["source_bytes"], 4) if self.job["source_bytes"] else 1.0,
+                rows_per_second=round(self.session_rows / elapsed, 1),
+                eta_seconds=round(eta) if eta is not None else None,
+                updated_at=datetime.utcnow()
+            )
+        }
+        if batch["errors"]:
+            update["$push"] = {"errors": {"$each": batch["errors"], "$slice": MAX_STORED_ERRORS}}
+        jobs_collection.update_one({"id": self.job_id}, update)
+        print(f"Import {self.job_id}: row {batch['last']}, imported={self.counts['imported']} "
+              f"failed={self.counts['failed']} {update['$set']['rows_per_second']} rows/s "
+              f"eta={update['$set']['eta_seconds']}s")
+
+    def run(self):
+        with ThreadPoolExecutor(IMAGE_WORKERS) as images, ThreadPoolExecutor(1) as preparer:
+            pending = None
+            for batch in self.batches():
+                # Fetch this batch's images while the previous batch is written
+                future = preparer.submit(self.prepare, batch, images)
+                if pending is not None:
+                    self.commit(pending.result())
+                pending = future
+                if _stop.is_set():
+                    break
+            if pending is not None:
+                self.commit(pending.result())
+        return not _stop.is_set()
+
+
+def create_job(source: str, fmt: Optional[str] = None, batch_size: int = BATCH_SIZE,
+               keep_image_urls: bool = False, allow_local_paths: bool = True,
+               runner: str = "cli") -> dict:
+    now = datetime.utcnow()
+    job = {
+        "id": str(uuid.uuid4()),
+        "source": os.path.abspath(source),
+        "source_bytes": os.path.getsize(source),
+        "format": fmt or detect_format(source),
+        "batch_size": batch_size,
+        "keep_image_urls": keep_image_urls,
+        "allow_local_paths": allow_local_paths,
+        "runner": runner,
+        "status": "queued",
+        "checkpoint": 0,
+        "bytes_read": 0,
+        "rows_read": 0,
+        "imported": 0,
+        "duplicates": 0,
+        "failed": 0,
+        "errors": [],
+        "created_at": now,
+        "updated_at": now
+    }
+    jobs_collection.insert_one(job)
+    job.pop("_id", None)
+    return job
+
+
+def run(job_id: str) -> dict:
+    """Run (or resume) an import job to completion; blocking"""
+    job = jobs_collection.find_one({"id": job_id}, {"_id": 0, "errors": 0})
+    if not job:
+        raise ValueError(f"Import job {job_id} not found")
+    if job["status"] == "completed":
+        return job
+
+    jobs_collection.update_one({"id": job_id}, {"$set": {"status": "running", "error": None,
+                                                          "updated_at": datetime.utcnow()}})
+    try:
+        finished = _Importer(job).run()
+    except Exception as e:
+        print(f"Import job {job_id} failed: {str(e)}")
+        jobs_collection.update_one({"id": job_id}, {"$set": {"status": "failed", "error": str(e),
+                                                              "updated_at": datetime.utcnow()}})
+        raise
+
+    if finished:
+        jobs_collection.update_one({"id": job_id}, {"$set": {"status": "completed", "eta_seconds": 0,
+                                                              "updated_at": datetime.utcnow()}})
+        if job["runner"] == "api":
+            _remove(job["source"])
+    return get_job(job_id)
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    return jobs_collection.find_one({"id": job_id}, {"_id": 0, "source": 0})
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def submit(upload: SpooledUpload, fmt: Optional[str] = None, keep_image_urls: bool = False) -> dict:
+    """Queue an uploaded catalog for import in the background.
+
+    Local image paths are refused for uploaded catalogs; rows must use URLs.
+    """
+    upload.move_to(os.path.join(IMPORT_DIR, f"{uuid.uuid4()}{os.path.splitext(upload.filename)[1].lower()[:10]}"))
+    job = await asyncio.to_thread(
+        create_job, upload.path, fmt or detect_format(upload.filename),
+        keep_image_urls=keep_image_urls, allow_local_paths=False, runner="api"
+    )
+    _start_task(job["id"])
+    return job
+
+
+def _start_task(job_id: str):
+    task = asyncio.create_task(asyncio.to_thread(_run_quietly, job_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def _run_quietly(job_id: str):
+    try:
+        run(job_id)
+    except Exception:
+        pass  # Already recorded on the job
+
+
+async def start():
+    """Resume API-submitted imports left running by a previous process"""
+    _stop.clear()
+    try:
+        unfinished = await asyncio.to_thread(
+            lambda: [j["id"] for j in jobs_collection.find(
+                {"status": {"$in": ["queued", "running"]}, "runner": "api"}, {"id": 1})]
+        )
+        for job_id in unfinished:
+            _start_task(job_id)
+        if unfinished:
+            print(f"Resuming {len(unfinished)} import jobs")
+    except Exception as e:
+        print(f"Warning: Could not resume import jobs: {str(e)}")
+
+
+async def stop():
+    """Stop running imports after their current batch (they resume on start)"""
+    _stop.set()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import cloudinary
+    from dotenv import load_dotenv
+
+    import mongo_config
+
+    parser = argparse.ArgumentParser(description="Bulk import products from a JSONL or CSV catalog")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("source")
+    run_parser.add_argument("--format", choices=["jsonl", "csv"])
+    run_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    run_parser.add_argument("--keep-image-urls", action="store_true",
+                            help="reference image URLs as-is instead of re-hosting them")
+    commands.add_parser("resume").add_argument("job_id")
+    commands.add_parser("status").add_argument("job_id")
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = mongo_config.connect()
+    db = mongo_config.database(client)
+    user_stats.setup_collection(client, db)
+    media_store.setup_collection(db)
+
+    setup_importer(db)
+
+    if args.command == "status":
+        print(json.dumps(get_job(args.job_id), default=str, indent=2))
+        sys.exit(0)
+
+    cloudinary.config(
+        cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME"),
+        api_key=os.getenv("CLOUDINARY_API_KEY"),
+        api_secret=os.getenv("CLOUDINARY_API_SECRET"),
+        secure=True
+    )
+    if args.command == "run":
+        job = create_job(args.source, args.format, args.batch_size, args.keep_image_urls)
+        print(f"Import job {job['id']} (resume with: python bulk_import.py resume {job['id']})")
+        job_id = job["id"]
+    else:
+        job_id = args.job_id
+    result = run(job_id)
+    print(json.dumps({k: result.get(k) for k in ("id", "status", "imported", "duplicates", "failed")}))
@@ -0,0 +1,63 @@
+"""Local category prediction for listing drafts.
+
+Listing text is scored against one prototype vector per category, which is
+the normalized mean of the MiniLM embeddings of the category name and its
+CATEGORY_MAPPING items. The prototypes are built once, so a prediction is a
+single sentence encode plus a 7 x 384 dot product, instead of a call to the
+remote zero-shot model. Vision labels are mapped to categories with one
+precompiled regex instead of nested substring loops.
+
+`benchmarks/bench_categories.py` compares accuracy and latency with the
+remote `bart-large-mnli` path on a labelled sample.
+"""
+import re
+from typing import Dict, Iterable, List, Set
+
+import numpy as np
+
+CATEGORY_MAPPING = {
+    'electronics': ['laptop', 'mobile', 'camera', 'headphones', 'television', 'watch', 'earphones', 'tablet', 'smartwatch', 'speaker', 'microphone', 'radio', 'projector', 'drone', 'smartphone'],
+    'furniture': ['chair', 'table', 'sofa', 'bed', 'desk', 'cabinet', 'shelf', 'couch', 'stool', 'dresser'],
+    'clothing': ['shirt', 'pants', 'dress', 'shoes', 'jacket', 'skirt', 'sweater', 'jeans', 't-shirt', 'shorts'],
+    'books': ['textbook', 'novel', 'magazine', 'comic', 'manual', 'guide', 'encyclopedia', 'biography', 'journal', 'anthology'],
+    'automobile': ['car', 'bike', 'scooter', 'motorcycle', 'truck', 'van', 'bus', 'bicycle', 'trailer', 'moped'],
+    'sports': ['football', 'cricket', 'tennis', 'basketball', 'baseball', 'hockey', 'golf', 'volleyball', 'badminton', 'rugby'],
+    'other': ['other']
+}
+
+
+class CategoryPredictor:
+    def __init__(self, model, mapping: Dict[str, List[str]] = CATEGORY_MAPPING):
+        self.model = model
+        self.categories = list(mapping)
+
+        prototypes = []
+        for category in self.categories:
+            vectors = model.encode([category] + mapping[category], normalize_embeddings=True)
+            prototype = vectors.mean(axis=0)
+            prototypes.append(prototype / np.linalg.norm(prototype))
+        self.prototypes = np.vstack(prototypes).astype(np.float32)
+
+        # Whole-word matches, longest item first ("t-shirt" before "shirt");
+        # plain substring matching mapped e.g. "cardigan" to automobile
+        self.item_category = {item: category for category, items in mapping.items() for item in items}
+        alternation = "|".join(re.escape(item) for item in sorted(self.item_category, key=len, reverse=True))
+        self.label_pattern = re.compile(rf"\b({alternation})s?\b", re.IGNORECASE)
+
+    def scores(self, text: str) -> Dict[str, float]:
+        vector = self.model.encode(text, normalize_embeddings=True)
+        similarities = self.prototypes @ vector.astype(np.float32)
+        return dict(zip(self.categories, similarities.tolist()))
+
+    def predict_text(self, text: str, top_n: int = 1) -> List[str]:
+        """The `top_n` categories closest to the text"""
+        scores = self.scores(text)
+        return sorted(scores, key=scores.get, reverse=True)[:top_n]
+
+    def categories_for_labels(self, labels: Iterable[str]) -> Set[str]:
+        """Categories named by vision model labels (e.g. "sports car, sport car")"""
+        found = set()
+        for label in labels:
+            for match in self.label_pattern.finditer(label):
+                found.add(self.item_category[match.group(1).lower()])
+        return found
@@ -0,0 +1,131 @@
+"""Cache of image classification results keyed by content hash.
+
+The same photo is often classified several times: `/api/search_by_image`
+retries, `/predict_categories` on the draft, then the ingestion pipeline
+when the listing is uploaded. Results are keyed by
+`<model version>:<sha256 of the image bytes>`, so identical bytes hit the
+cache whatever their filename. A new model version simply misses.
+
+Lookups go to an in-memory LRU first and then to a local SQLite file, which
+survives restarts. Empty results (a failed remote call) are not cached.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+CACHE_PATH = os.getenv(
+    "CLASSIFICATION_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads", "classification_cache.sqlite3")
+)
+MEMORY_ENTRIES = int(os.getenv("CLASSIFICATION_CACHE_MEMORY_ENTRIES", "10000"))
+DISK_ENTRIES = int(os.getenv("CLASSIFICATION_CACHE_DISK_ENTRIES", "1000000"))
+# Trim the disk store back to DISK_ENTRIES after this many writes
+_TRIM_EVERY = 1000
+
+
+class ClassificationCache:
+    def __init__(self, path: str = CACHE_PATH, memory_entries: int = MEMORY_ENTRIES,
+                 disk_entries: int = DISK_ENTRIES):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.memory: "OrderedDict[str, Any]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.writes = 0
+        self.db = None
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        # Opened lazily so importing the module never touches the disk
+        if self.db is None and self.path:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                db = sqlite3.connect(self.path, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS results "
+                           "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)")
+                self.db = db
+            except sqlite3.Error as e:
+                print(f"Warning: Classification cache running without disk store: {str(e)}")
+                self.path = None
+        return self.db
+
+    def _count(self, model_version: str, outcome: str):
+        counters = self.counters.setdefault(model_version, {"memory_hits": 0, "disk_hits": 0, "misses": 0})
+        counters[outcome] += 1
+
+    def _remember(self, key: str, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, model_version: str, digest: str):
+        key = f"{model_version}:{digest}"
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self._count(model_version, "memory_hits")
+                return self.memory[key]
+
+            db = self._connection()
+            row = None
+            if db is not None:
+                try:
+                    row = db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                except sqlite3.Error as e:
+                    print(f"Warning: Classification cache read failed: {str(e)}")
+            if row is None:
+                self._count(model_version, "misses")
+                return None
+
+            value = json.loads(row[0])
+            self._remember(key, value)
+            self._count(model_version, "disk_hits")
+            return value
+
+    def put(self, model_version: str, digest: str, value):
+        key = f"{model_version}:{digest}"
+        with self.lock:
+            self._remember(key, value)
+            db = self._connection()
+            if db is None:
+                return
+            try:
+                db.execute("INSERT OR REPLACE INTO results (key, value, created_at) VALUES (?, ?, ?)",
+                           (key, json.dumps(value), time.time()))
+                self.writes += 1
+                if self.writes % _TRIM_EVERY == 0:
+                    db.execute("DELETE FROM results WHERE key IN (SELECT key FROM results "
+                               "ORDER BY created_at DESC LIMIT -1 OFFSET ?)", (self.disk_entries,))
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"Warning: Classification cache write failed: {str(e)}")
+
+    def get_or_compute(self, model_version: str, digest: Optional[str], compute: Callable[[], Any]):
+        """Cached result for (model_version, digest), computing it on a miss"""
+        if not digest:
+            return compute()
+        value = self.get(model_version, digest)
+        if value is not None:
+            return value
+        value = compute()
+        if value:
+            self.put(model_version, digest, value)
+        return value
+
+    def stats(self) -> dict:
+        with self.lock:
+            by_model = {}
+            for model_version, counters in self.counters.items():
+                total = sum(counters.values())
+                hits = counters["memory_hits"] + counters["disk_hits"]
+                by_model[model_version] = dict(counters, hit_ratio=round(hits / total, 3) if total else 0.0)
+            return {"memory_entries": len(self.memory), "disk_store": bool(self.path), "models": by_model}
+
+
+classification_cache = ClassificationCache()
@@ -1,14 +1,20 @@
-from fastapi import APIRouter, HTTPException, File, UploadFile, Form
-from typing import List, Optional
-from datetime import datetime
+from fastapi import APIRouter, HTTPException, File, UploadFile, Form, Request, Query
+from typing import List, Optional, Tuple
+from datetime import datetime, timedelta
+import asyncio
+import base64
+import math
+import os
 import uuid
 import json
-import cloudinary
-import cloudinary.uploader
-from pymongo import GEOSPHERE
 
-import time
-from requests.exceptions import RequestException, ConnectionError
+from pymongo import ReturnDocument
+
+from media_uploader import MediaUploadError, uploader
+from upload_spool import SpooledUpload, spool_upload
+from bson_response import BSONResponse, DONATION_LIST_PROJECTION
+from response_cache import response_cache
+from semantic_search import covering_cells, geo_cells
 
 # Create router for donation endpoints
 router = APIRouter(
@@ -16,6 +22,15 @@ router = APIRouter(
     tags=["donations"]
 )
 
+# How long a reservation holds a donation, and how many may queue behind it
+RESERVATION_SECONDS = int(os.getenv("DONATION_RESERVATION_SECONDS", "600"))
+WAITLIST_LIMIT = int(os.getenv("DONATION_WAITLIST_LIMIT", "50"))
+
+# Nearby feed first pages are cached per cell of this grid (degrees, ~1.1 km)
+FEED_CELL_DEGREES = float(os.getenv("DONATION_FEED_CELL_DEGREES", "0.01"))
+# $geoNear measures GeoJSON distances on a sphere of this radius
+EARTH_RADIUS_M = 6378100.0
+
 # This will be set in main.py when importing this module
 donated_products_collection = None
 
@@ -24,55 +39,7 @@ def setup_collection(db):
     global donated_products_collection
     donated_products_collection = db["donated_products"]
     
-    # Create indexes
-    donated_products_collection.create_index([("is_available", 1)])
-    donated_products_collection.create_index([("categories", 1)])
-    donated_products_collection.create_index([("donor.id", 1)])
-    
-    try:
-        donated_products_collection.create_index([("location", GEOSPHERE)])
-    except Exception as e:
-        print(f"Warning: Could not create geospatial index: {str(e)}")
-
-# Helper function to upload images to Cloudinary
-async def upload_to_cloudinary(file: UploadFile, product_id: str, index: int, max_retries=3):
-    retries = 0
-    while retries < max_retries:
-        try:
-            contents = await file.read()
-            
-            # Create a unique public_id
-            public_id = f"barter_trade/donations/{product_id}_{index}"
-            
-            # Upload to Cloudinary
-            upload_result = cloudinary.uploader.upload(
-                contents,
-                public_id=public_id,
-                folder="donations",
-                resource_type="auto",
-                timeout=30  # Increase timeout
-            )
-            
-            # Reset file pointer
-            await file.seek(0)
-            
-            return {
-                "url": upload_result["secure_url"],
-                "public_id": upload_result["public_id"],
-                "format": upload_result["format"],
-                "width": upload_result["width"],
-                "height": upload_result["height"]
-            }
-        except (ConnectionError, RequestException) as e:
-            retries += 1
-            print(f"Connection error on attempt {retries}: {str(e)}")
-            if retries >= max_retries:
-                raise HTTPException(status_code=500, detail=f"Image upload failed after {max_retries} attempts: Connection error")
-            # Wait before retrying
-            time.sleep(2)
-        except Exception as e:
-            print(f"Error uploading to Cloudinary: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Image upload failed: {str(e)}")
+    # Indexes are declared in index_manager.INDEXES and applied from main.py
 
 # Create a new donation
 @router.post("/create")
@@ -97,8 +64,6 @@ async def create_donation(
         product_id = str(uuid.uuid4())
         
         # Process images
-        image_urls = []
-        image_details = []
         files = [file1]
         
         if file2 and file2.filename:
@@ -106,12 +71,20 @@ async def create_donation(
         if file3 and file3.filename:
             files.append(file3)
         
-        # Upload each image to Cloudinary
-        for i, file in enumerate(files):
-            if file and file.filename:
-                cloudinary_result = await upload_to_cloudinary(file, product_id, i+1)
-                image_urls.append(cloudinary_result["url"])
-                image_details.append(cloudinary_result)
+        # Stream each image to a spool file, then upload them all at once
+        uploads: List[SpooledUpload] = []
+        try:
+            for file in files:
+                if file and file.filename:
+                    uploads.append(await spool_upload(file))
+            image_details = await uploader.upload_many(uploads, "donations")
+        except MediaUploadError as e:
+            print(f"Error uploading donation images: {str(e)}")
+            raise HTTPException(status_code=502, detail=str(e))
+        finally:
+            for upload in uploads:
+                upload.discard()
+        image_urls = [details["url"] for details in image_details]
         
         # Parse categories
         try:
@@ -153,12 +126,15 @@ async def create_donation(
             },
             # Location
             "location": location,
-            # Initially no claimer
-            "claim": None
+            # Initially no claimer, reservation or waitlist
+            "claim": None,
+            "reservation": None,
+            "waitlist": []
         }
         
         # Insert into MongoDB
         result = donated_products_collection.insert_one(donation)
+        response_cache.invalidate("donations", *feed_invalidation_tags(location, parsed_categories))
         
         # Return success response
         return {
@@ -176,6 +152,7 @@ async def create_donation(
 # Get all donations with optional filtering
 @router.get("/")
 async def get_donations(
+    request: Request,
     category: Optional[str] = None,
     available_only: bool = True,
     skip: int = 0,
@@ -183,6 +160,10 @@ async def get_donations(
 ):
     """Get all donations with optional filtering"""
     try:
+        cached = response_cache.lookup(request)
+        if cached:
+            return cached
+        
         # Build query
         query = {}
         
@@ -193,28 +174,82 @@ async def get_donations(
             query["categories"] = category
         
         # Get donations from database
-        donations = list(donated_products_collection.find(query)
+        donations = list(donated_products_collection.find(query, DONATION_LIST_PROJECTION)
                          .sort("created_at", -1)
                          .skip(skip)
                          .limit(limit))
-        
-        # Convert ObjectId to string
-        for donation in donations:
-            if "_id" in donation:
-                donation["_id"] = str(donation["_id"])
                 
-        return donations
+        return response_cache.store(request, donations, tags=["donations"])
         
     except Exception as e:
         print(f"Error fetching donations: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch donations: {str(e)}")
 
+# Browse available donations near a point, nearest first
+@router.get("/nearby")
+async def get_nearby_donations(
+    request: Request,
+    latitude: float = Query(..., ge=-90, le=90),
+    longitude: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(10, gt=0, le=100),
+    category: Optional[List[str]] = Query(None),
+    limit: int = Query(20, ge=1, le=50),
+    cursor: Optional[str] = None
+):
+    """
+    Available donations within `radius_km` of the given point, ordered by
+    distance. Pass the returned `next_cursor` back to get the next page.
+
+    First pages are built from candidates cached once per ~1 km feed cell:
+    the donations nearest the cell centre, out to the radius plus the
+    distance from the centre to the cell's corners. Each caller's page is
+    cut from them by the true distance, falling back to a live query when
+    they cannot settle it. Only donations created or claimed inside the
+    candidates' circle (and in their categories) invalidate them.
+    """
+    try:
+        categories = sorted({c for c in category or [] if c and c.lower() != "all"})
+        radius_m = radius_km * 1000
+        after = _decode_cursor(cursor) if cursor else None
+
+        page = None
+        if after is None:
+            origin_lat, origin_lng = feed_origin(latitude, longitude)
+            key = f"/donations/nearby?{origin_lat}:{origin_lng}:{radius_km:g}:{','.join(categories)}:{limit}"
+            candidates = response_cache.lookup_value(request, key)
+            if candidates is None:
+                candidates = await asyncio.to_thread(
+                    first_page_candidates, origin_lat, origin_lng, radius_m, categories, limit
+                )
+                response_cache.store_value(request, key, candidates, tags=feed_page_tags(
+                    origin_lat, origin_lng, radius_m + candidates["slack_m"], categories
+                ))
+            page = first_page(candidates, latitude, longitude, radius_m, limit)
+
+        if page is None:
+            page = await asyncio.to_thread(nearby, latitude, longitude, radius_m, categories, limit, after)
+        donations, next_cursor = page
+        return BSONResponse({
+            "origin": {"latitude": latitude, "longitude": longitude},
+            "donations": donations,
+            "next_cursor": next_cursor
+        })
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error fetching nearby donations: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to fetch nearby donations: {str(e)}")
+
 # Get a specific donation
 @router.get("/{donation_id}")
 async def get_donation(donation_id: str):
     """Get a specific donation by ID"""
     try:
-        donation = donated_products_collection.find_one({"id": donation_id})
+        # The waitlist and the holder's email stay private
+        donation = donated_products_collection.find_one(
+            {"id": donation_id}, {"waitlist": 0, "reservation.user.email": 0}
+        )
         
         if not donation:
             raise HTTPException(status_code=404, detail="Donation not found")
@@ -231,6 +266,290 @@ async def get_donation(donation_id: str):
         print(f"Error fetching donation: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch donation: {str(e)}")
 
+def feed_origin(lat: float, lng: float) -> Tuple[float, float]:
+    """Centre of the feed cell containing the point"""
+    return tuple(
+        round((math.floor(v / FEED_CELL_DEGREES) + 0.5) * FEED_CELL_DEGREES, 6) for v in (lat, lng)
+    )
+
+
+def distance_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance on the sphere $geoNear uses, rounded like feed distances"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return round(2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0))), 2)
+
+
+def snap_error_m(origin_lat: float, origin_lng: float) -> float:
+    """Furthest any point of a feed cell is from its centre"""
+    half = FEED_CELL_DEGREES / 2
+    return max(distance_m(origin_lat, origin_lng, origin_lat + dlat, origin_lng + half)
+               for dlat in (-half, half))
+
+
+def _feed_tag(cell: str, category: str) -> str:
+    return f"donations:near:{cell}:{category}"
+
+
+def feed_page_tags(lat: float, lng: float, radius_m: float, categories: List[str]) -> List[str]:
+    """Tags of a cached feed page: the grid cells covering its circle, per category"""
+    return [_feed_tag(cell, category) for cell in covering_cells(lat, lng, radius_m)
+            for category in categories or ["*"]]
+
+
+def feed_invalidation_tags(location: Optional[dict], categories: Optional[List[str]]) -> List[str]:
+    """Tags of every feed page a donation at `location` can appear on"""
+    if not location:
+        return []
+    lng, lat = location["coordinates"]
+    return [_feed_tag(cell, category) for cell in geo_cells(lat, lng)
+            for category in ["*", *(categories or [])]]
+
+
+def _encode_cursor(donation: dict) -> str:
+    raw = json.dumps({"d": donation["distance_m"], "id": donation["id"]}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> Tuple[float, str]:
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return float(raw["d"]), str(raw["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _feed_query(categories: List[str]) -> dict:
+    query = {"is_available": True}
+    if categories:
+        query["categories"] = {"$in": categories}
+    return query
+
+
+def _read_near(lat: float, lng: float, query: dict, min_distance: float, max_distance: float,
+               page_size: Optional[int], after: Optional[Tuple[float, str]] = None) -> List[dict]:
+    """Donations by distance from a point, with `distance_m` rounded to the
+    centimetre as in `distance_m`, so cursors compare equal either way"""
+    # Named explicitly: with a second 2dsphere index $geoNear refuses to guess
+    near = {"near": {"type": "Point", "coordinates": [lng, lat]}, "key": "location",
+            "distanceField": "distance_m", "spherical": True, "query": query,
+            "minDistance": max(min_distance - 0.01, 0), "maxDistance": max_distance + 0.01}
+    pipeline = [{"$geoNear": near}, {"$set": {"distance_m": {"$round": ["$distance_m", 2]}}},
+                {"$match": {"distance_m": {"$gte": min_distance, "$lte": max_distance}}}]
+    if after:
+        pipeline.append({"$match": {"$or": [{"distance_m": {"$gt": after[0]}},
+                                            {"distance_m": after[0], "id": {"$gt": after[1]}}]}})
+    if page_size:
+        pipeline.append({"$limit": page_size})
+    pipeline.append({"$project": DONATION_LIST_PROJECTION})
+    return list(donated_products_collection.aggregate(pipeline))
+
+
+def first_page_candidates(origin_lat: float, origin_lng: float, radius_m: float,
+                          categories: List[str], limit: int) -> dict:
+    """What every first page in a feed cell is cut from (cached per cell).
+
+    Donations nearest the cell centre out to `radius_m` plus the snapping
+    error. `reach_m` is the true distance within which a caller anywhere in
+    the cell is guaranteed to see every donation, unless `complete` says
+    the candidates are everything in range.
+    """
+    slack = snap_error_m(origin_lat, origin_lng)
+    size = 2 * (limit + 1)
+    candidates = _read_near(origin_lat, origin_lng, _feed_query(categories), 0, radius_m + slack, size)
+    complete = len(candidates) < size
+    return {"candidates": candidates, "complete": complete, "slack_m": slack,
+            "reach_m": None if complete else candidates[-1]["distance_m"] - slack}
+
+
+def first_page(candidates: dict, lat: float, lng: float, radius_m: float,
+               limit: int) -> Optional[Tuple[List[dict], Optional[str]]]:
+    """A caller's first page from the cell's candidates, or None when they
+    do not settle it and the page has to be read live"""
+    page = []
+    for donation in candidates["candidates"]:
+        coordinates = (donation.get("location") or {}).get("coordinates")
+        if not coordinates:
+            continue
+        distance = distance_m(lat, lng, coordinates[1], coordinates[0])
+        # Past reach_m, an uncached donation could be nearer than this one
+        if distance <= radius_m and (candidates["complete"] or distance < candidates["reach_m"]):
+            page.append(dict(donation, distance_m=distance))
+    if not candidates["complete"] and len(page) <= limit:
+        return None
+
+    page.sort(key=lambda d: (d["distance_m"], d["id"]))
+    donations = page[:limit]
+    next_cursor = _encode_cursor(donations[-1]) if len(page) > limit else None
+    return donations, next_cursor
+
+
+def nearby(lat: float, lng: float, radius_m: float, categories: List[str], limit: int,
+           after: Optional[Tuple[float, str]] = None) -> Tuple[List[dict], Optional[str]]:
+    """One page of available donations by distance, then id.
+
+    $geoNear streams in distance order, so a page is the next `limit + 1`
+    matches past the cursor. Donations at exactly the same distance (one
+    donor's address, typically) come in no particular order. The whole group
+    at the page boundary is therefore read again and ordered by id. That
+    keeps the (distance, id) cursor exact even when a group spans pages.
+    """
+    query = _feed_query(categories)
+    page = _read_near(lat, lng, query, after[0] if after else 0, radius_m, limit + 1, after)
+    if len(page) > limit:
+        boundary = page[-1]["distance_m"]
+        page = [d for d in page if d["distance_m"] < boundary] + \
+            _read_near(lat, lng, query, boundary, boundary, None, after)
+    page.sort(key=lambda d: (d["distance_m"], d["id"]))
+
+    donations = page[:limit]
+    next_cursor = _encode_cursor(donations[-1]) if len(page) > limit else None
+    return donations, next_cursor
+
+
+def _person(user_id: str, name: str, email: str, avatar: str) -> dict:
+    return {"id": user_id, "name": name, "email": email, "avatar": avatar}
+
+
+def _unreserved(now: datetime) -> dict:
+    return {"$or": [{"reservation": None}, {"reservation.expires_at": {"$lte": now}}]}
+
+
+def promote_waitlist(donation_id: str, now: datetime) -> Optional[dict]:
+    """Hand an expired reservation to the head of the waitlist (lazily, on access)"""
+    return donated_products_collection.find_one_and_update(
+        {"id": donation_id, "is_available": True, "reservation.expires_at": {"$lte": now},
+         "waitlist.0": {"$exists": True}},
+        [{"$set": {
+            "reservation": {
+                "user": {"$arrayElemAt": ["$waitlist", 0]},
+                "reserved_at": now,
+                "expires_at": now + timedelta(seconds=RESERVATION_SECONDS)
+            },
+            "waitlist": {"$slice": ["$waitlist", 1, WAITLIST_LIMIT]}
+        }}],
+        projection={"_id": 0, "reservation": 1},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def claim(donation_id: str, claimant: dict) -> Tuple[str, Optional[dict]]:
+    """Claim a donation in one conditional update.
+
+    The claim wins only if the donation is still available and the claimant
+    holds its reservation, or nobody holds one and nobody is waiting.
+    Returns (outcome, document) with outcome one of "claimed", "not_found",
+    "unavailable" or "reserved".
+    """
+    for attempt in range(2):
+        now = datetime.utcnow()
+        claimed = donated_products_collection.find_one_and_update(
+            {"id": donation_id, "is_available": True, "$or": [
+                {"reservation.user.id": claimant["id"], "reservation.expires_at": {"$gt": now}},
+                {"$and": [_unreserved(now), {"waitlist.0": {"$exists": False}}]}
+            ]},
+            {"$set": {
+                "is_available": False,
+                "updated_at": now,
+                "claim": {"claimed_at": now, "claimed_by": claimant},
+                "reservation": None,
+                "waitlist": []
+            }},
+            projection={"_id": 0, "id": 1, "claim": 1, "location": 1, "categories": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if claimed:
+            return "claimed", claimed
+
+        # Lost: one more read to say why (only on this path)
+        donation = donated_products_collection.find_one(
+            {"id": donation_id}, {"_id": 0, "is_available": 1, "reservation": 1, "waitlist.id": 1}
+        )
+        if not donation:
+            return "not_found", None
+        if not donation.get("is_available", False):
+            return "unavailable", donation
+        reservation = donation.get("reservation")
+        if attempt == 0 and reservation and reservation["expires_at"] <= now and donation.get("waitlist"):
+            # The reservation lapsed; pass it on and retry (the claimant may be next)
+            promote_waitlist(donation_id, now)
+            continue
+        return "reserved", donation
+    return "reserved", donation
+
+
+def reserve(donation_id: str, user: dict) -> Tuple[str, Optional[dict]]:
+    """Hold a donation for RESERVATION_SECONDS, or join its waitlist.
+
+    Returns (outcome, document) with outcome one of "reserved", "waitlisted",
+    "not_found", "unavailable" or "waitlist_full".
+    """
+    now = datetime.utcnow()
+    promote_waitlist(donation_id, now)
+
+    reserved = donated_products_collection.find_one_and_update(
+        {"id": donation_id, "is_available": True, "waitlist.0": {"$exists": False}, **_unreserved(now)},
+        {"$set": {"reservation": {"user": user, "reserved_at": now,
+                                  "expires_at": now + timedelta(seconds=RESERVATION_SECONDS)}}},
+        projection={"_id": 0, "reservation": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if reserved:
+        return "reserved", reserved
+
+    waitlisted = donated_products_collection.find_one_and_update(
+        {"id": donation_id, "is_available": True, "reservation.expires_at": {"$gt": now},
+         "reservation.user.id": {"$ne": user["id"]}, "waitlist.id": {"$ne": user["id"]},
+         f"waitlist.{WAITLIST_LIMIT - 1}": {"$exists": False}},
+        {"$push": {"waitlist": user}},
+        projection={"_id": 0, "reservation": 1, "waitlist.id": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if waitlisted:
+        return "waitlisted", waitlisted
+
+    donation = donated_products_collection.find_one(
+        {"id": donation_id}, {"_id": 0, "is_available": 1, "reservation": 1, "waitlist.id": 1}
+    )
+    if not donation:
+        return "not_found", None
+    if not donation.get("is_available", False):
+        return "unavailable", donation
+    if ((donation.get("reservation") or {}).get("user") or {}).get("id") == user["id"]:
+        return "reserved", donation
+    if any(w["id"] == user["id"] for w in donation.get("waitlist") or []):
+        return "waitlisted", donation
+    return "waitlist_full", donation
+
+
+def release(donation_id: str, user_id: str) -> bool:
+    """Give up a reservation or waitlist place; the next in line is promoted"""
+    now = datetime.utcnow()
+    result = donated_products_collection.update_one(
+        {"id": donation_id, "reservation.user.id": user_id, "reservation.expires_at": {"$gt": now}},
+        {"$set": {"reservation.expires_at": now}}
+    )
+    left = donated_products_collection.update_one(
+        {"id": donation_id, "waitlist.id": user_id},
+        {"$pull": {"waitlist": {"id": user_id}}}
+    )
+    if result.modified_count:
+        promote_waitlist(donation_id, now)
+    return bool(result.modified_count or left.modified_count)
+
+
+def _reservation_view(document: dict, user_id: str) -> dict:
+    reservation = document.get("reservation") or {}
+    waitlist = [w["id"] for w in document.get("waitlist") or []]
+    return {
+        "reserved_by_you": (reservation.get("user") or {}).get("id") == user_id,
+        "reserved_until": reservation.get("expires_at"),
+        "waitlist_position": waitlist.index(user_id) + 1 if user_id in waitlist else None,
+        "waitlist_length": len(waitlist)
+    }
+
+
 # Claim a donation
 @router.post("/{donation_id}/claim")
 async def claim_donation(
@@ -240,37 +559,25 @@ async def claim_donation(
     userEmail: str = Form(...),
     userAvatar: str = Form("")
 ):
-    """Claim a donation"""
+    """Claim a donation (exactly one concurrent claimant wins)"""
     try:
-        # Find the donation
-        donation = donated_products_collection.find_one({"id": donation_id})
-        
-        if not donation:
+        claimant = _person(userId, userName, userEmail, userAvatar)
+        outcome, donation = await asyncio.to_thread(claim, donation_id, claimant)
+
+        if outcome == "not_found":
             raise HTTPException(status_code=404, detail="Donation not found")
-            
-        # Check if already claimed
-        if not donation.get("is_available", False):
+        if outcome == "unavailable":
             raise HTTPException(status_code=400, detail="This donation has already been claimed")
-            
-        # Update the donation
-        donated_products_collection.update_one(
-            {"id": donation_id},
-            {
-                "$set": {
-                    "is_available": False,
-                    "updated_at": datetime.utcnow(),
-                    "claim": {
-                        "claimed_at": datetime.utcnow(),
-                        "claimed_by": {
-                            "id": userId,
-                            "name": userName,
-                            "email": userEmail,
-                            "avatar": userAvatar
-                        }
-                    }
-                }
-            }
-        )
+        if outcome == "reserved":
+            view = _reservation_view(donation, userId)
+            raise HTTPException(status_code=409, detail={
+                "message": "This donation is reserved; reserve it to join the waitlist",
+                "reserved_until": view["reserved_until"].isoformat() if view["reserved_until"] else None,
+                "waitlist_length": view["waitlist_length"]
+            })
+
+        response_cache.invalidate("donations", f"donation:{donation_id}",
+                                  *feed_invalidation_tags(donation.get("location"), donation.get("categories")))
         
         return {
             "success": True,
@@ -281,4 +588,52 @@ async def claim_donation(
         raise
     except Exception as e:
         print(f"Error claiming donation: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to claim donation: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Failed to claim donation: {str(e)}")
+
+
+# Reserve a donation, or join its waitlist
+@router.post("/{donation_id}/reserve")
+async def reserve_donation(
+    donation_id: str,
+    userId: str = Form(...),
+    userName: str = Form(...),
+    userEmail: str = Form(...),
+    userAvatar: str = Form("")
+):
+    """Hold a donation for a few minutes so it can be claimed; when someone
+    else holds it, join the waitlist and get it when their hold lapses"""
+    try:
+        user = _person(userId, userName, userEmail, userAvatar)
+        outcome, donation = await asyncio.to_thread(reserve, donation_id, user)
+
+        if outcome == "not_found":
+            raise HTTPException(status_code=404, detail="Donation not found")
+        if outcome == "unavailable":
+            raise HTTPException(status_code=400, detail="This donation has already been claimed")
+        if outcome == "waitlist_full":
+            raise HTTPException(status_code=409, detail="The waitlist for this donation is full")
+
+        return BSONResponse(dict(_reservation_view(donation, userId), success=True, status=outcome))
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error reserving donation: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to reserve donation: {str(e)}")
+
+
+# Give up a reservation or waitlist place
+@router.delete("/{donation_id}/reserve")
+async def release_donation(donation_id: str, userId: str = Query(...)):
+    """Release a reservation or leave the waitlist"""
+    try:
+        released = await asyncio.to_thread(release, donation_id, userId)
+        if not released:
+            raise HTTPException(status_code=404, detail="No reservation or waitlist place to release")
+        return {"success": True}
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error releasing donation: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to release donation: {str(e)}")
@@ -0,0 +1,194 @@
+"""Batched lookups of users and products for embedding snapshots.
+
+Endpoints get a fresh `Hydrator` per request (`Depends(get_hydrator)`),
+queue every id they are going to need, then call `dispatch()` once. Each
+collection is then resolved with a single `$in` query, skipping ids already
+held in the per-request cache or in the bounded process-wide cache.
+
+    hydrator.users.queue(room["buyer_id"], room["seller_id"])
+    hydrator.products.queue(room["product_id"])
+    hydrator.dispatch()
+    buyer = hydrator.users.get(room["buyer_id"])
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+SHARED_CACHE_TTL = float(os.getenv("HYDRATION_CACHE_TTL", "30"))
+SHARED_CACHE_MAX_ENTRIES = int(os.getenv("HYDRATION_CACHE_MAX_ENTRIES", "10000"))
+
+USER_PROJECTION = {"_id": 0, "id": 1, "name": 1, "avatar": 1}
+PRODUCT_PROJECTION = {"_id": 0, "id": 1, "name": 1, "images": 1, "user.id": 1}
+
+# These will be set in setup_collection
+users_collection = None
+products_collection = None
+
+
+def setup_collection(db):
+    global users_collection, products_collection
+    users_collection = db["users"]
+    products_collection = db["products"]
+
+
+class _SharedCache:
+    """Process-wide LRU of recently loaded documents with a short TTL"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, dict]:
+        found = {}
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                item = self.entries.get(key)
+                if item is None:
+                    continue
+                expires_at, doc = item
+                if expires_at <= now:
+                    del self.entries[key]
+                    continue
+                self.entries.move_to_end(key)
+                found[key] = doc
+        return found
+
+    def put_many(self, docs: Dict[str, dict]):
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            for key, doc in docs.items():
+                self.entries[key] = (expires_at, doc)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *keys: str):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+
+_shared_users = _SharedCache(SHARED_CACHE_TTL, SHARED_CACHE_MAX_ENTRIES)
+_shared_products = _SharedCache(SHARED_CACHE_TTL, SHARED_CACHE_MAX_ENTRIES)
+
+
+class BatchLoader:
+    """Collects ids for one collection and resolves them with one `$in` query"""
+
+    def __init__(self, collection_name: str, projection: dict, shared: _SharedCache):
+        self.collection_name = collection_name
+        self.projection = projection
+        self.shared = shared
+        self.pending = set()
+        self.loaded: Dict[str, Optional[dict]] = {}
+        self.queries = 0
+
+    def queue(self, *keys: Optional[str]):
+        for key in keys:
+            if key and key not in self.loaded:
+                self.pending.add(key)
+
+    def dispatch(self):
+        if not self.pending:
+            return
+        keys, self.pending = self.pending, set()
+
+        found = self.shared.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            collection = users_collection if self.collection_name == "users" else products_collection
+            fetched = {doc["id"]: doc for doc in collection.find({"id": {"$in": missing}}, self.projection)}
+            self.queries += 1
+            self.shared.put_many(fetched)
+            found.update(fetched)
+
+        for key in keys:
+            # Remember misses too so they are not queried again in this request
+            self.loaded[key] = found.get(key)
+
+    def get(self, key: Optional[str]) -> Optional[dict]:
+        if key and key not in self.loaded:
+            self.queue(key)
+            self.dispatch()
+        return self.loaded.get(key)
+
+    def load_many(self, keys: Iterable[str]) -> Dict[str, Optional[dict]]:
+        keys = list(keys)
+        self.queue(*keys)
+        self.dispatch()
+        return {key: self.loaded.get(key) for key in keys}
+
+
+class Hydrator:
+    def __init__(self):
+        self.users = BatchLoader("users", USER_PROJECTION, _shared_users)
+        self.products = BatchLoader("products", PRODUCT_PROJECTION, _shared_products)
+
+    def dispatch(self):
+        self.users.dispatch()
+        self.products.dispatch()
+
+    def hydrate_rooms(self, rooms: List[dict]) -> List[dict]:
+        """Refresh the embedded product/buyer/seller snapshots of chat rooms"""
+        for room in rooms:
+            self.users.queue(room.get("buyer_id"), room.get("seller_id"))
+            self.products.queue(room.get("product_id"))
+        self.dispatch()
+
+        for room in rooms:
+            product = self.products.get(room.get("product_id"))
+            if product:
+                room["product"] = product_snapshot(product)
+            for role in ("buyer", "seller"):
+                user = self.users.get(room.get(f"{role}_id"))
+                if user:
+                    room[role] = user_snapshot(user)
+        return rooms
+
+    def hydrate_owners(self, products: List[dict]) -> List[dict]:
+        """Refresh the name/avatar in each product's embedded user"""
+        for product in products:
+            self.users.queue((product.get("user") or {}).get("id"))
+        self.users.dispatch()
+
+        for product in products:
+            owner = product.get("user")
+            user = self.users.get((owner or {}).get("id"))
+            if owner and user:
+                owner["name"] = user.get("name", owner.get("name"))
+                owner["avatar"] = user.get("avatar", owner.get("avatar", ""))
+        return products
+
+
+def get_hydrator() -> Hydrator:
+    """FastAPI dependency: one Hydrator (and per-request cache) per request"""
+    return Hydrator()
+
+
+def user_snapshot(user: dict) -> dict:
+    return {
+        "id": user["id"],
+        "name": user.get("name", "User"),
+        "avatar": user.get("avatar", "")
+    }
+
+
+def product_snapshot(product: dict) -> dict:
+    return {
+        "id": product["id"],
+        "name": product["name"],
+        "images": product.get("images", [])
+    }
+
+
+def invalidate_user(user_id: str):
+    _shared_users.invalidate(user_id)
+
+
+def invalidate_product(product_id: str):
+    _shared_products.invalidate(product_id)
@@ -0,0 +1,201 @@
+"""Search products by photo with image embeddings.
+
+Every listing image is embedded with a local CLIP encoder
+(sentence-transformers `clip-ViT-B-32` by default) while the listing is
+ingested. The vectors are kept on the product as `image_embeddings`, and
+vector_sync writes them to a separate image index as `<product id>:<n>`. A
+photo search embeds the query image, asks the index for the nearest images,
+keeps the best score per product, and loads the products with one `$in`
+read.
+
+Products listed before image embeddings existed are filled in in batches:
+
+    python image_search.py backfill [--batch-size 64] [--download-workers 16]
+"""
+import io
+import mmap
+import os
+import threading
+from typing import Callable, List, Optional
+
+from PIL import Image
+
+import metrics
+
+IMAGE_MODEL_NAME = os.getenv("IMAGE_EMBEDDING_MODEL", "clip-ViT-B-32")
+IMAGE_INDEX_NAME = os.getenv("IMAGE_INDEX_NAME", "product-images")
+# Upper bound on images per product (bulk imports allow 10), used for deletes
+MAX_IMAGES_PER_PRODUCT = 10
+# Ask for more image matches than products wanted; several may share a product
+OVERFETCH = 3
+
+# These will be set in setup_search
+products_collection = None
+query_index: Optional[Callable[..., dict]] = None
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def setup_search(db, query):
+    """Wire photo search to the database and the image index query"""
+    global products_collection, query_index
+    products_collection = db["products"]
+    query_index = query
+
+
+def encoder():
+    """The CLIP model, loaded on first use"""
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                from sentence_transformers import SentenceTransformer
+                print(f"Loading image encoder {IMAGE_MODEL_NAME}...")
+                _encoder = SentenceTransformer(IMAGE_MODEL_NAME)
+    return _encoder
+
+
+def _image_file(contents):
+    """A file for PIL over `contents`: an mmap is read in place, bytes are wrapped without a copy"""
+    if isinstance(contents, mmap.mmap):
+        contents.seek(0)
+        return contents
+    return io.BytesIO(contents)
+
+
+def _open(contents) -> Image.Image:
+    image = Image.open(_image_file(contents))
+    return image.convert("RGB")
+
+
+def embed_images(images: List) -> List[List[float]]:
+    """Normalized embeddings for image contents (bytes or buffers), in one batch"""
+    if not images:
+        return []
+    opened = [_open(contents) for contents in images]
+    with metrics.span("clip", "encode"):
+        return encoder().encode(opened, batch_size=32, normalize_embeddings=True).tolist()
+
+
+def vector_records(product: dict) -> List[dict]:
+    """Image index records for a product's stored image embeddings"""
+    images = product.get("images") or []
+    return [
+        {
+            "id": f"{product['id']}:{n}",
+            "values": vector,
+            "metadata": {
+                "product_id": product["id"],
+                "image_index": n,
+                "image_url": images[n] if n < len(images) else ""
+            }
+        }
+        for n, vector in enumerate(product.get("image_embeddings") or [])
+        if vector
+    ]
+
+
+def vector_ids(product_id: str) -> List[str]:
+    """Every image index id a product can have"""
+    return [f"{product_id}:{n}" for n in range(MAX_IMAGES_PER_PRODUCT)]
+
+
+def search(contents, limit: int = 20, projection: Optional[dict] = None) -> List[dict]:
+    """Products whose photos look most like the query image, best first"""
+    vector = embed_images([contents])[0]
+    result = query_index(
+        vector=vector,
+        top_k=limit * OVERFETCH,
+        include_values=False,
+        include_metadata=True
+    )
+
+    scores = {}
+    for match in result.get("matches", []):
+        product_id = (match.get("metadata") or {}).get("product_id") or match["id"].rsplit(":", 1)[0]
+        scores[product_id] = max(scores.get(product_id, 0.0), match["score"])
+    ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+    if not ranked:
+        return []
+
+    products = {p["id"]: p for p in products_collection.find({"id": {"$in": ranked}}, projection)}
+    results = []
+    for product_id in ranked:
+        product = products.get(product_id)
+        if product is not None:
+            product["score"] = round(scores[product_id], 4)
+            results.append(product)
+    return results
+
+
+def backfill(db, batch_size: int = 64, download_workers: int = 16) -> dict:
+    """Embed the images of products that have none yet.
+
+    Safe to stop and re-run: finished products no longer match the query.
+    vector_sync picks each update up and writes the image index.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    import requests
+    from pymongo import UpdateOne
+
+    products = db["products"]
+    query = {"image_embeddings": {"$exists": False}, "images.0": {"$exists": True}}
+    totals = {"products": 0, "images": 0, "failed": 0}
+    session = requests.Session()
+
+    def download(url):
+        response = session.get(url, timeout=30)
+        response.raise_for_status()
+        return response.content
+
+    with ThreadPoolExecutor(download_workers) as pool:
+        while True:
+            batch = list(products.find(query, {"_id": 1, "id": 1, "images": 1}).limit(batch_size))
+            if not batch:
+                break
+
+            updates = []
+            for product in batch:
+                try:
+                    contents = list(pool.map(download, product["images"][:MAX_IMAGES_PER_PRODUCT]))
+                    embeddings = embed_images(contents)
+                    updates.append(UpdateOne({"_id": product["_id"]}, {"$set": {
+                        "image_embeddings": embeddings,
+                        "image_embedding_model": IMAGE_MODEL_NAME
+                    }}))
+                    totals["images"] += len(embeddings)
+                except Exception as e:
+                    print(f"Could not embed images of {product.get('id')}: {str(e)}")
+                    # Recorded so the product is not retried on every run
+                    updates.append(UpdateOne({"_id": product["_id"]}, {"$set": {
+                        "image_embeddings": [],
+                        "image_embedding_error": str(e)
+                    }}))
+                    totals["failed"] += 1
+
+            products.bulk_write(updates, ordered=False)
+            totals["products"] += len(batch)
+            print(f"Embedded images of {totals['products']} products "
+                  f"({totals['images']} images, {totals['failed']} failed)")
+    return totals
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from dotenv import load_dotenv
+
+    import mongo_config
+
+    parser = argparse.ArgumentParser(description="Image embeddings for product photo search")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = commands.add_parser("backfill")
+    backfill_parser.add_argument("--batch-size", type=int, default=64)
+    backfill_parser.add_argument("--download-workers", type=int, default=16)
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = mongo_config.connect()
+    print(backfill(mongo_config.database(client), args.batch_size, args.download_workers))
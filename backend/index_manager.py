@@ -0,0 +1,447 @@
+"""Declarative MongoDB index catalog.
+
+Every index the backend relies on is listed in INDEXES, keyed by collection.
+`apply_indexes` is idempotent: it creates what is missing, leaves matching
+indexes alone, and only drops indexes that are not in the catalog when asked
+to. It runs on startup from main.py and can be run on its own at deploy:
+
+    python index_manager.py apply [--prune]
+
+`python index_manager.py verify` seeds a scratch database on a local mongod,
+runs each endpoint's query shape (QUERY_SHAPES, the filters, sorts, limits
+and collations main.py and donation_service send) through explain() and exits
+non-zero if a catalog index could not be built, or if any shape falls back
+to a COLLSCAN or examines too many keys/documents. `apply` exits non-zero
+when an index could not be built or conflicts with an existing one.
+"""
+import os
+import random
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, IndexModel, MongoClient
+from pymongo.collation import Collation
+from pymongo.errors import OperationFailure
+
+# How long finished ingestion jobs stay queryable
+INGEST_JOB_TTL_SECONDS = int(os.getenv("INGEST_JOB_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Category filters match case-insensitively; queries on the category indexes
+# must pass this collation to use them
+CATEGORY_COLLATION = Collation("en", strength=2)
+
+INDEXES = {
+    "products": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("user.id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("created_at", DESCENDING)]),
+        IndexModel([("view_count", DESCENDING)]),
+        # Trending top-up per category
+        IndexModel([("categories", ASCENDING), ("view_count", DESCENDING)], collation=CATEGORY_COLLATION,
+                   name="categories_1_view_count_-1_ci"),
+        IndexModel([("price", ASCENDING)]),
+        # Named apart from the case-sensitive index it replaces (dropped by --prune)
+        IndexModel([("categories", ASCENDING), ("created_at", DESCENDING)], collation=CATEGORY_COLLATION,
+                   name="categories_1_created_at_-1_ci"),
+        IndexModel([("location", GEOSPHERE)]),
+    ],
+    "users": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    "chat_rooms": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("product_id", ASCENDING), ("buyer_id", ASCENDING), ("seller_id", ASCENDING)], unique=True),
+        IndexModel([("buyer_id", ASCENDING), ("updated_at", DESCENDING)]),
+        IndexModel([("seller_id", ASCENDING), ("updated_at", DESCENDING)]),
+    ],
+    "messages": [
+        IndexModel([("chat_room_id", ASCENDING), ("created_at", ASCENDING)]),
+    ],
+    "donated_products": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("is_available", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("categories", ASCENDING), ("is_available", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("donor.id", ASCENDING)]),
+        # Nearby feed: availability and category bounds inside the geo scan
+        # (2dsphere compound indexes also serve location-only queries)
+        IndexModel([("is_available", ASCENDING), ("categories", ASCENDING), ("location", GEOSPHERE)]),
+    ],
+    "ingestion_jobs": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING)]),
+        # Completed and failed jobs expire; running ones have no finished_at
+        IndexModel([("finished_at", ASCENDING)], expireAfterSeconds=INGEST_JOB_TTL_SECONDS),
+    ],
+    "import_jobs": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING), ("runner", ASCENDING)]),
+    ],
+    "reembed_runs": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    "sync_state": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    "vector_sync_dead_letters": [
+        IndexModel([("product_id", ASCENDING)], unique=True),
+    ],
+    "snapshot_sync_queue": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+        IndexModel([("retry_at", ASCENDING)]),
+    ],
+    "snapshot_sync_dead_letters": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+    ],
+    "media_assets": [
+        IndexModel([("sha256", ASCENDING), ("backend", ASCENDING)], unique=True),
+    ],
+    "product_views": [
+        IndexModel([("product_id", ASCENDING), ("timestamp", DESCENDING)]),
+        IndexModel([("timestamp", ASCENDING)]),
+    ],
+}
+
+
+def _key_of(spec):
+    # IndexModel documents hold a SON, index_information() a list of pairs
+    pairs = spec.items() if hasattr(spec, "items") else spec
+    return tuple((field, direction) for field, direction in pairs)
+
+
+def _identity_of(spec):
+    """Key pattern plus collation: the same keys under two collations are two indexes"""
+    collation = spec.get("collation")
+    if isinstance(collation, Collation):
+        collation = collation.document
+    collation = (collation["locale"], collation.get("strength", 3)) if collation else None
+    return _key_of(spec["key"]), collation
+
+
+def _options_of(spec):
+    return {"unique": bool(spec.get("unique", False)), "sparse": bool(spec.get("sparse", False)),
+            "expireAfterSeconds": spec.get("expireAfterSeconds")}
+
+
+def apply_indexes(db, prune=False, collections=None):
+    """Bring the indexes of `db` in line with INDEXES.
+
+    Returns a dict of collection -> {"created": [...], "dropped": [...],
+    "extra": [...], "conflicts": [...]}. Failures on one collection are
+    reported and do not stop the others.
+    """
+    report = {}
+    for name, models in INDEXES.items():
+        if collections and name not in collections:
+            continue
+
+        collection = db[name]
+        result = {"created": [], "dropped": [], "extra": [], "conflicts": []}
+        report[name] = result
+
+        try:
+            existing = collection.index_information()
+        except OperationFailure:
+            existing = {}
+        by_key = {_identity_of(info): (index_name, info) for index_name, info in existing.items()}
+
+        missing = []
+        wanted_keys = set()
+        for model in models:
+            document = model.document
+            key = _identity_of(document)
+            wanted_keys.add(key)
+
+            if key not in by_key:
+                missing.append(model)
+                continue
+
+            index_name, info = by_key[key]
+            if _options_of(info) != _options_of(document):
+                result["conflicts"].append(index_name)
+                print(f"Warning: index {name}.{index_name} exists with different options; leaving it in place")
+
+        # One at a time, so one bad index (e.g. duplicates under a new
+        # unique key) does not keep the others from being built
+        for model in missing:
+            try:
+                result["created"].extend(collection.create_indexes([model]))
+            except Exception as e:
+                index_name = model.document["name"]
+                result["conflicts"].append(index_name)
+                print(f"Error creating index {name}.{index_name}: {str(e)}")
+
+        for key, (index_name, _) in by_key.items():
+            if index_name == "_id_" or key in wanted_keys:
+                continue
+            result["extra"].append(index_name)
+            if prune:
+                try:
+                    collection.drop_index(index_name)
+                    result["dropped"].append(index_name)
+                except Exception as e:
+                    print(f"Error dropping index {name}.{index_name}: {str(e)}")
+
+    return report
+
+
+def missing_indexes(db):
+    """(collection, index name) for every catalog index `db` does not have"""
+    missing = []
+    for name, models in INDEXES.items():
+        try:
+            existing = {_identity_of(info) for info in db[name].index_information().values()}
+        except OperationFailure:
+            existing = set()
+        for model in models:
+            if _identity_of(model.document) not in existing:
+                missing.append((name, model.document["name"]))
+    return missing
+
+
+# Query shapes issued by the endpoints. Each entry is run through explain()
+# by `verify_query_plans`; `max_examined_ratio` bounds docs/keys examined per
+# document returned (with a small absolute slack for tiny result sets).
+USER_ID = "seed-user-0"
+PRODUCT_ID = "seed-product-0"
+ROOM_ID = "seed-room-0"
+POINT = [77.59, 12.97]
+CI = CATEGORY_COLLATION.document
+
+QUERY_SHAPES = [
+    {"name": "get_product", "collection": "products",
+     "filter": {"id": PRODUCT_ID}, "limit": 1},
+    {"name": "get_user_products", "collection": "products",
+     "filter": {"user.id": USER_ID}, "sort": [("created_at", -1)], "limit": 20},
+    {"name": "get_products_latest", "collection": "products",
+     "filter": {}, "sort": [("created_at", -1)], "limit": 1000},
+    {"name": "get_products_by_category", "collection": "products",
+     "filter": {"categories": "Books"}, "collation": CI,
+     "sort": [("created_at", -1)], "limit": 1000},
+    {"name": "recommended_latest_in_category", "collection": "products",
+     "filter": {"id": {"$ne": PRODUCT_ID}, "user.id": {"$ne": USER_ID},
+                "price": {"$gte": 80.0, "$lte": 120.0}, "categories": "Books"},
+     "collation": CI, "sort": [("created_at", -1)], "limit": 10, "max_examined_ratio": 10},
+    {"name": "recommended_price_band", "collection": "products",
+     "filter": {"price": {"$gte": 80.0, "$lte": 120.0}, "user.id": {"$ne": USER_ID},
+                "id": {"$ne": PRODUCT_ID}}, "limit": 10,
+     "max_examined_ratio": 4},
+    {"name": "recommended_nearby", "collection": "products",
+     "filter": {"location": {"$near": {"$geometry": {"type": "Point", "coordinates": POINT},
+                                         "$maxDistance": 10000}},
+                "user.id": {"$ne": USER_ID}, "id": {"$nin": [PRODUCT_ID]}}, "limit": 10,
+     "max_examined_ratio": 10},
+    {"name": "recommended_categories", "collection": "products",
+     "filter": {"categories": {"$in": ["books", "sports"]}, "user.id": {"$ne": USER_ID},
+                "id": {"$nin": [PRODUCT_ID]}}, "collation": CI, "limit": 10,
+     "max_examined_ratio": 4},
+    {"name": "trending_top_up", "collection": "products",
+     "filter": {"id": {"$nin": [PRODUCT_ID]}, "user.id": {"$ne": USER_ID}},
+     "sort": [("view_count", -1)], "limit": 10},
+    {"name": "trending_top_up_in_category", "collection": "products",
+     "filter": {"id": {"$nin": [PRODUCT_ID]}, "user.id": {"$ne": USER_ID}, "categories": "Books"},
+     "collation": CI, "sort": [("view_count", -1)], "limit": 10},
+    {"name": "get_nearby_products", "collection": "products",
+     "filter": {"location": {"$near": {"$geometry": {"type": "Point", "coordinates": POINT},
+                                         "$maxDistance": 50000}}}, "limit": 1000,
+     "max_examined_ratio": 10},
+    {"name": "get_user_profile", "collection": "users",
+     "filter": {"id": USER_ID}, "limit": 1},
+    {"name": "get_chat_room", "collection": "chat_rooms",
+     "filter": {"id": ROOM_ID}, "limit": 1},
+    {"name": "find_existing_chat_room", "collection": "chat_rooms",
+     "filter": {"product_id": PRODUCT_ID, "buyer_id": USER_ID, "seller_id": "seed-user-1"}, "limit": 1},
+    {"name": "get_chat_rooms", "collection": "chat_rooms",
+     "filter": {"$or": [{"buyer_id": USER_ID}, {"seller_id": USER_ID}]},
+     "sort": [("updated_at", -1)], "max_examined_ratio": 3},
+    {"name": "get_messages", "collection": "messages",
+     "filter": {"chat_room_id": ROOM_ID}, "sort": [("created_at", -1)], "limit": 50},
+    {"name": "count_unread", "collection": "messages", "count": True,
+     "filter": {"chat_room_id": ROOM_ID, "sender_id": {"$ne": USER_ID},
+                "created_at": {"$gt": datetime(2000, 1, 1)}},
+     "max_examined_ratio": 3},
+    {"name": "get_donations", "collection": "donated_products",
+     "filter": {"is_available": True}, "sort": [("created_at", -1)], "limit": 20},
+    {"name": "get_donations_by_category", "collection": "donated_products",
+     "filter": {"is_available": True, "categories": "books"}, "sort": [("created_at", -1)], "limit": 20},
+    {"name": "donation_feed_nearby", "collection": "donated_products",
+     "pipeline": [{"$geoNear": {"near": {"type": "Point", "coordinates": POINT}, "key": "location",
+                                "distanceField": "distance_m", "spherical": True,
+                                "query": {"is_available": True}, "minDistance": 0, "maxDistance": 25000}},
+                  {"$limit": 21}],
+     "max_examined_ratio": 10},
+    {"name": "donation_feed_nearby_by_category", "collection": "donated_products",
+     "pipeline": [{"$geoNear": {"near": {"type": "Point", "coordinates": POINT}, "key": "location",
+                                "distanceField": "distance_m", "spherical": True,
+                                "query": {"is_available": True, "categories": {"$in": ["books", "sports"]}},
+                                "minDistance": 0, "maxDistance": 25000}},
+                  {"$limit": 21}],
+     "max_examined_ratio": 10},
+    {"name": "get_donation", "collection": "donated_products",
+     "filter": {"id": "seed-donation-0"}, "limit": 1},
+    {"name": "product_views_recent", "collection": "product_views",
+     "filter": {"timestamp": {"$gte": datetime.utcnow() - timedelta(hours=1)}},
+     "max_examined_ratio": 2, "count": True},
+]
+
+DEFAULT_MAX_EXAMINED_RATIO = 2
+EXAMINED_SLACK = 5
+
+
+def _stages(plan):
+    """Yield every stage name in a (possibly nested) winning plan"""
+    if not isinstance(plan, dict):
+        return
+    if "stage" in plan:
+        yield plan["stage"]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _stages(child)
+
+
+def explain_shape(db, shape):
+    """Run a query shape through explain and return its plan summary"""
+    collection = shape["collection"]
+    if shape.get("pipeline"):
+        command = {"aggregate": collection, "pipeline": shape["pipeline"], "cursor": {}}
+    elif shape.get("count"):
+        command = {"count": collection, "query": shape["filter"]}
+    else:
+        command = {"find": collection, "filter": shape["filter"]}
+        if shape.get("sort"):
+            command["sort"] = dict(shape["sort"])
+        if shape.get("limit"):
+            command["limit"] = shape["limit"]
+    if shape.get("collation"):
+        command["collation"] = shape["collation"]
+
+    explained = db.command("explain", command, verbosity="executionStats")
+    if "queryPlanner" not in explained:
+        # Aggregations not pushed down whole explain their cursor stage
+        first = (explained.get("stages") or [{}])[0]
+        explained = first.get("$geoNearCursor") or first.get("$cursor") or {}
+    planner = explained.get("queryPlanner", {})
+    stats = explained.get("executionStats", {})
+    n_returned = stats.get("nReturned", 0)
+    if shape.get("count"):
+        # A count returns no documents; budget against the number it matched
+        n_returned = db[collection].count_documents(shape["filter"])
+    return {
+        "stages": list(_stages(planner.get("winningPlan", {}))),
+        "n_returned": n_returned,
+        "keys_examined": stats.get("totalKeysExamined", 0),
+        "docs_examined": stats.get("totalDocsExamined", 0),
+    }
+
+
+def verify_query_plans(db, shapes=QUERY_SHAPES):
+    """Return a list of (shape name, problem) for every failing query shape"""
+    failures = []
+    for shape in shapes:
+        try:
+            summary = explain_shape(db, shape)
+        except Exception as e:
+            failures.append((shape["name"], f"explain failed: {str(e)}"))
+            continue
+
+        if "COLLSCAN" in summary["stages"]:
+            failures.append((shape["name"], f"COLLSCAN in plan {summary['stages']}"))
+            continue
+
+        ratio = shape.get("max_examined_ratio", DEFAULT_MAX_EXAMINED_RATIO)
+        budget = max(summary["n_returned"], 1) * ratio + EXAMINED_SLACK
+        for field in ("keys_examined", "docs_examined"):
+            if summary[field] > budget:
+                failures.append((shape["name"], f"{field}={summary[field]} exceeds {budget} "
+                                                f"for {summary['n_returned']} returned"))
+    return failures
+
+
+def seed(db, products=2000, users=200):
+    """Fill a scratch database with synthetic documents shaped like production"""
+    rng = random.Random(42)
+    categories = ["electronics", "furniture", "clothing", "books", "automobile", "sports", "other"]
+    now = datetime.utcnow()
+
+    def point():
+        return {"type": "Point", "coordinates": [POINT[0] + rng.uniform(-2, 2), POINT[1] + rng.uniform(-2, 2)]}
+
+    db["users"].insert_many([
+        {"id": f"seed-user-{i}", "name": f"User {i}", "email": f"user{i}@example.com", "avatar": "",
+         "statistics": {"items_listed": 0, "total_trades": 0, "successful_trades": 0}}
+        for i in range(users)
+    ])
+    db["products"].insert_many([
+        {"id": f"seed-product-{i}", "name": f"Product {i}", "description": "seeded",
+         "price": float(rng.randint(1, 2000)), "categories": [rng.choice(categories)],
+         "images": [], "image_details": [], "view_count": rng.randint(0, 500),
+         "created_at": now - timedelta(minutes=i), "updated_at": now,
+         "user": {"id": f"seed-user-{i % users}", "name": f"User {i % users}", "avatar": ""},
+         "location": point()}
+        for i in range(products)
+    ])
+    db["chat_rooms"].insert_many([
+        {"id": f"seed-room-{i}", "product_id": f"seed-product-{i}",
+         "buyer_id": f"seed-user-{i % users}", "seller_id": f"seed-user-{(i + 1) % users}",
+         "created_at": now, "updated_at": now - timedelta(minutes=i)}
+        for i in range(products // 2)
+    ])
+    db["messages"].insert_many([
+        {"id": str(uuid.uuid4()), "chat_room_id": f"seed-room-{i % (products // 2)}",
+         "sender_id": f"seed-user-{i % users}", "message": "hi", "is_read": False,
+         "created_at": now - timedelta(seconds=i)}
+        for i in range(products * 2)
+    ])
+    db["donated_products"].insert_many([
+        {"id": f"seed-donation-{i}", "name": f"Donation {i}", "categories": [rng.choice(categories)],
+         "is_available": rng.random() < 0.7, "created_at": now - timedelta(minutes=i),
+         "donor": {"id": f"seed-user-{i % users}"}, "location": point()}
+        for i in range(products)
+    ])
+    db["product_views"].insert_many([
+        {"product_id": f"seed-product-{rng.randrange(products)}", "user_id": None,
+         "timestamp": now - timedelta(minutes=rng.randint(0, 60 * 24 * 7))}
+        for _ in range(products * 5)
+    ])
+
+
+def _verify(uri):
+    client = MongoClient(uri)
+    db_name = f"index_check_{uuid.uuid4().hex[:8]}"
+    db = client[db_name]
+    try:
+        seed(db)
+        apply_indexes(db)
+        missing = missing_indexes(db)
+        failures = verify_query_plans(db)
+    finally:
+        client.drop_database(db_name)
+
+    for collection, index_name in missing:
+        print(f"FAIL {collection}.{index_name}: index missing after apply")
+    for name, problem in failures:
+        print(f"FAIL {name}: {problem}")
+    print(f"{len(QUERY_SHAPES) - len({n for n, _ in failures})}/{len(QUERY_SHAPES)} query shapes use an index")
+    return 1 if failures or missing else 0
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    command = sys.argv[1] if len(sys.argv) > 1 else "apply"
+
+    if command == "apply":
+        client = mongo_config.connect()
+        report = apply_indexes(mongo_config.database(client), prune="--prune" in sys.argv)
+        for name, result in report.items():
+            print(f"{name}: created={result['created']} dropped={result['dropped']} "
+                  f"extra={result['extra']} conflicts={result['conflicts']}")
+        sys.exit(1 if any(result["conflicts"] for result in report.values()) else 0)
+    elif command == "verify":
+        sys.exit(_verify(os.getenv("INDEX_CHECK_MONGODB_URI", "mongodb://localhost:27017")))
+    else:
+        print("usage: python index_manager.py [apply [--prune] | verify]")
+        sys.exit(2)
@@ -0,0 +1,460 @@
+"""Asynchronous ingestion pipeline for new product listings.
+
+`/upload_product` only validates the form, writes the raw image files to the
+spool directory, records a job in `ingestion_jobs` and returns 202 with the
+job id. Job workers then run each listing through the stages
+
+    storage + classification  (per image, in parallel)
+    embedding                 (all images of the listing in one batch)
+    indexing                  (the products insert)
+
+The product's vectors are written by vector_sync once the insert shows up on
+the change stream. Each stage has its own semaphore, so a slow HF API only backs
+up its own stage. Storage goes through media_uploader, whose process-wide cap
+and retries are shared with donation uploads. When an upload still fails
+with a transient error (a media backend outage), or the classifier times
+out (TransientStageError; other classifier errors only lose the labels),
+the job goes back to
+"queued" with its spool files kept and runs again after an exponential
+backoff, up to INGEST_JOB_MAX_ATTEMPTS runs; stored images are keyed by
+content hash, so a rerun does not duplicate them. Any other failure, or the
+last attempt, marks the job "failed". Blocking client calls run in threads.
+Jobs that were queued or running when the process stopped are picked up
+again on startup because their files and listing data are persisted.
+"""
+import asyncio
+import os
+import shutil
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import user_stats
+from semantic_search import geo_cells, normalize_categories
+from response_cache import response_cache
+from upload_spool import SpooledUpload
+
+SPOOL_DIR = os.getenv(
+    "UPLOAD_SPOOL_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads", "ingest")
+)
+JOB_WORKERS = int(os.getenv("INGEST_JOB_WORKERS", "8"))
+STAGE_CONCURRENCY = {
+    "classification": int(os.getenv("INGEST_CLASSIFICATION_CONCURRENCY", "4")),
+    "embedding": int(os.getenv("INGEST_EMBEDDING_CONCURRENCY", "2")),
+    "indexing": int(os.getenv("INGEST_INDEXING_CONCURRENCY", "4")),
+}
+JOB_MAX_ATTEMPTS = int(os.getenv("INGEST_JOB_MAX_ATTEMPTS", "6"))
+RETRY_BASE_DELAY = float(os.getenv("INGEST_RETRY_BASE_DELAY", "30"))
+RETRY_MAX_DELAY = float(os.getenv("INGEST_RETRY_MAX_DELAY", "900"))
+STAGES = ["storage", "classification", "embedding", "indexing"]
+IMAGE_STAGES = ("storage", "classification", "embedding")
+
+# These will be set in setup_pipeline
+jobs_collection = None
+store_image: Optional[Callable[[SpooledUpload], Awaitable[dict]]] = None
+classify_image: Optional[Callable[..., List[str]]] = None
+embed_images: Optional[Callable[[list], List[List[float]]]] = None
+
+_queue: Optional[asyncio.Queue] = None
+_workers: List[asyncio.Task] = []
+_semaphores = {}
+_retries: Dict[str, asyncio.TimerHandle] = {}
+
+
+class TransientStageError(Exception):
+    """A stage failure that a later run of the job can get past (a timeout)"""
+    transient = True
+
+
+def setup_pipeline(db, store, classify, embed=None):
+    """Wire the pipeline to the database and the external-service hooks"""
+    global jobs_collection, store_image, classify_image, embed_images
+    jobs_collection = db["ingestion_jobs"]
+    store_image = store
+    classify_image = classify
+    embed_images = embed
+
+
+def parse_location(latitude: Optional[str], longitude: Optional[str]):
+    if not (latitude and longitude):
+        return None
+    try:
+        return {
+            "type": "Point",
+            "coordinates": [float(longitude), float(latitude)]  # GeoJSON format is [longitude, latitude]
+        }
+    except ValueError:
+        return None
+
+
+def parse_price(price: str) -> float:
+    try:
+        return float(price)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def embedding_text(name: str, description: str, categories: List[str]) -> str:
+    return f"{name} {description} {' '.join(categories)}"
+
+
+def vector_metadata(listing: dict, product_id: str, image_urls: List[str],
+                    image_categories: List[str]) -> dict:
+    """Index metadata; `price` and `geo_cells` are there for search filters"""
+    metadata = {
+        "productName": listing["productName"],
+        "productDescription": listing["productDescription"],
+        "productPrice": listing["productPrice"],
+        "price": parse_price(listing["productPrice"]),
+        "categories": normalize_categories(listing["categories"]),
+        "image_categories": image_categories,
+        "product_id": product_id,
+        "image_urls": image_urls
+    }
+    location = parse_location(listing.get("latitude"), listing.get("longitude"))
+    if location:
+        lng, lat = location["coordinates"]
+        metadata["geo_cells"] = geo_cells(lat, lng)
+    return metadata
+
+
+def listing_from_product(product: dict) -> dict:
+    """The listing fields used for embedding, rebuilt from a product document"""
+    price = product.get("price") or 0
+    coordinates = (product.get("location") or {}).get("coordinates") or [None, None]
+    return {
+        "productName": product.get("name", ""),
+        "productDescription": product.get("description", ""),
+        "productPrice": str(int(price) if float(price).is_integer() else price),
+        "categories": product.get("categories") or [],
+        "latitude": None if coordinates[1] is None else str(coordinates[1]),
+        "longitude": None if coordinates[0] is None else str(coordinates[0])
+    }
+
+
+def build_product_document(listing: dict, product_id: str, image_details: List[dict],
+                           image_categories: List[str],
+                           image_embeddings: Optional[List[List[float]]] = None) -> dict:
+    """The `products` document for a listing once its images are stored"""
+    now = datetime.utcnow()
+    product = {
+        "id": product_id,
+        "name": listing["productName"],
+        "description": listing["productDescription"],
+        "price": parse_price(listing["productPrice"]),
+        "categories": listing["categories"],
+        "images": [d["url"] for d in image_details],
+        "image_details": image_details,
+        "created_at": now,
+        "updated_at": now,
+        "user": {
+            "id": listing.get("userId"),
+            "email": listing.get("userEmail"),
+            "name": listing.get("userName"),
+            "avatar": listing.get("userAvatar", "")
+        },
+        "location": parse_location(listing.get("latitude"), listing.get("longitude")),
+        "address": listing.get("address"),
+        "image_categories": image_categories
+    }
+    if image_embeddings is not None:
+        product["image_embeddings"] = image_embeddings
+    return product
+
+
+async def submit(listing: dict, uploads: List[SpooledUpload]) -> dict:
+    """Persist a listing and its spooled images and queue it for ingestion.
+
+    The spool files are moved (not copied) into the job's directory.
+    Returns the job document.
+    """
+    job_id = str(uuid.uuid4())
+    product_id = str(uuid.uuid4())
+    job_dir = os.path.join(SPOOL_DIR, job_id)
+
+    paths = []
+    hashes = []
+    for i, upload in enumerate(uploads):
+        upload.move_to(os.path.join(job_dir, f"{i + 1}.{upload.kind}"))
+        paths.append(upload.path)
+        hashes.append(upload.sha256)
+
+    now = datetime.utcnow()
+    job = {
+        "id": job_id,
+        "product_id": product_id,
+        "status": "queued",
+        "stage": None,
+        "stages": _pending_stages(len(paths)),
+        "listing": listing,
+        "files": paths,
+        "file_hashes": hashes,
+        "error": None,
+        "created_at": now,
+        "updated_at": now
+    }
+    await asyncio.to_thread(jobs_collection.insert_one, job)
+    job.pop("_id", None)
+
+    _enqueue(job_id)
+    return job
+
+
+def _pending_stages(images: int) -> dict:
+    return {
+        stage: {"status": "pending", "done": 0, "total": images if stage in IMAGE_STAGES else 1}
+        for stage in STAGES
+    }
+
+
+def retry_delay(attempt: int) -> float:
+    """Seconds before run `attempt + 1` of a job whose run `attempt` failed"""
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+
+
+async def _settle(*aws):
+    """Like gather, but the first error is raised only once every awaitable
+    has finished, so nothing keeps using the job's files after it fails"""
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    job = jobs_collection.find_one({"id": job_id}, {"_id": 0, "listing": 0, "files": 0, "file_hashes": 0})
+    if job:
+        job["progress"] = _progress(job["stages"])
+    return job
+
+
+def _progress(stages: dict) -> float:
+    done = sum(min(s["done"], s["total"]) / s["total"] for s in stages.values() if s["total"])
+    total = sum(1 for s in stages.values() if s["total"])
+    return round(done / total, 3) if total else 1.0
+
+
+async def _update(job_id: str, fields: dict):
+    fields["updated_at"] = datetime.utcnow()
+    await asyncio.to_thread(jobs_collection.update_one, {"id": job_id}, {"$set": fields})
+
+
+async def _stage(job_id: str, stage: str, **fields):
+    await _update(job_id, {f"stages.{stage}.{k}": v for k, v in fields.items()})
+
+
+async def _run_stage(name: str, fn, *args):
+    async with _semaphores[name]:
+        return await asyncio.to_thread(fn, *args)
+
+
+async def _process_image(job_id: str, path: str, digest: Optional[str], counters: dict):
+    # Each stage maps the file itself, so the two threads never share a
+    # file position and nothing is copied into Python bytes
+    upload = SpooledUpload(path, os.path.basename(path), os.path.getsize(path), digest, "")
+
+    def classify():
+        with upload.view() as contents:
+            return classify_image(contents, digest)
+
+    async def storage():
+        result = await store_image(upload)
+        counters["storage"] += 1
+        await _stage(job_id, "storage", done=counters["storage"])
+        return result
+
+    async def classification():
+        try:
+            labels = await _run_stage("classification", classify)
+        except TransientStageError:
+            # Requeues the job (see process)
+            raise
+        except Exception as e:
+            # Classification is best effort, as it was before the pipeline
+            print(f"Error processing image: {str(e)}")
+            labels = []
+        counters["classification"] += 1
+        await _stage(job_id, "classification", done=counters["classification"])
+        return labels
+
+    return await _settle(storage(), classification())
+
+
+async def _embed_images(job_id: str, paths: List[str]) -> Optional[List[List[float]]]:
+    """Image vectors for photo search, one batch per listing (best effort)"""
+    if embed_images is None:
+        return None
+
+    def embed():
+        with ExitStack() as stack:
+            views = [
+                stack.enter_context(SpooledUpload(path, os.path.basename(path), os.path.getsize(path), None, "").view())
+                for path in paths
+            ]
+            return embed_images(views)
+
+    await _stage(job_id, "embedding", status="running")
+    try:
+        embeddings = await _run_stage("embedding", embed)
+    except Exception as e:
+        print(f"Error embedding images: {str(e)}")
+        embeddings = None
+    await _stage(job_id, "embedding", status="completed", done=len(paths))
+    return embeddings
+
+
+async def process(job: dict):
+    job_id = job["id"]
+    product_id = job["product_id"]
+    listing = job["listing"]
+    attempt = job.get("attempts", 0) + 1
+    # Set once the job has reached a final status; its spool files are then removed
+    finished = False
+
+    try:
+        await _update(job_id, {"status": "running", "stage": "storage", "attempts": attempt})
+        await _stage(job_id, "storage", status="running")
+        await _stage(job_id, "classification", status="running")
+
+        counters = {"storage": 0, "classification": 0}
+        hashes = job.get("file_hashes") or [None] * len(job["files"])
+        results, image_embeddings = await _settle(
+            _settle(*[
+                _process_image(job_id, path, digest, counters)
+                for path, digest in zip(job["files"], hashes)
+            ]),
+            _embed_images(job_id, job["files"])
+        )
+        image_details = [details for details, _ in results]
+        image_categories = [label for _, labels in results for label in labels]
+        image_urls = [d["url"] for d in image_details]
+        await _stage(job_id, "storage", status="completed")
+        await _stage(job_id, "classification", status="completed")
+
+        await _update(job_id, {"stage": "indexing"})
+        await _stage(job_id, "indexing", status="running")
+        product = build_product_document(listing, product_id, image_details, image_categories,
+                                         image_embeddings)
+        # A resumed job may already have inserted the product
+        exists = await asyncio.to_thread(product_collection_has, product_id)
+        if not exists:
+            await _run_stage("indexing", user_stats.insert_product, product)
+        await _stage(job_id, "indexing", status="completed", done=1)
+
+        # New listing shows up in product lists and the seller's item count
+        response_cache.invalidate("products", f"user:{listing.get('userId')}")
+
+        await _update(job_id, {"status": "completed", "stage": None, "images": image_urls,
+                               "error": None, "retry_at": None, "finished_at": datetime.utcnow()})
+        finished = True
+    except Exception as e:
+        # MediaUploadError and TransientStageError mark failures a rerun can get past
+        if getattr(e, "transient", False) and attempt < JOB_MAX_ATTEMPTS:
+            delay = retry_delay(attempt)
+            print(f"Ingestion job {job_id} attempt {attempt} failed ({str(e)}); retrying in {delay:.0f}s")
+            await _update(job_id, {
+                "status": "queued", "stage": None, "error": str(e),
+                "stages": _pending_stages(len(job["files"])),
+                "retry_at": datetime.utcnow() + timedelta(seconds=delay)
+            })
+            _schedule(job_id, delay)
+            return
+        print(f"Ingestion job {job_id} failed: {str(e)}")
+        await _update(job_id, {"status": "failed", "error": str(e), "finished_at": datetime.utcnow()})
+        finished = True
+    finally:
+        if finished:
+            await asyncio.to_thread(shutil.rmtree, os.path.join(SPOOL_DIR, job_id), True)
+
+
+async def _worker():
+    while True:
+        job_id = await _queue.get()
+        try:
+            job = await asyncio.to_thread(jobs_collection.find_one, {"id": job_id}, {"_id": 0})
+            if job and job["status"] in ("queued", "running"):
+                await process(job)
+        except Exception as e:
+            print(f"Ingestion worker error on job {job_id}: {str(e)}")
+        finally:
+            _queue.task_done()
+
+
+def _enqueue(job_id: str):
+    if _queue is None:
+        raise RuntimeError("Ingestion pipeline has not been started")
+    _queue.put_nowait(job_id)
+
+
+def _schedule(job_id: str, delay: float):
+    """Queue a job again after `delay` seconds"""
+    def requeue():
+        _retries.pop(job_id, None)
+        if _queue is not None:
+            _queue.put_nowait(job_id)
+
+    _retries[job_id] = asyncio.get_running_loop().call_later(max(delay, 0), requeue)
+
+
+def product_collection_has(product_id: str) -> bool:
+    return user_stats.products_collection.find_one({"id": product_id}, {"_id": 1}) is not None
+
+
+async def start():
+    """Start job workers and resume unfinished jobs (called on app startup)"""
+    global _queue
+    if _queue is not None:
+        return
+    _queue = asyncio.Queue()
+    for stage, limit in STAGE_CONCURRENCY.items():
+        _semaphores[stage] = asyncio.Semaphore(limit)
+    for _ in range(JOB_WORKERS):
+        _workers.append(asyncio.create_task(_worker()))
+
+    try:
+        unfinished = await asyncio.to_thread(
+            lambda: list(jobs_collection.find({"status": {"$in": ["queued", "running"]}}, {"id": 1, "retry_at": 1}))
+        )
+        now = datetime.utcnow()
+        for job in unfinished:
+            retry_at = job.get("retry_at")
+            if retry_at and retry_at > now:
+                _schedule(job["id"], (retry_at - now).total_seconds())
+            else:
+                _queue.put_nowait(job["id"])
+        if unfinished:
+            print(f"Resuming {len(unfinished)} ingestion jobs")
+        await asyncio.to_thread(_sweep_spool, {job["id"] for job in unfinished})
+    except Exception as e:
+        print(f"Warning: Could not resume ingestion jobs: {str(e)}")
+
+
+def _sweep_spool(unfinished: set):
+    """Remove spool directories left behind by jobs that are no longer running.
+
+    Files are spooled before their job is inserted, so only directories
+    older than an hour are considered (another process may be mid-submit).
+    """
+    if not os.path.isdir(SPOOL_DIR):
+        return
+    cutoff = time.time() - 3600
+    for name in os.listdir(SPOOL_DIR):
+        path = os.path.join(SPOOL_DIR, name)
+        if name not in unfinished and os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, True)
+
+
+async def stop():
+    global _queue
+    for handle in _retries.values():
+        handle.cancel()
+    _retries.clear()
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _queue = None
@@ -0,0 +1,182 @@
+"""Event-loop lag monitor and blocking-call detector.
+
+A ticker task sleeps for INTERVAL and measures how late it wakes up. That
+delay is the event-loop lag, exported as `event_loop_lag_seconds` on
+/metrics.
+
+A watchdog thread checks the ticker. If the ticker is overdue by more than
+LOOP_BLOCK_THRESHOLD_MS, something is running on the loop without yielding:
+sync I/O or model inference inside an `async def`. The watchdog then
+captures the loop thread's stack. It reads the ASGI scope from the stack to
+attribute the stall to the route being served; background work shows up as
+"background". When the loop wakes, the stall's duration is filled in and
+recorded in a ring buffer. `GET /admin/event_loop` shows the buffer, and
+`event_loop_blocked_seconds{route}` is exported on /metrics.
+
+Debug mode: with LOOP_MONITOR_FAIL_MS set, every stall at least that long is
+a violation, and `stop()` (run on app shutdown) raises `BlockingCallError`
+listing them. Tests that run the app under a TestClient context therefore
+fail on any blocking call longer than N ms.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from typing import List, Optional
+
+import metrics
+
+INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL_MS", "100")) / 1000
+BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "100")) / 1000
+FAIL_THRESHOLD = float(os.getenv("LOOP_MONITOR_FAIL_MS", "0")) / 1000 or None
+BUFFER_SIZE = int(os.getenv("LOOP_MONITOR_BUFFER", "100"))
+STACK_FRAMES = 40
+
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+loop_lag = metrics.registry.register(metrics.Histogram(
+    "event_loop_lag_seconds", "How late the event loop ran a timer", buckets=LAG_BUCKETS
+))
+loop_blocked = metrics.registry.register(metrics.Histogram(
+    "event_loop_blocked_seconds", "Event-loop stalls over the threshold, by route", ["route"], buckets=LAG_BUCKETS
+))
+
+
+class BlockingCallError(AssertionError):
+    pass
+
+
+def request_for_stack(frame) -> dict:
+    """Method, path and route template of the request whose code is on the stack"""
+    while frame is not None:
+        try:
+            scope = frame.f_locals.get("scope")
+        except Exception:
+            scope = None
+        if isinstance(scope, dict) and scope.get("type") == "http":
+            route = scope.get("route")
+            return {"method": scope.get("method"), "path": scope.get("path"),
+                    "route": getattr(route, "path", None) or scope.get("path")}
+        frame = frame.f_back
+    return {"method": None, "path": None, "route": "background"}
+
+
+class LoopMonitor:
+    def __init__(self, interval: float = INTERVAL, threshold: float = BLOCK_THRESHOLD,
+                 fail_threshold: Optional[float] = FAIL_THRESHOLD, buffer_size: int = BUFFER_SIZE):
+        self.interval = interval
+        self.threshold = threshold
+        self.fail_threshold = fail_threshold
+        self.stalls = deque(maxlen=buffer_size)
+        self.violations: List[dict] = []
+        self.stats = {"ticks": 0, "stalls": 0, "max_lag_ms": 0.0, "last_lag_ms": 0.0}
+        self.lock = threading.Lock()
+        self._tick = 0
+        self._expected_at = None
+        self._pending = None
+        self._loop_thread = None
+        self._task = None
+        self._watchdog = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start on the running loop (called on app startup)"""
+        if self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._ticker())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._watchdog.join()
+        self.raise_for_violations()
+
+    def raise_for_violations(self):
+        if not self.violations:
+            return
+        violations, self.violations = self.violations, []
+        details = "\n\n".join(
+            f"{v['duration_ms']} ms in {v['route']}:\n" + "".join(v["stack"][-8:]) for v in violations
+        )
+        raise BlockingCallError(
+            f"{len(violations)} event-loop stalls over {self.fail_threshold * 1000:.0f} ms\n\n{details}"
+        )
+
+    async def _ticker(self):
+        while True:
+            with self.lock:
+                self._tick += 1
+                self._expected_at = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - self._expected_at, 0.0)
+            loop_lag.observe(lag)
+            with self.lock:
+                self.stats["ticks"] += 1
+                self.stats["last_lag_ms"] = round(lag * 1000, 2)
+                self.stats["max_lag_ms"] = max(self.stats["max_lag_ms"], self.stats["last_lag_ms"])
+                stall, self._pending = self._pending, None
+            if lag >= self.threshold:
+                self._record(stall or {"route": "unknown", "method": None, "path": None, "stack": []}, lag)
+
+    def _record(self, stall: dict, lag: float):
+        stall["duration_ms"] = round(lag * 1000, 2)
+        loop_blocked.observe(lag, stall["route"])
+        with self.lock:
+            self.stats["stalls"] += 1
+            self.stalls.append(stall)
+            if self.fail_threshold is not None and lag >= self.fail_threshold:
+                self.violations.append(stall)
+        print(f"Event loop blocked for {stall['duration_ms']} ms in {stall['route']}")
+
+    def _watch(self):
+        poll = max(min(self.threshold, self.interval) / 4, 0.005)
+        captured = None
+        while not self._stop.wait(poll):
+            with self.lock:
+                tick, expected_at = self._tick, self._expected_at
+            if expected_at is None or tick == captured:
+                continue
+            if time.monotonic() - expected_at < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stall = dict(
+                request_for_stack(frame),
+                at=datetime.utcnow().isoformat() + "Z",
+                stack=traceback.format_stack(frame)[-STACK_FRAMES:]
+            )
+            del frame
+            captured = tick
+            with self.lock:
+                # The loop may have woken up meanwhile; only a still-current tick counts
+                if self._tick == tick:
+                    self._pending = stall
+
+    def report(self, limit: int = 20) -> dict:
+        with self.lock:
+            stalls = list(self.stalls)[-limit:]
+            return dict(
+                self.stats,
+                interval_ms=self.interval * 1000,
+                threshold_ms=self.threshold * 1000,
+                fail_threshold_ms=self.fail_threshold * 1000 if self.fail_threshold else None,
+                running=self._task is not None,
+                violations=len(self.violations),
+                recent_stalls=list(reversed(stalls))
+            )
+
+
+loop_monitor = LoopMonitor()
@@ -3,6 +3,7 @@ from fastapi import FastAPI, Request, HTTPException, File, UploadFile, Form
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from sentence_transformers import SentenceTransformer
+from transformers import ViTImageProcessor, ViTForImageClassification
 from typing import Dict
 from pinecone import Pinecone
 from dotenv import load_dotenv
@@ -11,7 +12,8 @@ import requests
 import shutil
 from PIL import Image
 import io
-from pymongo import MongoClient, GEOSPHERE
+import hashlib
+from pymongo import GEOSPHERE
 from datetime import datetime
 import json
 from typing import Optional, List
@@ -27,7 +29,29 @@ from pydantic import BaseModel
 from fastapi import Body, Depends
 from pydantic import BaseModel, Field, EmailStr
 import donation_service
-from fastapi.responses import StreamingResponse
+import hydration
+import bulk_import
+import ingestion
+import media_store
+import media_uploader
+from loop_monitor import loop_monitor
+import metrics
+import mongo_config
+import mongo_monitor
+from upload_spool import SpooledUpload, UploadSizeLimitMiddleware, spool_upload
+import index_manager
+from category_predictor import CategoryPredictor
+from classification_cache import classification_cache
+import image_search
+import semantic_search
+import snapshot_sync
+from bson_response import BSONResponse, PRODUCT_LIST_PROJECTION
+from response_cache import response_cache
+from hydration import Hydrator, get_hydrator
+import trending_service
+import user_stats
+import vector_sync
+from fastapi.responses import Response, StreamingResponse
 import asyncio
 import json
 
@@ -37,10 +61,17 @@ load_dotenv()
 API_KEY = os.getenv("API_KEY")
 API_URL = os.getenv("API_URL")
 HF_API = os.getenv("HF_API")
+# /admin endpoints and bulk imports require it in the X-Admin-Token header;
+# they answer 403 while it is unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
-MONGODB_URI = os.getenv("MONGODB_URI")
-mongo_client = MongoClient(MONGODB_URI)
-db = mongo_client['Cluster0']  # database name
+mongo_client = mongo_config.connect(
+    # Times every command as a `mongo` span and keeps the slow-query log
+    event_listeners=[mongo_monitor.query_monitor]
+)
+# Slow queries are explained in the background with the same client
+mongo_monitor.query_monitor.attach(mongo_client)
+db = mongo_config.database(mongo_client)
 
 products_collection = db["products"]
 users_collection = db["users"]
@@ -49,16 +80,8 @@ users_collection = db["users"]
 chat_rooms_collection = db["chat_rooms"]
 messages_collection = db["messages"]
 
-users_collection.create_index([("id", 1)], unique=True)
-
-# Create indexes for chat collections
-chat_rooms_collection.create_index([("product_id", 1), ("buyer_id", 1), ("seller_id", 1)], unique=True)
-messages_collection.create_index([("chat_room_id", 1), ("created_at", 1)])
-chat_rooms_collection.create_index([("buyer_id", 1)])
-chat_rooms_collection.create_index([("seller_id", 1)])
-
-
-products_collection.create_index([("location", GEOSPHERE)])
+# Create any indexes from the catalog that are missing (idempotent)
+index_manager.apply_indexes(db)
 
 sse_connections = {}
 
@@ -101,9 +124,19 @@ pc = Pinecone(api_key=API_KEY)
 
 index_name = "products-test"
 index = pc.Index(index_name)
+# CLIP image vectors have a different dimension, so they get their own index
+image_index = pc.Index(image_search.IMAGE_INDEX_NAME)
+metrics.instrument(index, "pinecone", "query", "upsert", "delete")
+metrics.instrument(image_index, "pinecone_images", "query", "upsert", "delete")
 
 app = FastAPI()
 
+# Reject oversized multipart bodies before they are parsed
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    path_limits={"/products/import": bulk_import.MAX_SOURCE_BYTES}
+)
+
 # CORS middleware configuration
 app.add_middleware(
     CORSMiddleware,
@@ -112,6 +145,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so request timing covers every other middleware
+app.add_middleware(metrics.MetricsMiddleware)
+
 # Import donation_service after initializing the app and database
 import donation_service
 
@@ -121,7 +157,48 @@ donation_service.setup_collection(db)
 # Include the donation_service router in your app
 app.include_router(donation_service.router)
 
+# Warm the trending engine from recent product views
+trending_service.setup_collection(db)
+
+# Product create/delete paths keep user statistics up to date
+user_stats.setup_collection(mongo_client, db)
+
+# Batched user/product lookups for embedded snapshots
+hydration.setup_collection(db)
+
+# Content-addressed media store (dedup registry and /media routes)
+media_store.setup_collection(db)
+app.include_router(media_store.router)
+
+# Background rewrite of embedded snapshots when users change (durable queue)
+snapshot_sync.setup_collection(db)
+
+
+@app.on_event("startup")
+async def start_background_workers():
+    loop_monitor.start()
+    snapshot_sync.start()
+    trending_service.start()
+    await ingestion.start()
+    await bulk_import.start()
+    vector_sync.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    await bulk_import.stop()
+    await ingestion.stop()
+    await snapshot_sync.stop()
+    await trending_service.stop()
+    await vector_sync.stop()
+    # Last: in debug mode (LOOP_MONITOR_FAIL_MS) this raises on blocking calls
+    await loop_monitor.stop()
+
 model = SentenceTransformer('all-MiniLM-L6-v2')
+metrics.instrument(model, "minilm", "encode")
+
+# Category prototypes are embedded once with the same model
+category_predictor = CategoryPredictor(model)
 
 class ProdutData(BaseModel):
     productName: str
@@ -172,7 +249,7 @@ async def insert(data: ProdutData):
 
 
 # Add this endpoint to your main.py
-@app.post("/upload_product")
+@app.post("/upload_product", status_code=202)
 async def upload_product(
     file1: UploadFile = File(...),
     file2: UploadFile = File(None),
@@ -191,14 +268,14 @@ async def upload_product(
     longitude: str = Form(None),
     address: str = Form(None)
 ):
+    """Accept a listing and queue it for ingestion.
+
+    Storage, classification and the products insert run in the ingestion
+    pipeline and the vector is written by vector_sync; poll `status_url`
+    for progress until the job is "completed" or "failed". A job that is
+    "queued" again with a `retry_at` is waiting out a media backend outage.
+    """
     try:
-        # Generate a unique ID for this product
-        product_id = str(uuid.uuid4())
-        
-        # Process all files
-        image_categories = []
-        image_urls = []
-        image_details = []
         files = [file1]
         
         if file2 and file2.filename:
@@ -206,31 +283,17 @@ async def upload_product(
         
         if file3 and file3.filename:
             files.append(file3)
-            
-        for i, file in enumerate(files):
-            if file and file.filename:
-                # Upload to Cloudinary
-                cloudinary_result = await upload_to_cloudinary(file, product_id, i+1)
-                image_url = cloudinary_result["url"]
-                image_urls.append(image_url)
-                image_details.append(cloudinary_result)
-                
-                # Process image with HuggingFace API for category prediction
-                try:
-                    await file.seek(0)  # Reset file pointer
-                    image_data = await file.read()
-                    response = requests.post(
-                        VISION_API_URL,
-                        headers={"Authorization": f"Bearer {HF_API}"},
-                        data=image_data
-                    )
-                    if response.status_code == 200:
-                        for item in response.json():
-                            category = item['label']
-                            image_categories.append(category)
-                except Exception as img_error:
-                    print(f"Error processing image: {str(img_error)}")
-                    # Continue with other files if one fails
+        
+        # Stream each image to a spool file (hashing and size checks on the fly)
+        uploads = []
+        try:
+            for file in files:
+                if file and file.filename:
+                    uploads.append(await spool_upload(file))
+        except BaseException:
+            for upload in uploads:
+                upload.discard()
+            raise
         
         # Parse the categories JSON string
         try:
@@ -241,88 +304,104 @@ async def upload_product(
             except:
                 parsed_categories = []
         
-        # Create product metadata for Pinecone
-        metadata = {
+        listing = {
             "productName": productName,
             "productDescription": productDescription,
             "productPrice": productPrice,
             "categories": parsed_categories,
-            "image_categories": image_categories,
-            "product_id": product_id,
-            "image_urls": image_urls  # Add image URLs to metadata
-        }
-
-        # Generate embeddings and store in Pinecone
-        combined_string = f"{productName} {productDescription} {' '.join(parsed_categories)}"
-        vector = model.encode(combined_string).tolist()
-
-        # Upsert to Pinecone
-        index.upsert(vectors=[{
-            "id": product_id,
-            "values": vector,
-            "metadata": metadata
-        }])
-
-        # Parse location data
-        location = None
-        if latitude and longitude:
-            try:
-                lat_float = float(latitude)
-                lng_float = float(longitude)
-                location = {
-                    "type": "Point",
-                    "coordinates": [lng_float, lat_float]  # GeoJSON format is [longitude, latitude]
-                }
-            except ValueError:
-                location = None
-
-        # Parse price to float
-        try:
-            price_float = float(productPrice)
-        except ValueError:
-            price_float = 0.0
-
-        # Create MongoDB document
-        mongo_product = {
-            "id": product_id,
-            "name": productName,
-            "description": productDescription,
-            "price": price_float,
-            "categories": parsed_categories,
-            "images": image_urls,
-            "image_details": image_details,  # Store full image details
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow(),
-            # User information
-            "user": {
-                "id": userId,
-                "email": userEmail,
-                "name": userName,
-                "avatar": userAvatar
-            },
-            # Location information
-            "location": location,
-            "address": address,
-            # Store image analysis for future use
-            "image_categories": image_categories
+            "userId": userId,
+            "userEmail": userEmail,
+            "userName": userName,
+            "userAvatar": userAvatar,
+            "latitude": latitude,
+            "longitude": longitude,
+            "address": address
         }
         
-        # Insert into MongoDB
-        products_collection.insert_one(mongo_product)
+        job = await ingestion.submit(listing, uploads)
         
         return {
-            "message": "Product uploaded successfully", 
-            "product_id": product_id, 
-            "metadata": metadata,
-            "mongo_id": str(mongo_product.get("_id", "")),
-            "images": image_urls
+            "message": "Product accepted for processing",
+            "job_id": job["id"],
+            "product_id": job["product_id"],
+            "status": job["status"],
+            "status_url": f"/upload_product/jobs/{job['id']}"
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Upload error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/upload_product/jobs/{job_id}")
+async def get_upload_job(job_id: str):
+    """Report the progress of an ingestion job"""
+    try:
+        job = ingestion.get_job(job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return BSONResponse(job)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error fetching upload job: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error fetching upload job: {str(e)}")
+
+
+def require_admin(request: Request):
+    if not ADMIN_TOKEN or request.headers.get("x-admin-token") != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+@app.post("/products/import", status_code=202, dependencies=[Depends(require_admin)])
+async def import_products(
+    file: UploadFile = File(...),
+    sourceFormat: str = Form(None),
+    keepImageUrls: bool = Form(False)
+):
+    """Queue a JSONL or CSV catalog for bulk import.
+
+    Rows use the `/upload_product` field names plus `images` (URLs). Poll
+    `status_url` for progress and per-row errors.
+    """
+    if sourceFormat not in (None, "jsonl", "csv"):
+        raise HTTPException(status_code=400, detail="sourceFormat must be jsonl or csv")
+    try:
+        upload = await spool_upload(file, max_bytes=bulk_import.MAX_SOURCE_BYTES, require_image=False)
+        job = await bulk_import.submit(upload, sourceFormat, keepImageUrls)
+        return {
+            "message": "Catalog accepted for import",
+            "job_id": job["id"],
+            "status": job["status"],
+            "status_url": f"/products/import/{job['id']}"
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Import error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error starting import: {str(e)}")
+
+
+@app.get("/products/import/{job_id}", dependencies=[Depends(require_admin)])
+async def get_import_job(job_id: str):
+    """Report the progress, throughput, ETA and row errors of an import"""
+    try:
+        job = bulk_import.get_job(job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="Import job not found")
+        return BSONResponse(job)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error fetching import job: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error fetching import job: {str(e)}")
+
+
 @app.get("/products/nearby")
 async def get_nearby_products(
     latitude: float,
@@ -343,28 +422,75 @@ async def get_nearby_products(
                         "$maxDistance": max_distance  # in meters
                     }
                 }
-            }
-        ))  # Removed the limit parameter
-        
-        # Convert ObjectId to string for JSON serialization
-        for product in nearby_products:
-            if "_id" in product:
-                product["_id"] = str(product["_id"])
+            },
+            PRODUCT_LIST_PROJECTION
+        ).limit(limit))
         
-        return nearby_products
+        return BSONResponse(nearby_products)
     
     except Exception as e:
         print(f"Error fetching nearby products: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching nearby products: {str(e)}")
-    
+
+
+@app.get("/products/search")
+async def search_products(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=200),
+    hydrator: Hydrator = Depends(get_hydrator),
+    category: Optional[List[str]] = Query(None),
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    latitude: Optional[float] = Query(None, ge=-90, le=90),
+    longitude: Optional[float] = Query(None, ge=-180, le=180),
+    radius_km: float = Query(25, gt=0, le=500),
+    limit: int = Query(20, ge=1, le=100)
+):
+    """
+    Semantic search: products whose meaning is closest to `q`
+
+    Category, price range and location filters are applied inside the
+    vector query; results carry their similarity `score` (and `distance_m`
+    when searching near a point).
+    """
+    if (latitude is None) != (longitude is None):
+        raise HTTPException(status_code=400, detail="latitude and longitude must be given together")
+    try:
+        cached = response_cache.lookup(request)
+        if cached:
+            return cached
+
+        categories = [c for c in (category or []) if c.lower() != "all"]
+        near = (latitude, longitude, radius_km * 1000) if latitude is not None else None
+        products = await asyncio.to_thread(
+            semantic_search.search, q, limit, categories, min_price, max_price, near, PRODUCT_LIST_PROJECTION
+        )
+
+        # Refresh seller names/avatars with one batched users query
+        hydrator.hydrate_owners(products)
+
+        tags = ["products"] + [f"product:{p['id']}" for p in products]
+        tags += {f"user:{p['user']['id']}" for p in products if (p.get("user") or {}).get("id")}
+        return response_cache.store(request, products, tags=tags)
+
+    except Exception as e:
+        print(f"Error searching products: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error searching products: {str(e)}")
+
 @app.get("/products")
 async def get_products(
+    request: Request,
+    hydrator: Hydrator = Depends(get_hydrator),
     skip: int = Query(0, ge=0), 
     limit: int = Query(1000, ge=1),  # Increase default limit to 1000
     category: Optional[str] = None,
     search: Optional[str] = None
 ):
     try:
+        cached = response_cache.lookup(request)
+        if cached:
+            return cached
+        
         query = {}
         
         # Add debugging
@@ -379,10 +505,10 @@ async def get_products(
                 {"categories": {"$regex": search, "$options": "i"}}  # Search in categories
             ]
         
-        # Filter by category if provided and not 'All'
+        # Filter by category if provided and not 'All' (case-insensitive
+        # through the collation of the categories index)
         if category and category.lower() != 'all':
-            # Check if the category field exists
-            query["categories"] = {"$regex": category, "$options": "i"}
+            query["categories"] = category
             
         # Text search if provided
         if search:
@@ -393,34 +519,61 @@ async def get_products(
         
         print(f"MongoDB query: {query}")
             
-        # Get products - removed the limit parameter to get all products
-        products = list(products_collection.find(query).sort("created_at", -1).skip(skip))
+        cursor = products_collection.find(query, PRODUCT_LIST_PROJECTION)
+        if "categories" in query:
+            cursor = cursor.collation(index_manager.CATEGORY_COLLATION)
+        products = list(cursor.sort("created_at", -1).skip(skip).limit(limit))
         print(f"Found {len(products)} products matching query")
         
-        # Convert ObjectId to string for JSON serialization
-        for product in products:
-            if "_id" in product:
-                product["_id"] = str(product["_id"])
+        # Refresh seller names/avatars with one batched users query
+        hydrator.hydrate_owners(products)
         
-        return products
+        # Any new listing or change to a listed product or seller invalidates this page
+        tags = ["products"] + [f"product:{p['id']}" for p in products if "id" in p]
+        tags += {f"user:{p['user']['id']}" for p in products if (p.get("user") or {}).get("id")}
+        return response_cache.store(request, products, tags=tags)
     
     except Exception as e:
         print(f"Error fetching products: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching products: {str(e)}")
 
 # Add API endpoints
-VISION_API_URL = "https://api-inference.huggingface.co/models/google/vit-base-patch16-224"
-TEXT_API_URL = "https://api-inference.huggingface.co/models/facebook/bart-large-mnli"
-
-CATEGORY_MAPPING = {
-    'electronics': ['laptop', 'mobile', 'camera', 'headphones', 'television', 'watch', 'earphones', 'tablet', 'smartwatch', 'speaker', 'microphone', 'radio', 'projector', 'drone', 'smartphone'],
-    'furniture': ['chair', 'table', 'sofa', 'bed', 'desk', 'cabinet', 'shelf', 'couch', 'stool', 'dresser'],
-    'clothing': ['shirt', 'pants', 'dress', 'shoes', 'jacket', 'skirt', 'sweater', 'jeans', 't-shirt', 'shorts'],
-    'books': ['textbook', 'novel', 'magazine', 'comic', 'manual', 'guide', 'encyclopedia', 'biography', 'journal', 'anthology'],
-    'automobile': ['car', 'bike', 'scooter', 'motorcycle', 'truck', 'van', 'bus', 'bicycle', 'trailer', 'moped'],
-    'sports': ['football', 'cricket', 'tennis', 'basketball', 'baseball', 'hockey', 'golf', 'volleyball', 'badminton', 'rugby'],
-    'other': ['other']
-}
+VISION_API_URL = os.getenv(
+    "HF_VISION_API_URL",
+    "https://api-inference.huggingface.co/models/google/vit-base-patch16-224"
+)
+# Connect and read timeout for the vision API, in seconds
+VISION_API_TIMEOUT = float(os.getenv("HF_VISION_API_TIMEOUT", "20"))
+
+# Classification cache namespaces; bump when the model or its output changes
+REMOTE_VISION_VERSION = "google/vit-base-patch16-224@hf-inference:labels"
+LOCAL_VISION_VERSION = "google/vit-base-patch16-224@transformers:top1"
+
+def classify_image_remote(contents, digest: Optional[str] = None) -> List[str]:
+    """Labels for an image from the HuggingFace vision API (empty on failure).
+    Results are cached by content hash, so the same photo is sent once.
+    A timeout raises TransientStageError, so an ingestion job is requeued
+    rather than hanging on to a classification slot."""
+    def compute():
+        with metrics.span("hf_inference", "image_classification"):
+            try:
+                response = requests.post(
+                    VISION_API_URL,
+                    headers={"Authorization": f"Bearer {HF_API}"},
+                    data=contents,
+                    timeout=VISION_API_TIMEOUT
+                )
+            except requests.Timeout as e:
+                raise ingestion.TransientStageError(
+                    f"Vision API timed out after {VISION_API_TIMEOUT:g}s"
+                ) from e
+        if response.status_code != 200:
+            return []
+        return [item['label'] for item in response.json()]
+    
+    digest = digest or hashlib.sha256(contents).hexdigest()
+    return classification_cache.get_or_compute(REMOTE_VISION_VERSION, digest, compute)
+
 
 @app.post("/predict_categories")
 async def predict_categories(
@@ -432,57 +585,29 @@ async def predict_categories(
 ):
     try:
         categories = set()
-        headers = {"Authorization": f"Bearer {HF_API}"}
 
         # Process images
         for file in [file1, file2, file3]:
             if file is None:
                 continue
                 
-            # Read image
-            contents = await file.read()
-            
-            # Send image to Hugging Face API
-            response = requests.post(
-                VISION_API_URL,
-                headers=headers,
-                data=contents
-            )
+            # Stream the image to disk, then classify a memory-mapped view
+            # (cached by content hash, shared with the upload pipeline)
+            upload = await spool_upload(file)
+            try:
+                with upload.view() as contents:
+                    labels = classify_image_remote(contents, upload.sha256)
+            finally:
+                upload.discard()
             
-            if response.status_code == 200:
-                predictions = response.json()
-                print("Predictions:", predictions)
-                # Extract predicted labels
-                for prediction in predictions:
-                    label = prediction['label'].lower()
-                    # Map prediction to category
-                    for category, items in CATEGORY_MAPPING.items():
-                        if any(item in label for item in items):
-                            categories.add(category)
+            print("Predictions:", labels)
+            # Map predicted labels to categories
+            categories.update(category_predictor.categories_for_labels(labels))
             print("Categories:", categories)
 
-        # Process text (product name and description)
-        text_payload = {
-            "inputs": f"{productName} {productDescription}",
-            "parameters": {
-                "candidate_labels": list(CATEGORY_MAPPING.keys())
-            }
-        }
-        
-        response = requests.post(
-            TEXT_API_URL,
-            headers=headers,
-            json=text_payload
-        )
-        
-        if response.status_code == 200:
-            text_predictions = response.json()
-            print("Text Predictions:", text_predictions)
-            # Add top 2 predicted categories from text
-            scores = text_predictions['scores']
-            labels = text_predictions['labels']
-            top_categories = [labels[i] for i in range(min(1, len(scores)))]
-            categories.update(top_categories)
+        # Process text (product name and description) against the local
+        # category prototypes
+        categories.update(category_predictor.predict_text(f"{productName} {productDescription}", top_n=1))
         print("Categories:", categories)
         
         # Add default categories if none were predicted
@@ -491,6 +616,8 @@ async def predict_categories(
         
         return {"categories": list(categories)}
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error processing data: {str(e)}")
         return {"categories": ["electronics", "furniture", "clothing"]}
@@ -499,53 +626,22 @@ async def predict_categories(
 
 
 
-async def upload_to_cloudinary(file: UploadFile, product_id: str, index: int) -> dict:
+async def store_product_image(upload: SpooledUpload) -> dict:
     """
-    Uploads an image to Cloudinary and returns the image details
+    Uploads a spooled listing image to the media store and returns the image
+    details. Transient failures are retried; anything else raises
+    MediaUploadError, and the ingestion job is requeued (transient) or
+    failed.
     """
-    try:
-        # Read file content
-        contents = await file.read()
-        
-        # Create a unique public_id based on product and image index
-        public_id = f"barter_trade/{product_id}_{index}"
-        
-        # Upload to Cloudinary
-        upload_result = cloudinary.uploader.upload(
-            contents,
-            public_id=public_id,
-            folder="barter_trade_products",
-            resource_type="auto",
-            overwrite=True
-        )
-        
-        # Reset file pointer for potential future reads
-        await file.seek(0)
-        
-        return {
-            "url": upload_result["secure_url"],
-            "public_id": upload_result["public_id"],
-            "format": upload_result["format"],
-            "width": upload_result["width"],
-            "height": upload_result["height"],
-            "resource_type": upload_result["resource_type"]
-        }
-    except Exception as e:
-        print(f"Error uploading to Cloudinary: {str(e)}")
-        # Return a placeholder if upload fails
-        return {
-            "url": f"https://res.cloudinary.com/demo/image/upload/v1/placeholder.jpg",
-            "public_id": "",
-            "format": "jpg",
-            "width": 300,
-            "height": 300,
-            "resource_type": "image",
-            "error": str(e)
-        }
+    return await media_uploader.uploader.upload(upload, "barter_trade_products")
 
 
 @app.get("/products/{product_id}")
-async def get_product(product_id: str = Path(..., description="The ID of the product to retrieve")):
+async def get_product(
+    request: Request,
+    product_id: str = Path(..., description="The ID of the product to retrieve"),
+    hydrator: Hydrator = Depends(get_hydrator)
+):
     """
     Get a specific product by its ID
     
@@ -556,8 +652,12 @@ async def get_product(product_id: str = Path(..., description="The ID of the pro
     - Location data
     """
     try:
+        cached = response_cache.lookup(request)
+        if cached:
+            return cached
+        
         # Try to find the product in MongoDB by ID
-        product = products_collection.find_one({"id": product_id})
+        product = products_collection.find_one({"id": product_id}, {"image_embeddings": 0})
         
         # If the product is not found
         if not product:
@@ -605,6 +705,7 @@ async def get_product(product_id: str = Path(..., description="The ID of the pro
         
         # Clean up user data to remove sensitive information
         if "user" in product and product["user"]:
+            hydrator.hydrate_owners([product])
             # Ensure we're only sending what's needed
             product["user"] = {
                 "id": product["user"].get("id", ""),
@@ -613,7 +714,10 @@ async def get_product(product_id: str = Path(..., description="The ID of the pro
                 # Remove email for privacy unless you specifically need it
             }
         
-        return product
+        tags = [f"product:{product_id}"]
+        if product.get("user"):
+            tags.append(f"user:{product['user']['id']}")
+        return response_cache.store(request, product, tags=tags)
     
     except HTTPException:
         # Re-raise HTTP exceptions
@@ -640,12 +744,23 @@ async def record_product_view(
         # Insert into a views collection
         db["product_views"].insert_one(view_data)
         
-        # Increment view count on the product
-        products_collection.update_one(
+        # Increment view count on the product and fetch what the trending
+        # engine needs to bucket it in the same round trip
+        product = products_collection.find_one_and_update(
             {"id": product_id},
-            {"$inc": {"view_count": 1}}
+            {"$inc": {"view_count": 1}},
+            projection={"_id": 0, "categories": 1, "location": 1}
         )
         
+        if product is not None:
+            trending_service.engine.record_view(
+                product_id,
+                product.get("categories") or [],
+                product.get("location")
+            )
+            # Cached responses carrying this product show its view_count
+            response_cache.invalidate(f"product:{product_id}")
+        
         return {"success": True}
     except Exception as e:
         print(f"Error recording product view: {str(e)}")
@@ -668,7 +783,10 @@ async def get_recommended_products(
     """Get personalized product recommendations for a user based on price, location, and category"""
     try:
         # Check if user has uploaded products
-        user_products = list(products_collection.find({"user.id": user_id}))
+        user_products = list(products_collection.find(
+            {"user.id": user_id},
+            {"_id": 0, "price": 1, "categories": 1}
+        ))
         has_uploads = len(user_products) > 0
         
         # User hasn't uploaded any products - use generic recommendations
@@ -691,10 +809,13 @@ async def get_recommended_products(
                 
             # 2. Category-based filtering (if category provided)
             if category:
-                query["categories"] = {"$regex": category, "$options": "i"}
+                query["categories"] = category
                 
             # Get similar products with price and category matching
-            matched_products = list(products_collection.find(query).sort("created_at", -1).limit(limit))
+            cursor = products_collection.find(query, PRODUCT_LIST_PROJECTION)
+            if category:
+                cursor = cursor.collation(index_manager.CATEGORY_COLLATION)
+            matched_products = list(cursor.sort("created_at", -1).limit(limit))
             
             # Add match reason to products
             for product in matched_products:
@@ -707,38 +828,29 @@ async def get_recommended_products(
                 # Add category match reason
                 if category and any(cat.lower() == category.lower() for cat in product.get("categories", [])):
                     product["match_reasons"].append("Similar category")
-                
-                # Convert ObjectId to string
-                if "_id" in product:
-                    product["_id"] = str(product["_id"])
                     
-            # If not enough products found, add popular products
+            # If not enough products found, add trending products
             if len(matched_products) < limit:
-                # Get popular products excluding already recommended ones
+                # Get trending products excluding already recommended ones
                 existing_ids = [p["id"] for p in matched_products]
-                popular_query = {"id": {"$nin": existing_ids}}
-                
                 if productId:
-                    popular_query["id"] = {"$ne": productId}
+                    existing_ids.append(productId)
                     
-                if user_id:
-                    popular_query["user.id"] = {"$ne": user_id}
-                    
-                popular_products = list(
-                    products_collection.find(popular_query)
-                    .sort("view_count", -1)
-                    .limit(limit - len(matched_products))
+                popular_products = trending_service.fetch_trending_products(
+                    limit - len(matched_products),
+                    category=category,
+                    region=trending_service.region_for_point(lat, lng),
+                    exclude_ids=existing_ids,
+                    exclude_user_id=user_id,
+                    projection=PRODUCT_LIST_PROJECTION
                 )
                 
-                # Convert ObjectId to string
                 for product in popular_products:
                     product["match_reasons"] = ["Popular item"]
-                    if "_id" in product:
-                        product["_id"] = str(product["_id"])
                         
                 matched_products.extend(popular_products)
                 
-            return matched_products
+            return BSONResponse(matched_products)
             
         # User has uploaded products - do more sophisticated matching
         else:
@@ -762,7 +874,7 @@ async def get_recommended_products(
                 if productId:
                     price_query["id"] = {"$ne": productId}  # Exclude current product
                     
-                price_matched = list(products_collection.find(price_query).limit(limit))
+                price_matched = list(products_collection.find(price_query, PRODUCT_LIST_PROJECTION).limit(limit))
                 
             # STEP 2: LOCATION MATCHING (second priority)
             location_matched = []
@@ -790,7 +902,7 @@ async def get_recommended_products(
                         "$nin": [p["id"] for p in price_matched]
                     }
                     
-                location_matched = list(products_collection.find(location_query).limit(limit))
+                location_matched = list(products_collection.find(location_query, PRODUCT_LIST_PROJECTION).limit(limit))
                 
                 # Calculate distance for each product
                 for product in location_matched:
@@ -841,7 +953,11 @@ async def get_recommended_products(
                     if excluded_ids:
                         category_query["id"] = {"$nin": excluded_ids}
                         
-                    category_matched = list(products_collection.find(category_query).limit(limit))
+                    category_matched = list(
+                        products_collection.find(category_query, PRODUCT_LIST_PROJECTION)
+                        .collation(index_manager.CATEGORY_COLLATION)
+                        .limit(limit)
+                    )
             
             # Combine all matched products with priority (price > location > category)
             all_matches = []
@@ -849,70 +965,52 @@ async def get_recommended_products(
             # Add price matched products with tag
             for p in price_matched:
                 p["match_reasons"] = ["Similar price"]
-                if "_id" in p:
-                    p["_id"] = str(p["_id"])
                 all_matches.append(p)
                 
             # Add location matched products with tag
             for p in location_matched:
                 distance_str = f"Nearby ({p.get('distance', '?')}km)"
                 p["match_reasons"] = [distance_str]
-                if "_id" in p:
-                    p["_id"] = str(p["_id"])
                 all_matches.append(p)
                 
             # Add category matched products with tag
             for p in category_matched:
                 p["match_reasons"] = ["Similar category"]
-                if "_id" in p:
-                    p["_id"] = str(p["_id"])
                 all_matches.append(p)
             
-            # If we still don't have enough products, add popular products
+            # If we still don't have enough products, add trending products
             if len(all_matches) < limit:
-                # Get popular products excluding already recommended ones
+                # Get trending products excluding already recommended ones
                 existing_ids = [p["id"] for p in all_matches]
-                popular_query = {"id": {"$nin": existing_ids}}
-                
                 if productId:
-                    popular_query["id"] = {"$ne": productId}
+                    existing_ids.append(productId)
                     
-                if user_id:
-                    popular_query["user.id"] = {"$ne": user_id}
-                    
-                popular_products = list(
-                    products_collection.find(popular_query)
-                    .sort("view_count", -1)
-                    .limit(limit - len(all_matches))
+                popular_products = trending_service.fetch_trending_products(
+                    limit - len(all_matches),
+                    category=category,
+                    region=trending_service.region_for_point(lat, lng),
+                    exclude_ids=existing_ids,
+                    exclude_user_id=user_id,
+                    projection=PRODUCT_LIST_PROJECTION
                 )
                 
-                # Convert ObjectId to string
                 for p in popular_products:
                     p["match_reasons"] = ["Popular item"]
-                    if "_id" in p:
-                        p["_id"] = str(p["_id"])
                         
                 all_matches.extend(popular_products)
                 
-            return all_matches[:limit]  # Return at most 'limit' products
+            return BSONResponse(all_matches[:limit])  # Return at most 'limit' products
                 
     except Exception as e:
         print(f"Error getting recommendations: {str(e)}")
         # Fallback to popular products
-        return await get_popular_products(limit)
+        return BSONResponse(await get_popular_products(limit))
     
 # Helper function to get popular products
 async def get_popular_products(limit: int = 10):
     try:
-        # Get products with highest view count
-        popular_products = list(products_collection.find().sort("view_count", -1).limit(limit))
-        
-        # Convert ObjectId to string
-        for product in popular_products:
-            if "_id" in product:
-                product["_id"] = str(product["_id"])
-                
-        return popular_products
+        # Get products with the highest decayed popularity score
+        return trending_service.fetch_trending_products(limit, projection=PRODUCT_LIST_PROJECTION)
     except Exception as e:
         print(f"Error fetching popular products: {str(e)}")
         # Return empty list as last resort
@@ -936,6 +1034,11 @@ async def create_user(user: UserCreate):
                     "updated_at": datetime.utcnow()
                 }}
             )
+            if existing_user.get("name") != user.name or existing_user.get("avatar") != user.avatar:
+                hydration.invalidate_user(user.id)
+                snapshot_sync.enqueue_user(user.id)
+            if any(existing_user.get(field) != getattr(user, field) for field in ("name", "avatar", "email")):
+                response_cache.invalidate(f"user:{user.id}")
             # Get updated user
             updated_user = users_collection.find_one({"id": user.id})
             if updated_user:
@@ -973,29 +1076,23 @@ async def create_user(user: UserCreate):
         raise HTTPException(status_code=500, detail=f"Error creating user: {str(e)}")
 
 @app.get("/users/{user_id}")
-async def get_user_profile(user_id: str):
+async def get_user_profile(request: Request, user_id: str):
     """Get a user's profile data"""
     try:
-        # Find the user in the database
-        user = users_collection.find_one({"id": user_id})
+        cached = response_cache.lookup(request)
+        if cached:
+            return cached
+        
+        # Find the user in the database, leaving out sensitive fields.
+        # Statistics are maintained by the product create/delete paths.
+        user = users_collection.find_one({"id": user_id}, {"password": 0, "token": 0})
         
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Convert ObjectId to string for JSON serialization
-        if "_id" in user:
-            user["_id"] = str(user["_id"])
-            
-        # Update statistics if needed
-        user = update_user_statistics(user)
+        user = user_stats.with_default_statistics(user)
             
-        # Remove sensitive fields
-        if "password" in user:
-            del user["password"]
-        if "token" in user:
-            del user["token"]
-            
-        return user
+        return response_cache.store(request, user, tags=[f"user:{user_id}"])
         
     except HTTPException:
         raise
@@ -1003,32 +1100,6 @@ async def get_user_profile(user_id: str):
         print(f"Error fetching user profile: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching user profile: {str(e)}")
 
-def update_user_statistics(user):
-    """Update user statistics based on their activity"""
-    try:
-        user_id = user["id"]
-        
-        # Count user's products
-        products_count = products_collection.count_documents({"user.id": user_id})
-        
-        # Add calculated statistics
-        user["statistics"] = {
-            "items_listed": products_count,
-            "total_trades": user.get("statistics", {}).get("total_trades", 0),
-            "successful_trades": user.get("statistics", {}).get("successful_trades", 0)
-        }
-        
-        # Save updated statistics back to database
-        users_collection.update_one(
-            {"id": user_id},
-            {"$set": {"statistics": user["statistics"]}}
-        )
-        
-        return user
-    except Exception as e:
-        print(f"Error updating user statistics: {str(e)}")
-        return user  # Return the original user if we can't update stats
-
 @app.get("/users/{user_id}/products")
 async def get_user_products(
     user_id: str,
@@ -1038,15 +1109,11 @@ async def get_user_products(
     """Get products listed by a user"""
     try:
         products = list(products_collection.find(
-            {"user.id": user_id}
+            {"user.id": user_id},
+            PRODUCT_LIST_PROJECTION
         ).sort("created_at", -1).skip(skip).limit(limit))
-        
-        # Convert ObjectId to string
-        for product in products:
-            if "_id" in product:
-                product["_id"] = str(product["_id"])
                 
-        return products
+        return BSONResponse(products)
         
     except Exception as e:
         print(f"Error fetching user products: {str(e)}")
@@ -1089,6 +1156,12 @@ async def update_user(user_id: str, update_data: UserUpdate):
             {"id": user_id},
             {"$set": update_fields}
         )
+        response_cache.invalidate(f"user:{user_id}")
+        hydration.invalidate_user(user_id)
+        
+        # Embedded copies of the name/avatar are rewritten in the background
+        if "name" in update_fields or "avatar" in update_fields:
+            snapshot_sync.enqueue_user(user_id)
         
         # Get and return the updated user
         updated_user = users_collection.find_one({"id": user_id})
@@ -1114,7 +1187,7 @@ app.include_router(donation_service.router)
 
 
 @app.post("/chat/rooms")
-async def create_chat_room(room_data: ChatRoomCreate):
+async def create_chat_room(room_data: ChatRoomCreate, hydrator: Hydrator = Depends(get_hydrator)):
     """Create a new chat room or return existing one"""
     try:
         # Check if room already exists
@@ -1128,18 +1201,20 @@ async def create_chat_room(room_data: ChatRoomCreate):
             existing_room["_id"] = str(existing_room["_id"])
             return existing_room
         
-        # Get product details
-        product = products_collection.find_one({"id": room_data.product_id})
+        # Load product, buyer and seller details (one query per collection)
+        hydrator.products.queue(room_data.product_id)
+        hydrator.users.queue(room_data.buyer_id, room_data.seller_id)
+        hydrator.dispatch()
+        
+        product = hydrator.products.get(room_data.product_id)
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
             
-        # Get buyer details
-        buyer = users_collection.find_one({"id": room_data.buyer_id})
+        buyer = hydrator.users.get(room_data.buyer_id)
         if not buyer:
             raise HTTPException(status_code=404, detail="Buyer not found")
             
-        # Get seller details
-        seller = users_collection.find_one({"id": room_data.seller_id})
+        seller = hydrator.users.get(room_data.seller_id)
         if not seller:
             raise HTTPException(status_code=404, detail="Seller not found")
         
@@ -1156,21 +1231,9 @@ async def create_chat_room(room_data: ChatRoomCreate):
             "buyer_read_at": None,
             "seller_read_at": None,
             # Include minimal product and user details
-            "product": {
-                "id": product["id"],
-                "name": product["name"],
-                "images": product.get("images", [])
-            },
-            "buyer": {
-                "id": buyer["id"],
-                "name": buyer.get("name", "User"),
-                "avatar": buyer.get("avatar", "")
-            },
-            "seller": {
-                "id": seller["id"],
-                "name": seller.get("name", "User"),
-                "avatar": seller.get("avatar", "")
-            }
+            "product": hydration.product_snapshot(product),
+            "buyer": hydration.user_snapshot(buyer),
+            "seller": hydration.user_snapshot(seller)
         }
         
         result = chat_rooms_collection.insert_one(new_room)
@@ -1185,7 +1248,7 @@ async def create_chat_room(room_data: ChatRoomCreate):
         raise HTTPException(status_code=500, detail=f"Error creating chat room: {str(e)}")
 
 @app.get("/chat/rooms")
-async def get_chat_rooms(user_id: str = Query(...)):
+async def get_chat_rooms(user_id: str = Query(...), hydrator: Hydrator = Depends(get_hydrator)):
     """Get all chat rooms for a user"""
     try:
         rooms = list(chat_rooms_collection.find({
@@ -1195,19 +1258,17 @@ async def get_chat_rooms(user_id: str = Query(...)):
             ]
         }).sort("updated_at", -1))
         
-        # Convert ObjectId to string
-        for room in rooms:
-            if "_id" in room:
-                room["_id"] = str(room["_id"])
+        # Refresh embedded product and user snapshots in one batch
+        hydrator.hydrate_rooms(rooms)
                 
-        return rooms
+        return BSONResponse(rooms)
         
     except Exception as e:
         print(f"Error fetching chat rooms: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching chat rooms: {str(e)}")
 
 @app.get("/chat/rooms/{room_id}")
-async def get_chat_room(room_id: str):
+async def get_chat_room(room_id: str, hydrator: Hydrator = Depends(get_hydrator)):
     """Get a specific chat room by ID"""
     try:
         room = chat_rooms_collection.find_one({"id": room_id})
@@ -1216,6 +1277,7 @@ async def get_chat_room(room_id: str):
             raise HTTPException(status_code=404, detail="Chat room not found")
             
         room["_id"] = str(room["_id"])
+        hydrator.hydrate_rooms([room])
         return room
         
     except HTTPException:
@@ -1353,15 +1415,10 @@ async def get_messages(
             .limit(limit)
         )
         
-        # Convert ObjectId to string
-        for msg in messages:
-            if "_id" in msg:
-                msg["_id"] = str(msg["_id"])
-                
         # Sort messages in ascending order for client display
-        messages.sort(key=lambda x: x["created_at"])
+        messages.reverse()
                 
-        return messages
+        return BSONResponse(messages)
         
     except Exception as e:
         print(f"Error fetching messages: {str(e)}")
@@ -1451,18 +1508,19 @@ async def get_unread_count(user_id: str = Query(...)):
         raise HTTPException(status_code=500, detail=f"Error getting unread count: {str(e)}")
 
 
-# Initialize model and processor globally to avoid reloading (reduces latency)
-processor = None
-model = None
+# Initialize model and processor globally to avoid reloading (reduces latency).
+# Kept separate from `model` (the sentence embedder) so loading ViT does not replace it.
+vit_processor = None
+vit_model = None
 
 def load_model():
-    global processor, model
-    if processor is None or model is None:
+    global vit_processor, vit_model
+    if vit_processor is None or vit_model is None:
         print("Loading model for the first time...")
-        processor = ViTImageProcessor.from_pretrained('google/vit-base-patch16-224', token=HF_API_KEY)
-        model = ViTForImageClassification.from_pretrained('google/vit-base-patch16-224', token=HF_API_KEY)
+        vit_processor = ViTImageProcessor.from_pretrained('google/vit-base-patch16-224', token=HF_API)
+        vit_model = ViTForImageClassification.from_pretrained('google/vit-base-patch16-224', token=HF_API)
         print("Model loaded successfully")
-    return processor, model
+    return vit_processor, vit_model
 
 def classify_from_file(image_path):
     try:
@@ -1474,42 +1532,132 @@ def classify_from_file(image_path):
         print(f"Error classifying from file: {str(e)}")
         return None
 
-def get_top_prediction(image):
-    try:
-        processor, model = load_model()
-        inputs = processor(images=image, return_tensors="pt")
-        outputs = model(**inputs)
+def get_top_prediction(image, digest: Optional[str] = None):
+    """Top ViT label for a PIL image; pass the image bytes' SHA-256 as
+    `digest` to reuse an earlier result for the same photo"""
+    def compute():
+        processor, classifier = load_model()
+        with metrics.span("vit", "classify"):
+            inputs = processor(images=image, return_tensors="pt")
+            outputs = classifier(**inputs)
         logits = outputs.logits
         
         # Get only the top prediction
         predicted_class_idx = logits.argmax(-1).item()
-        label = model.config.id2label[predicted_class_idx]
-        
-        return label
+        return classifier.config.id2label[predicted_class_idx]
+    
+    try:
+        return classification_cache.get_or_compute(LOCAL_VISION_VERSION, digest, compute)
     except Exception as e:
         print(f"Error getting prediction: {str(e)}")
         return None
 
 @app.post("/api/search_by_image")
-async def search_by_image(file: UploadFile = File(...)):
+async def search_by_image(
+    file: UploadFile = File(...),
+    limit: int = Query(20, ge=1, le=100),
+    hydrator: Hydrator = Depends(get_hydrator)
+):
+    """Products whose photos look like the uploaded one, best match first.
+
+    `label` is the ViT top-1 label that used to be the whole response.
+    """
     try:
         print(f"Received image: {file.filename}, size: {file.size} bytes")
-        # Read the image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        # Get classification
-        print("Calling get_top_prediction...")
-        label = get_top_prediction(image)
-        print(f"Prediction result: {label}")
-        
-        # Return result
-        return {"label": label}
+        # Stream the image to disk; PIL reads it from there lazily
+        upload = await spool_upload(file)
+        try:
+            with Image.open(upload.path) as image:
+                # Get classification
+                print("Calling get_top_prediction...")
+                label = get_top_prediction(image, upload.sha256)
+                print(f"Prediction result: {label}")
+
+            def find_similar():
+                with upload.view() as contents:
+                    return image_search.search(contents, limit, PRODUCT_LIST_PROJECTION)
+
+            products = await asyncio.to_thread(find_similar)
+        finally:
+            upload.discard()
+
+        hydrator.hydrate_owners(products)
+        return BSONResponse({"label": label, "products": products})
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in search_by_image: {str(e)}")
         return {"error": str(e)}
 
 
+# Wire the ingestion pipeline to the external services
+ingestion.setup_pipeline(
+    db,
+    store=store_product_image,
+    classify=classify_image_remote,
+    embed=image_search.embed_images
+)
+
+# Catalog imports only write products; their vectors come from vector_sync
+bulk_import.setup_importer(db)
+
+# Semantic search embeds queries with the same model as the products
+semantic_search.setup_search(
+    db,
+    embed=lambda text: model.encode(text).tolist(),
+    query=index.query
+)
+
+# Mirror products into the vector index from the change stream
+vector_sync.setup_sync(
+    db,
+    embed=lambda texts: model.encode(texts, batch_size=256).tolist(),
+    upsert=lambda vectors: index.upsert(vectors=vectors),
+    delete=lambda ids: index.delete(ids=ids),
+    image_upsert=lambda vectors: image_index.upsert(vectors=vectors),
+    image_delete=lambda ids: image_index.delete(ids=ids)
+)
+
+# Photo search queries the image index built from listing images
+image_search.setup_search(db, query=image_index.query)
+
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """Hit ratios and sizes for the in-process response cache"""
+    return dict(
+        response_cache.stats(),
+        query_embeddings=semantic_search.query_cache.stats(),
+        classifications=classification_cache.stats()
+    )
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Request and dependency latencies in Prometheus text format"""
+    return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/admin/slow_queries", dependencies=[Depends(require_admin)])
+async def get_slow_queries(
+    limit: int = Query(50, ge=1, le=500),
+    collection: Optional[str] = None
+):
+    """Recent slow MongoDB commands with their plans, and per-collection totals"""
+    return BSONResponse(mongo_monitor.query_monitor.report(limit, collection))
+
+
+@app.get("/admin/event_loop", dependencies=[Depends(require_admin)])
+async def get_event_loop_stats(limit: int = Query(20, ge=1, le=100)):
+    """Event-loop lag and recent stalls with the blocking stack and route"""
+    return loop_monitor.report(limit)
+
+
+@app.get("/vector_sync/stats")
+async def get_vector_sync_stats():
+    """Throughput and lag of the products -> vector index sync"""
+    return vector_sync.get_stats()
+
 
 if __name__ == '__main__':
     import uvicorn
@@ -0,0 +1,275 @@
+"""Content-addressed media storage.
+
+Images are keyed by the SHA-256 of their bytes, so re-uploading the same
+photo (common when relisting) is a lookup instead of a second upload.
+`put` returns the same detail dict shape the Cloudinary helpers always
+returned (url, public_id, format, width, height, resource_type), plus the
+content hash and thumbnail renditions.
+
+Two backends are available, selected with MEDIA_BACKEND:
+
+* `cloudinary` (default): uploads once per distinct hash and remembers the
+  result in `media_assets`; thumbnails are Cloudinary transformation URLs.
+* `local`: writes originals and WebP thumbnails under MEDIA_ROOT and serves
+  them from `/media/...` with immutable, year-long cache headers. Stored URLs
+  are absolute (MEDIA_PUBLIC_URL is this backend's public origin), so they
+  work from a frontend served on another origin.
+"""
+import hashlib
+import io
+import mmap
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import cloudinary
+import cloudinary.uploader
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import FileResponse
+from PIL import Image
+
+import metrics
+
+MEDIA_BACKEND = os.getenv("MEDIA_BACKEND", "cloudinary")
+MEDIA_ROOT = os.getenv(
+    "MEDIA_ROOT",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads", "media")
+)
+MEDIA_PUBLIC_URL = os.getenv("MEDIA_PUBLIC_URL", "http://localhost:8000")
+MEDIA_BASE_URL = os.getenv("MEDIA_BASE_URL", "/media")
+THUMBNAIL_WIDTHS = [int(w) for w in os.getenv("MEDIA_THUMBNAIL_WIDTHS", "200,600").split(",") if w]
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_FORMATS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif", "BMP": "bmp", "TIFF": "tiff"}
+
+router = APIRouter(
+    prefix="/media",
+    tags=["media"]
+)
+
+
+def content_hash(contents) -> str:
+    return hashlib.sha256(contents).hexdigest()
+
+
+def _image_file(contents):
+    """A file for PIL over `contents`: an mmap is read in place, bytes are wrapped without a copy"""
+    if isinstance(contents, mmap.mmap):
+        contents.seek(0)
+        return contents
+    return io.BytesIO(contents)
+
+
+def _image_info(contents):
+    """(format, width, height) of an image, or a generic fallback"""
+    try:
+        with Image.open(_image_file(contents)) as image:
+            return _FORMATS.get(image.format, (image.format or "bin").lower()), image.width, image.height
+    except Exception:
+        return "bin", 0, 0
+
+
+class MediaStore(ABC):
+    """Interface shared by the media backends"""
+
+    name = "base"
+
+    def __init__(self):
+        self.counters = {"puts": 0, "deduplicated": 0, "bytes_stored": 0}
+
+    @abstractmethod
+    def put(self, contents, folder: str = "", digest: Optional[str] = None) -> dict:
+        """Store `contents` (bytes or any buffer, e.g. an mmap) unless
+        already stored, and return its details. Pass `digest` when the
+        SHA-256 is already known to skip rehashing."""
+
+    def stats(self) -> dict:
+        return dict(self.counters, backend=self.name)
+
+
+class LocalMediaStore(MediaStore):
+    name = "local"
+
+    def __init__(self, root: str = MEDIA_ROOT, base_url: str = MEDIA_BASE_URL,
+                 thumbnail_widths: List[int] = THUMBNAIL_WIDTHS, public_url: str = MEDIA_PUBLIC_URL):
+        super().__init__()
+        self.root = root
+        if base_url.startswith("/"):
+            # URLs are stored in documents and read by other origins
+            base_url = public_url.rstrip("/") + base_url
+        self.base_url = base_url.rstrip("/")
+        self.thumbnail_widths = thumbnail_widths
+
+    def relative_path(self, digest: str, suffix: str) -> str:
+        return os.path.join(digest[:2], digest[2:4], f"{digest}{suffix}")
+
+    def put(self, contents, folder: str = "", digest: Optional[str] = None) -> dict:
+        digest = digest or content_hash(contents)
+        fmt, width, height = _image_info(contents)
+        original = self.relative_path(digest, f".{fmt}")
+        path = os.path.join(self.root, original)
+        self.counters["puts"] += 1
+
+        if os.path.exists(path):
+            self.counters["deduplicated"] += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _atomic_write(path, contents)
+            self.counters["bytes_stored"] += len(contents)
+
+        thumbnails = {}
+        for target in self.thumbnail_widths:
+            relative = self.relative_path(digest, f"_w{target}.webp")
+            thumb_path = os.path.join(self.root, relative)
+            if not os.path.exists(thumb_path) and fmt != "bin":
+                self._write_thumbnail(contents, thumb_path, target)
+            if os.path.exists(thumb_path):
+                thumbnails[f"w{target}"] = f"{self.base_url}/{relative.replace(os.sep, '/')}"
+
+        return {
+            "url": f"{self.base_url}/{original.replace(os.sep, '/')}",
+            "public_id": digest,
+            "format": fmt,
+            "width": width,
+            "height": height,
+            "resource_type": "image" if fmt != "bin" else "raw",
+            "sha256": digest,
+            "thumbnails": thumbnails
+        }
+
+    def _write_thumbnail(self, contents, path: str, target: int):
+        try:
+            with Image.open(_image_file(contents)) as image:
+                image.thumbnail((target, target * 4))
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGB")
+                buffer = io.BytesIO()
+                image.save(buffer, format="WEBP", quality=80)
+            _atomic_write(path, buffer.getvalue())
+        except Exception as e:
+            print(f"Error generating thumbnail: {str(e)}")
+
+
+class CloudinaryMediaStore(MediaStore):
+    """Cloudinary uploads, skipped when the same bytes were uploaded before"""
+
+    name = "cloudinary"
+
+    def __init__(self, thumbnail_widths: List[int] = THUMBNAIL_WIDTHS, memory_entries: int = 4096):
+        super().__init__()
+        self.thumbnail_widths = thumbnail_widths
+        self.assets_collection = None
+        self.memory: "OrderedDict[str, dict]" = OrderedDict()
+        self.memory_entries = memory_entries
+        self.lock = threading.Lock()
+
+    def put(self, contents, folder: str = "barter_trade_products", digest: Optional[str] = None) -> dict:
+        digest = digest or content_hash(contents)
+        self.counters["puts"] += 1
+
+        known = self._lookup(digest)
+        if known is not None:
+            self.counters["deduplicated"] += 1
+            return dict(known)
+
+        with metrics.span("cloudinary", "upload"):
+            upload_result = cloudinary.uploader.upload(
+                contents,
+                public_id=f"barter_trade/{digest}",
+                folder=folder,
+                resource_type="auto",
+                overwrite=False,
+                timeout=30
+            )
+        self.counters["bytes_stored"] += len(contents)
+
+        details = {
+            "url": upload_result["secure_url"],
+            "public_id": upload_result["public_id"],
+            "format": upload_result["format"],
+            "width": upload_result["width"],
+            "height": upload_result["height"],
+            "resource_type": upload_result["resource_type"],
+            "sha256": digest,
+            "thumbnails": {f"w{w}": _cloudinary_rendition(upload_result["secure_url"], w)
+                           for w in self.thumbnail_widths}
+        }
+        self._remember(digest, details)
+        return dict(details)
+
+    def _lookup(self, digest: str) -> Optional[dict]:
+        with self.lock:
+            if digest in self.memory:
+                self.memory.move_to_end(digest)
+                return self.memory[digest]
+        if self.assets_collection is not None:
+            asset = self.assets_collection.find_one({"sha256": digest, "backend": self.name}, {"_id": 0, "details": 1})
+            if asset:
+                self._remember(digest, asset["details"], persist=False)
+                return asset["details"]
+        return None
+
+    def _remember(self, digest: str, details: dict, persist: bool = True):
+        with self.lock:
+            self.memory[digest] = details
+            self.memory.move_to_end(digest)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+        if persist and self.assets_collection is not None:
+            try:
+                self.assets_collection.update_one(
+                    {"sha256": digest, "backend": self.name},
+                    {"$setOnInsert": {"details": details, "created_at": datetime.utcnow()}},
+                    upsert=True
+                )
+            except Exception as e:
+                print(f"Warning: Could not record media asset: {str(e)}")
+
+
+def _cloudinary_rendition(url: str, width: int) -> str:
+    return url.replace("/upload/", f"/upload/c_limit,w_{width},f_auto,q_auto/", 1)
+
+
+def _atomic_write(path: str, contents):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(contents)
+    os.replace(tmp_path, path)
+
+
+def _create_store() -> MediaStore:
+    if MEDIA_BACKEND == "local":
+        return LocalMediaStore()
+    return CloudinaryMediaStore()
+
+
+store: MediaStore = _create_store()
+
+
+def setup_collection(db):
+    """Back the dedup registry with `media_assets` (called from main.py)"""
+    if isinstance(store, CloudinaryMediaStore):
+        store.assets_collection = db["media_assets"]
+
+
+@router.get("/{path:path}")
+async def get_media(path: str):
+    """Serve a locally stored original or thumbnail"""
+    if not isinstance(store, LocalMediaStore):
+        raise HTTPException(status_code=404, detail="Media not found")
+
+    full_path = os.path.realpath(os.path.join(store.root, path))
+    if not full_path.startswith(os.path.realpath(store.root) + os.sep) or not os.path.isfile(full_path):
+        raise HTTPException(status_code=404, detail="Media not found")
+
+    # Content-addressed files never change, so clients may cache them forever.
+    # FileResponse hands the file to the server's zero-copy send when available.
+    digest = os.path.basename(full_path).split(".")[0].split("_")[0]
+    return FileResponse(
+        full_path,
+        headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL, "ETag": f'"{digest}"'}
+    )
@@ -0,0 +1,238 @@
+"""Shared async image uploader for listings and donations.
+
+Both `/upload_product` (through the ingestion pipeline) and
+`/donations/create` store images through `uploader`. A listing's images are
+uploaded concurrently, capped by one process-wide limit
+(MEDIA_UPLOAD_CONCURRENCY), so a burst of listings cannot open unbounded
+connections to the media backend. The blocking store call runs in a thread.
+
+Transient failures are retried with jittered exponential backoff. Transient
+means a dropped connection, a timeout, an unreadable gateway response or a
+Cloudinary rate limit. The wait is an `asyncio.sleep`, and the concurrency
+slot is released while waiting. An outage therefore never blocks the event
+loop, and other uploads are not held up by it.
+
+Failure model: every failure reaches the caller as `MediaUploadError`,
+which records whether it was transient and how many attempts were made.
+There are no placeholder images. An ingestion job goes back to its queue
+with backoff on a transient error and fails on any other, and the donation
+endpoint answers 502.
+
+`python media_uploader.py check` runs the uploader against a local stub
+store. The stub fails the first attempts, counts concurrency and checks that
+the loop keeps running during backoff.
+"""
+import asyncio
+import os
+import random
+import socket
+import sys
+from typing import Callable, List, Optional
+
+import cloudinary.exceptions
+import requests
+
+import media_store
+import metrics
+from upload_spool import SpooledUpload
+
+CONCURRENCY = int(os.getenv("MEDIA_UPLOAD_CONCURRENCY", "8"))
+MAX_ATTEMPTS = int(os.getenv("MEDIA_UPLOAD_MAX_ATTEMPTS", "4"))
+BASE_DELAY = float(os.getenv("MEDIA_UPLOAD_BASE_DELAY", "0.5"))
+MAX_DELAY = float(os.getenv("MEDIA_UPLOAD_MAX_DELAY", "8"))
+
+# Cloudinary SDK messages for transport failures (it raises one Error type)
+_TRANSIENT_MESSAGES = ("Unexpected error", "Socket error", "Error parsing server response")
+
+upload_retries = metrics.registry.register(metrics.Counter(
+    "media_upload_retries_total", "Media uploads retried after a transient failure"
+))
+upload_failures = metrics.registry.register(metrics.Counter(
+    "media_upload_failures_total", "Media uploads that failed for good", ["transient"]
+))
+
+
+class MediaUploadError(Exception):
+    def __init__(self, message: str, transient: bool, attempts: int):
+        super().__init__(message)
+        self.transient = transient
+        self.attempts = attempts
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether retrying the same upload can succeed"""
+    if isinstance(error, (cloudinary.exceptions.RateLimited, cloudinary.exceptions.GeneralError)):
+        return True
+    if isinstance(error, cloudinary.exceptions.Error):
+        return str(error).startswith(_TRANSIENT_MESSAGES)
+    # Network failures only: any other OSError (a missing spool file, a
+    # permissions problem) fails the same way on every attempt
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                              ConnectionError, TimeoutError, socket.timeout))
+
+
+class MediaUploader:
+    def __init__(self, put: Optional[Callable[..., dict]] = None, concurrency: int = CONCURRENCY,
+                 max_attempts: int = MAX_ATTEMPTS, base_delay: float = BASE_DELAY, max_delay: float = MAX_DELAY):
+        # Looked up per call by default, so tests can swap media_store.store
+        self.put = put
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    @property
+    def slots(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        return self._slots
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: uniform in [0, min(max_delay, base * 2^attempt)]"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _store(self, upload: SpooledUpload, folder: str) -> dict:
+        put = self.put or media_store.store.put
+        with upload.view() as contents:
+            return put(contents, folder=folder, digest=upload.sha256)
+
+    async def upload(self, upload: SpooledUpload, folder: str) -> dict:
+        """Store one spooled image and return its details"""
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                async with self.slots:
+                    return await asyncio.to_thread(self._store, upload, folder)
+            except Exception as e:
+                transient = is_transient(e)
+                if not transient or attempt == self.max_attempts:
+                    upload_failures.inc(str(transient).lower())
+                    raise MediaUploadError(
+                        f"Image upload failed after {attempt} attempt{'s' if attempt > 1 else ''}: {str(e)}",
+                        transient, attempt
+                    ) from e
+                delay = self.backoff(attempt)
+                upload_retries.inc()
+                print(f"Image upload attempt {attempt} failed ({str(e)}); retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def upload_many(self, uploads: List[SpooledUpload], folder: str) -> List[dict]:
+        """Store images concurrently; details in input order.
+
+        Every upload finishes (or fails) before this returns, so no upload is
+        left running against files the caller is about to discard.
+        """
+        results = await asyncio.gather(*[self.upload(u, folder) for u in uploads], return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+
+uploader = MediaUploader()
+
+
+def _check() -> int:
+    """Exercise retries, the concurrency cap and non-blocking backoff on a stub"""
+    import shutil
+    import tempfile
+    import threading
+    import time
+
+    failures = []
+    state = {"active": 0, "peak": 0, "calls": {}}
+    lock = threading.Lock()
+
+    def stub_put(contents, folder="", digest=None):
+        with lock:
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+            calls = state["calls"][digest] = state["calls"].get(digest, 0) + 1
+        try:
+            time.sleep(0.05)
+            if digest.startswith("bad"):
+                raise cloudinary.exceptions.BadRequest("Invalid image file")
+            if digest.startswith("flaky") and calls < 3:
+                raise cloudinary.exceptions.Error("Socket error: ConnectionResetError(104)")
+            if digest.startswith("down"):
+                raise cloudinary.exceptions.Error("Unexpected error - MaxRetryError")
+            return {"url": f"https://stub/{digest}.jpg", "public_id": digest}
+        finally:
+            with lock:
+                state["active"] -= 1
+
+    directory = tempfile.mkdtemp(prefix="media-uploader-check-")
+
+    def spooled(name):
+        path = os.path.join(directory, name)
+        with open(path, "wb") as f:
+            f.write(name.encode())
+        return SpooledUpload(path, name, os.path.getsize(path), name, "jpg")
+
+    async def run():
+        check = MediaUploader(put=stub_put, concurrency=4, max_attempts=3, base_delay=0.2, max_delay=0.4)
+
+        # Fan-out under the cap
+        start = time.perf_counter()
+        results = await check.upload_many([spooled(f"ok-{i}") for i in range(16)], "check")
+        elapsed = time.perf_counter() - start
+        if [r["public_id"] for r in results] != [f"ok-{i}" for i in range(16)]:
+            failures.append("results not in input order")
+        if state["peak"] > 4:
+            failures.append(f"concurrency cap exceeded: {state['peak']} > 4")
+        if elapsed > 16 * 0.05 * 0.75:
+            failures.append(f"uploads did not run concurrently ({elapsed:.2f}s)")
+
+        # Transient failures are retried while the loop keeps ticking
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticking = asyncio.create_task(ticker())
+        start = time.perf_counter()
+        result = await check.upload(spooled("flaky-1"), "check")
+        elapsed = time.perf_counter() - start
+        ticking.cancel()
+        if result["public_id"] != "flaky-1" or state["calls"]["flaky-1"] != 3:
+            failures.append(f"flaky upload took {state['calls'].get('flaky-1')} calls, expected 3")
+        if ticks < elapsed / 0.01 * 0.5:
+            failures.append(f"event loop stalled during backoff ({ticks} ticks in {elapsed:.2f}s)")
+
+        # Permanent errors fail fast; exhausted retries report the attempts
+        for name, transient, attempts in (("bad-1", False, 1), ("down-1", True, 3)):
+            try:
+                await check.upload(spooled(name), "check")
+                failures.append(f"{name} did not fail")
+            except MediaUploadError as e:
+                if (e.transient, e.attempts) != (transient, attempts):
+                    failures.append(f"{name}: transient={e.transient} attempts={e.attempts}")
+
+        # One failure in a fan-out fails the batch only after the rest settle
+        try:
+            await check.upload_many([spooled("ok-a"), spooled("bad-2"), spooled("ok-b")], "check")
+            failures.append("batch with a bad image did not fail")
+        except MediaUploadError:
+            pass
+        if state["active"] != 0:
+            failures.append("uploads still running after the batch failed")
+
+    try:
+        asyncio.run(run())
+    finally:
+        shutil.rmtree(directory, True)
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    print("media uploader check passed" if not failures else f"{len(failures)} failures")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "check":
+        print("usage: python media_uploader.py check")
+        sys.exit(2)
+    sys.exit(_check())
@@ -0,0 +1,247 @@
+"""Request and dependency timing, exported in Prometheus text format.
+
+`MetricsMiddleware` times every HTTP request by route template (so
+`/products/{product_id}` is one series, not one per id). Calls to external
+services and models are timed with
+
+    with metrics.span("cloudinary", "upload"):
+        ...
+
+or by wrapping methods once at startup:
+
+    metrics.instrument(index, "pinecone", "query", "upsert", "delete")
+
+MongoDB commands are timed by `MongoCommandTimer`, a pymongo command listener
+(the app registers it as mongo_monitor.QueryMonitor, which extends it).
+Span time also counts towards the request being served. Each request records
+how long it spent in each service (`http_request_dependency_seconds`), which
+shows whether a slow route is waiting on Mongo, Pinecone, Cloudinary, HF or
+the model. This works across `asyncio.to_thread` because the per-request
+holder travels in a context variable.
+
+The cost per span is two `perf_counter` calls and a bucket bisect under a
+lock, small enough to leave on in production. `GET /metrics` serves
+`registry.render()`.
+"""
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+
+# Seconds; spans cover sub-millisecond Mongo reads up to minute-long uploads
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Per-request {service: seconds}, set by MetricsMiddleware
+_request_spans: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "request_spans", default=None
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values: Dict[Tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1.0):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (+Inf last), sum]
+        self.series: Dict[Tuple, list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][position] += 1
+            series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            items = [(labels, list(counts), total) for labels, (counts, total) in self.series.items()]
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield (f"{self.name}_bucket{_labels(self.label_names + ('le',), labels + (le,))} "
+                       f"{cumulative}")
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template",
+    ["method", "route", "status"]
+))
+requests_in_flight = registry.register(Gauge(
+    "http_requests_in_flight", "HTTP requests being served"
+))
+request_dependency = registry.register(Histogram(
+    "http_request_dependency_seconds", "Time a request spent in each external service or model",
+    ["route", "service"]
+))
+span_duration = registry.register(Histogram(
+    "dependency_call_duration_seconds", "Latency of calls to external services and models",
+    ["service", "operation"]
+))
+span_errors = registry.register(Counter(
+    "dependency_call_errors_total", "Calls to external services and models that raised",
+    ["service", "operation"]
+))
+
+
+def record_span(service: str, operation: str, seconds: float, failed: bool = False):
+    span_duration.observe(seconds, service, operation)
+    if failed:
+        span_errors.inc(service, operation)
+    spans = _request_spans.get()
+    if spans is not None:
+        spans[service] = spans.get(service, 0.0) + seconds
+
+
+@contextmanager
+def span(service: str, operation: str):
+    """Time a block as one call to `service`"""
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        record_span(service, operation, time.perf_counter() - start, failed)
+
+
+def timed(service: str, operation: str):
+    """Decorator form of `span`"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(service, operation):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def instrument(obj, service: str, *methods: str):
+    """Replace `obj.<method>` with a timed version for each named method"""
+    for method in methods:
+        setattr(obj, method, timed(service, method)(getattr(obj, method)))
+    return obj
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Times every MongoDB command as a `mongo` span (pymongo calls the
+    listener on the thread that ran the command, so the request is known)"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record_span("mongo", event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record_span("mongo", event.command_name, event.duration_micros / 1e6, failed=True)
+
+
+class MetricsMiddleware:
+    """Time requests by route template and attribute dependency time to them"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        spans: Dict[str, float] = {}
+        token = _request_spans.set(spans)
+        requests_in_flight.inc()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - start
+            requests_in_flight.dec()
+            _request_spans.reset(token)
+            route = scope.get("route")
+            template = getattr(route, "path", None) or "unmatched"
+            request_duration.observe(seconds, scope["method"], template, str(status))
+            for service, spent in spans.items():
+                request_dependency.observe(spent, template, service)
@@ -0,0 +1,22 @@
+"""Which MongoDB deployment and database the backend uses.
+
+main.py and the maintenance CLIs (index_manager, reembed, user_stats,
+bulk_import, image_search) all connect through here, so a CLI always works
+on the database the app serves. The environment is read on each call, after
+the caller has loaded its .env.
+"""
+import os
+
+from pymongo import MongoClient
+
+DEFAULT_DATABASE = "Cluster0"
+
+
+def connect(**options) -> MongoClient:
+    """A client for MONGODB_URI"""
+    return MongoClient(os.getenv("MONGODB_URI"), **options)
+
+
+def database(client: MongoClient):
+    """The app database (MONGODB_DB) on `client`"""
+    return client[os.getenv("MONGODB_DB", DEFAULT_DATABASE)]
@@ -0,0 +1,221 @@
+"""MongoDB command monitoring with a slow-query log.
+
+`QueryMonitor` is the app's pymongo command listener. It extends
+`metrics.MongoCommandTimer`, so every command is still timed once, as a
+`mongo` span. On top of that it keeps per-collection totals for
+/admin/slow_queries and flags commands slower than MONGO_SLOW_QUERY_MS
+(`mongo_slow_commands_total`). For a slow
+read or write it keeps a sample in a ring buffer. Each sample holds the query
+shape, with literal values replaced by "?", and the `explain` plan: the
+winning stages and index names, and whether it scanned the whole
+collection. The plan itself is not kept, since its filters and index bounds
+hold the literal values.
+
+A `getMore` with `maxTimeMS` is on an awaitData cursor (a change stream or a
+tailable cursor). The server holds it for up to that long when there is
+nothing new, so the wait is not counted towards the slow threshold.
+
+Explains run on a background thread, never in the listener, and at most once
+per query shape every EXPLAIN_INTERVAL seconds. Later samples of the same
+shape reuse the last plan. When the explain queue is full, the plan is
+skipped rather than slowing requests down. `GET /admin/slow_queries` shows
+the buffer and per-collection totals.
+"""
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+import metrics
+
+SLOW_QUERY_MS = float(os.getenv("MONGO_SLOW_QUERY_MS", "100"))
+SAMPLE_RATE = float(os.getenv("MONGO_SLOW_QUERY_SAMPLE_RATE", "1.0"))
+BUFFER_SIZE = int(os.getenv("MONGO_SLOW_QUERY_BUFFER", "200"))
+EXPLAIN_INTERVAL = float(os.getenv("MONGO_EXPLAIN_INTERVAL", "300"))
+EXPLAIN_QUEUE_SIZE = 64
+
+EXPLAINABLE = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+# Command fields that explain rejects or that only describe the session
+_SESSION_FIELDS = {"lsid", "txnNumber", "readConcern", "writeConcern", "autocommit", "startTransaction"}
+# Fields whose values are the query itself (shape kept, literals redacted)
+_QUERY_FIELDS = ("filter", "query", "q", "pipeline", "sort", "key", "updates", "deletes")
+
+slow_commands = metrics.registry.register(metrics.Counter(
+    "mongo_slow_commands_total", "MongoDB commands slower than the slow-query threshold",
+    ["collection", "command"]
+))
+
+
+def query_shape(value):
+    """The value with every literal replaced by "?" (keys and operators kept)"""
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = [query_shape(v) for v in value]
+        # `$in: [1, 2, 3]` and `$in: [4]` are the same query
+        return shapes[:1] if all(s == "?" for s in shapes) else shapes
+    return "?"
+
+
+def plan_summary(explain: dict) -> dict:
+    """Stages, indexes and collection scans of the winning plan"""
+    planner = explain.get("queryPlanner")
+    if planner is None:
+        # Aggregations explain per stage; the $cursor stage has the planner
+        for stage in explain.get("stages") or []:
+            planner = (stage.get("$cursor") or {}).get("queryPlanner")
+            if planner:
+                break
+    winning = (planner or {}).get("winningPlan") or {}
+    stages, indexes = [], []
+
+    def walk(node):
+        if not isinstance(node, dict):
+            return
+        if "stage" in node:
+            stages.append(node["stage"])
+        if "indexName" in node:
+            indexes.append(node["indexName"])
+        for child in ("inputStage", "queryPlan"):
+            walk(node.get(child))
+        for child in node.get("inputStages") or []:
+            walk(child)
+
+    walk(winning)
+    return {"stages": stages, "indexes": indexes, "collection_scan": "COLLSCAN" in stages}
+
+
+class QueryMonitor(metrics.MongoCommandTimer):
+    def __init__(self, threshold_ms: float = SLOW_QUERY_MS, sample_rate: float = SAMPLE_RATE,
+                 buffer_size: int = BUFFER_SIZE):
+        self.threshold = threshold_ms / 1000
+        self.sample_rate = sample_rate
+        self.samples = deque(maxlen=buffer_size)
+        self.totals: Dict[Tuple[str, str], dict] = {}
+        self.plans: Dict[str, Tuple[float, Optional[dict]]] = {}
+        self.inflight: Dict[Tuple, Tuple[str, str, Optional[dict], float]] = {}
+        self.client = None
+        self.explain_queue: "queue.Queue" = queue.Queue(EXPLAIN_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self._worker = None
+
+    def attach(self, client):
+        """Client used to run explains (the one this listener is registered on)"""
+        self.client = client
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._explain_loop, name="mongo-explain", daemon=True)
+            self._worker.start()
+
+    def started(self, event):
+        name = event.command_name
+        if name == "explain":
+            return
+        target = event.command.get("collection") if name == "getMore" else event.command.get(name)
+        collection = target if isinstance(target, str) else ""
+        # Only awaitData getMores accept maxTimeMS; that much of the wait is idle
+        awaited = event.command.get("maxTimeMS", 0) / 1000 if name == "getMore" else 0.0
+        self.inflight[(event.connection_id, event.request_id)] = (
+            collection, event.database_name, event.command if name in EXPLAINABLE else None, awaited
+        )
+
+    def succeeded(self, event):
+        super().succeeded(event)
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        super().failed(event)
+        self._finish(event, failed=True)
+
+    def _finish(self, event, failed: bool):
+        started = self.inflight.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        collection, database, command, awaited = started
+        name = event.command_name
+        seconds = event.duration_micros / 1e6
+
+        slow = seconds - awaited >= self.threshold
+        with self.lock:
+            totals = self.totals.setdefault((collection, name), {"count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                                                  "slow": 0, "failed": 0})
+            totals["count"] += 1
+            totals["total_ms"] += seconds * 1000
+            totals["max_ms"] = max(totals["max_ms"], seconds * 1000)
+            totals["slow"] += slow
+            totals["failed"] += failed
+        if not slow:
+            return
+
+        slow_commands.inc(collection, name)
+        if random.random() > self.sample_rate:
+            return
+        self._sample(database, collection, name, command, seconds)
+
+    def _sample(self, database: str, collection: str, name: str, command: Optional[dict], seconds: float):
+        shape = {field: query_shape(command[field]) for field in _QUERY_FIELDS if command and field in command}
+        if command and "limit" in command:
+            shape["limit"] = command["limit"]
+        if command and command.get("skip"):
+            shape["skip"] = "?"
+        key = json.dumps([database, collection, name, shape], sort_keys=True, default=str)
+
+        sample = {
+            "at": datetime.utcnow().isoformat() + "Z",
+            "database": database,
+            "collection": collection,
+            "command": name,
+            "duration_ms": round(seconds * 1000, 2),
+            "shape": shape,
+            "plan": None,
+        }
+        with self.lock:
+            explained_at, plan = self.plans.get(key, (float("-inf"), None))
+            sample["plan"] = plan
+            self.samples.append(sample)
+            due = command is not None and time.monotonic() - explained_at >= EXPLAIN_INTERVAL
+            if due:
+                # Claimed now so concurrent slow calls of this shape do not queue it again
+                self.plans[key] = (time.monotonic(), plan)
+        if due and self.client is not None:
+            explain = {k: v for k, v in command.items() if not k.startswith("$") and k not in _SESSION_FIELDS}
+            try:
+                self.explain_queue.put_nowait((key, database, explain, sample))
+            except queue.Full:
+                pass
+
+    def _explain_loop(self):
+        while True:
+            key, database, command, sample = self.explain_queue.get()
+            try:
+                result = self.client[database].command("explain", command, verbosity="queryPlanner")
+                plan = plan_summary(result)
+            except Exception as e:
+                plan = {"error": str(e)}
+            with self.lock:
+                self.plans[key] = (self.plans.get(key, (time.monotonic(), None))[0], plan)
+                # The sample that triggered the explain is still in the buffer (or evicted, harmlessly)
+                sample["plan"] = plan
+
+    def report(self, limit: int = 50, collection: Optional[str] = None) -> dict:
+        with self.lock:
+            samples = [s for s in self.samples if collection is None or s["collection"] == collection]
+            totals = [
+                dict(t, collection=c, command=n, avg_ms=round(t["total_ms"] / t["count"], 2),
+                     total_ms=round(t["total_ms"], 1), max_ms=round(t["max_ms"], 2))
+                for (c, n), t in self.totals.items() if collection is None or c == collection
+            ]
+        totals.sort(key=lambda t: t["total_ms"], reverse=True)
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "sample_rate": self.sample_rate,
+            "by_collection": totals,
+            "slow_queries": list(reversed(samples))[:limit],
+        }
+
+
+query_monitor = QueryMonitor()
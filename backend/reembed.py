@@ -0,0 +1,244 @@
+"""Rebuild product vectors from `products` after a change to the embedding
+text, the model or the vector index.
+
+The collection is split into `_id` ranges ($bucketAuto), and the ranges are
+spread over worker processes. Each worker loads the model once. For every
+range it scans in `_id` order, encodes a batch at a time, upserts the
+vectors in chunks, and records the last `_id` it finished on the run's
+`reembed_runs` document. After a crash or Ctrl-C, `resume` picks each range
+up from that `_id`. With `--shadow-index`, every vector is also written to a
+second index, so the new index can be filled and checked before traffic is
+switched to it.
+
+    python reembed.py start [--workers 4] [--batch-size 256] [--index products-test]
+                            [--shadow-index NAME] [--model all-MiniLM-L6-v2]
+    python reembed.py resume <run_id> [--workers 4]
+    python reembed.py status <run_id>
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_EXCEPTION
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+import ingestion
+import mongo_config
+import vector_sync
+
+DEFAULT_MODEL = "all-MiniLM-L6-v2"
+DEFAULT_INDEX = "products-test"
+VECTOR_CHUNK = 100
+RANGES_PER_WORKER = 4
+PROGRESS_INTERVAL = 5.0
+
+# Every field the vector records are built from (location feeds geo_cells)
+PRODUCT_PROJECTION = {"_id": 1, "id": 1, **{field: 1 for field in vector_sync.EMBEDDED_FIELDS}}
+
+
+def _database():
+    load_dotenv()
+    return mongo_config.database(mongo_config.connect())
+
+
+def plan_ranges(products, count: int) -> list:
+    """Split products into about `count` contiguous `_id` ranges of similar size.
+
+    A $bucketAuto bucket's max is the next bucket's min, so ranges are
+    half-open [min, max) except the last one, which includes its max.
+    """
+    buckets = list(products.aggregate([
+        {"$bucketAuto": {"groupBy": "$_id", "buckets": max(count, 1)}}
+    ]))
+    return [
+        {"n": n, "min": bucket["_id"]["min"], "max": bucket["_id"]["max"], "last": n == len(buckets) - 1,
+         "last_id": None, "processed": 0, "done": False}
+        for n, bucket in enumerate(buckets)
+    ]
+
+
+# Per-process state, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(model_name: str, index_name: str, shadow_index_name):
+    from pinecone import Pinecone
+    from sentence_transformers import SentenceTransformer
+
+    db = _database()
+    pc = Pinecone(api_key=os.getenv("API_KEY"))
+    _worker.update(
+        runs=db["reembed_runs"],
+        products=db["products"],
+        model=SentenceTransformer(model_name),
+        indexes=[pc.Index(index_name)] + ([pc.Index(shadow_index_name)] if shadow_index_name else [])
+    )
+
+
+def _encode_batch(products: list) -> list:
+    listings = [ingestion.listing_from_product(p) for p in products]
+    texts = [ingestion.embedding_text(l["productName"], l["productDescription"], l["categories"])
+             for l in listings]
+    vectors = _worker["model"].encode(texts, batch_size=len(texts)).tolist()
+    return [
+        {
+            "id": product["id"],
+            "values": vector,
+            "metadata": ingestion.vector_metadata(
+                listing, product["id"], product.get("images") or [], product.get("image_categories") or []
+            )
+        }
+        for product, listing, vector in zip(products, listings, vectors)
+    ]
+
+
+def _process_range(run_id: str, bucket: dict, batch_size: int) -> int:
+    """Re-embed one `_id` range from its checkpoint; returns documents processed"""
+    runs, products = _worker["runs"], _worker["products"]
+    # Runs planned before ranges were half-open have no "last" and keep $lte
+    upper = "$lte" if bucket.get("last", True) else "$lt"
+    if bucket["last_id"] is not None:
+        query = {"_id": {"$gt": bucket["last_id"], upper: bucket["max"]}}
+    else:
+        query = {"_id": {"$gte": bucket["min"], upper: bucket["max"]}}
+
+    processed = bucket["processed"]
+    cursor = products.find(query, PRODUCT_PROJECTION).sort("_id", 1).batch_size(batch_size)
+    batch = []
+    for product in cursor:
+        if not product.get("id"):
+            continue
+        batch.append(product)
+        if len(batch) >= batch_size:
+            processed += _flush(run_id, bucket["n"], batch, processed)
+            batch = []
+    if batch:
+        processed += _flush(run_id, bucket["n"], batch, processed)
+
+    runs.update_one({"id": run_id, "ranges.n": bucket["n"]},
+                    {"$set": {"ranges.$.done": True, "updated_at": datetime.utcnow()}})
+    return processed
+
+
+def _flush(run_id: str, n: int, batch: list, processed: int) -> int:
+    vectors = _encode_batch(batch)
+    for index in _worker["indexes"]:
+        for start in range(0, len(vectors), VECTOR_CHUNK):
+            index.upsert(vectors=vectors[start:start + VECTOR_CHUNK])
+
+    # Checkpoint only once the whole batch is in every index
+    _worker["runs"].update_one(
+        {"id": run_id, "ranges.n": n},
+        {"$set": {"ranges.$.last_id": batch[-1]["_id"], "ranges.$.processed": processed + len(batch),
+                  "updated_at": datetime.utcnow()}}
+    )
+    return len(batch)
+
+
+def _progress(run: dict, started_at: float, processed_at_start: int) -> dict:
+    processed = sum(r["processed"] for r in run["ranges"])
+    elapsed = max(time.time() - started_at, 1e-6)
+    rate = (processed - processed_at_start) / elapsed
+    remaining = max(run["total"] - processed, 0)
+    return {
+        "processed": processed,
+        "total": run["total"],
+        "ranges_done": sum(1 for r in run["ranges"] if r["done"]),
+        "ranges": len(run["ranges"]),
+        "docs_per_second": round(rate, 1),
+        "eta_seconds": round(remaining / rate) if rate > 0 else None
+    }
+
+
+def execute(run_id: str, workers: int) -> dict:
+    """Run every unfinished range of a run across `workers` processes"""
+    runs = _database()["reembed_runs"]
+    run = runs.find_one({"id": run_id}, {"_id": 0})
+    if not run:
+        raise ValueError(f"Re-embed run {run_id} not found")
+
+    pending = [r for r in run["ranges"] if not r["done"]]
+    processed_at_start = sum(r["processed"] for r in run["ranges"])
+    started_at = time.time()
+    runs.update_one({"id": run_id}, {"$set": {"status": "running", "error": None}})
+
+    # spawn: each worker gets a clean interpreter for torch and its own clients
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(run["model"], run["index"], run.get("shadow_index"))) as pool:
+        futures = [pool.submit(_process_range, run_id, bucket, run["batch_size"]) for bucket in pending]
+        while True:
+            done, not_done = wait(futures, timeout=PROGRESS_INTERVAL, return_when=FIRST_EXCEPTION)
+            progress = _progress(runs.find_one({"id": run_id}, {"_id": 0}), started_at, processed_at_start)
+            print(f"{progress['processed']}/{progress['total']} products, "
+                  f"{progress['ranges_done']}/{progress['ranges']} ranges, "
+                  f"{progress['docs_per_second']} docs/s, eta {progress['eta_seconds']}s")
+
+            failed = [f for f in done if f.exception() is not None]
+            if failed:
+                for future in not_done:
+                    future.cancel()
+                error = str(failed[0].exception())
+                runs.update_one({"id": run_id}, {"$set": {"status": "failed", "error": error}})
+                raise RuntimeError(f"Re-embed run {run_id} failed (resume it to continue): {error}")
+            if not not_done:
+                break
+
+    runs.update_one({"id": run_id}, {"$set": {"status": "completed", "completed_at": datetime.utcnow()}})
+    return progress
+
+
+def create_run(workers: int, batch_size: int, model: str, index: str, shadow_index) -> dict:
+    db = _database()
+    products = db["products"]
+    run = {
+        "id": str(uuid.uuid4()),
+        "status": "planned",
+        "model": model,
+        "index": index,
+        "shadow_index": shadow_index,
+        "batch_size": batch_size,
+        "total": products.estimated_document_count(),
+        "ranges": plan_ranges(products, workers * RANGES_PER_WORKER),
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow()
+    }
+    db["reembed_runs"].insert_one(run)
+    run.pop("_id", None)
+    return run
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-embed products into the vector index")
+    commands = parser.add_subparsers(dest="command", required=True)
+    start_parser = commands.add_parser("start")
+    start_parser.add_argument("--workers", type=int, default=4)
+    start_parser.add_argument("--batch-size", type=int, default=256)
+    start_parser.add_argument("--model", default=DEFAULT_MODEL)
+    start_parser.add_argument("--index", default=DEFAULT_INDEX)
+    start_parser.add_argument("--shadow-index", default=None,
+                              help="also write every vector to this index (for cutover)")
+    resume_parser = commands.add_parser("resume")
+    resume_parser.add_argument("run_id")
+    resume_parser.add_argument("--workers", type=int, default=4)
+    commands.add_parser("status").add_argument("run_id")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        run = _database()["reembed_runs"].find_one({"id": args.run_id}, {"_id": 0, "ranges": 0})
+        print(json.dumps(run, default=str, indent=2))
+        sys.exit(0 if run else 1)
+
+    if args.command == "start":
+        run = create_run(args.workers, args.batch_size, args.model, args.index, args.shadow_index)
+        print(f"Re-embed run {run['id']}: {run['total']} products in {len(run['ranges'])} ranges "
+              f"(resume with: python reembed.py resume {run['id']})")
+        run_id = run["id"]
+    else:
+        run_id = args.run_id
+    print(execute(run_id, args.workers))
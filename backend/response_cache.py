@@ -0,0 +1,248 @@
+"""In-process response cache with ETag / Last-Modified revalidation.
+
+Read endpoints wrap their work like this:
+
+    cached = response_cache.lookup(request)
+    if cached:
+        return cached
+    ... build `content` ...
+    return response_cache.store(request, content, tags=[f"product:{product_id}"])
+
+Entries are keyed by route path and query parameters, expire after a TTL,
+and are evicted least-recently-used beyond a size bound. An endpoint whose
+response depends on less than its full query string (a region rather than
+exact coordinates, say) passes the same explicit `key=` to both calls.
+An endpoint that shares an intermediate result between requests and builds
+each response from it uses `lookup_value` / `store_value` instead.
+Write endpoints call `response_cache.invalidate(*tags)` to drop every entry
+carrying one of the tags. Both cached and freshly built responses honour If-None-Match and
+If-Modified-Since with a 304.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Any, Dict, Iterable, Optional, Set
+
+from fastapi import Request, Response
+
+from bson_response import dumps
+
+DEFAULT_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "60"))
+MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2048"))
+
+# Bound on remembered per-tag invalidation sequence numbers
+_MAX_TRACKED_TAGS = 50000
+
+CACHE_CONTROL = "private, no-cache"
+
+
+class _Entry:
+    __slots__ = ("body", "etag", "last_modified", "expires_at", "tags", "route", "status_code")
+
+    def __init__(self, body, etag, last_modified, expires_at, tags, route, status_code):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+        self.tags = tags
+        self.route = route
+        self.status_code = status_code
+
+
+class ResponseCache:
+    def __init__(self, ttl: float = DEFAULT_TTL, max_entries: int = MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.tag_index: Dict[str, Set[str]] = defaultdict(set)
+        # Sequence number of the last invalidation per tag, so a response
+        # built while one of its tags was invalidated is not stored
+        self.tag_invalidated_at: Dict[str, int] = {}
+        self.invalidated_floor = 0
+        self.sequence = 0
+        self.counters = defaultdict(lambda: {"hits": 0, "misses": 0, "not_modified": 0,
+                                             "stores": 0, "invalidations": 0, "evictions": 0})
+        self.lock = threading.Lock()
+
+    def key_for(self, request: Request) -> str:
+        params = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+        return f"{request.url.path}?{params}"
+
+    def lookup(self, request: Request, key: Optional[str] = None) -> Optional[Response]:
+        """Return a cached (or 304) response, or None on a miss"""
+        key = key or self.key_for(request)
+        route = _route_of(request)
+
+        with self.lock:
+            entry = self._get(request, key, route)
+            if entry is None:
+                return None
+            if _not_modified(request, entry.etag, entry.last_modified):
+                self.counters[route]["not_modified"] += 1
+                return _not_modified_response(entry.etag, entry.last_modified)
+
+        return _full_response(entry.body, entry.etag, entry.last_modified, entry.status_code)
+
+    def lookup_value(self, request: Request, key: str) -> Optional[Any]:
+        """Return a value cached with `store_value`, or None on a miss"""
+        with self.lock:
+            entry = self._get(request, key, _route_of(request))
+            return None if entry is None else entry.body
+
+    def store_value(self, request: Request, key: str, value: Any, tags: Iterable[str] = (),
+                    ttl: Optional[float] = None):
+        """Cache `value` as is (callers must not mutate it) under `key`"""
+        self._put(request, key, _Entry(value, None, None, None, set(tags), _route_of(request), None), ttl)
+
+    def store(self, request: Request, content, tags: Iterable[str] = (),
+              ttl: Optional[float] = None, status_code: int = 200, key: Optional[str] = None) -> Response:
+        """Serialize `content`, cache it under the request's key and respond"""
+        body = dumps(content)
+        etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        last_modified = float(int(time.time()))
+        self._put(request, key or self.key_for(request),
+                  _Entry(body, etag, last_modified, None, set(tags), _route_of(request), status_code), ttl)
+
+        if _not_modified(request, etag, last_modified):
+            return _not_modified_response(etag, last_modified)
+        return _full_response(body, etag, last_modified, status_code)
+
+    def invalidate(self, *tags: str) -> int:
+        """Drop every entry carrying any of `tags`; returns how many went"""
+        removed = 0
+        with self.lock:
+            self.sequence += 1
+            if len(self.tag_invalidated_at) > _MAX_TRACKED_TAGS:
+                # Forget individual tags; anything in flight is treated as stale
+                self.tag_invalidated_at.clear()
+                self.invalidated_floor = self.sequence
+            for tag in tags:
+                self.tag_invalidated_at[tag] = self.sequence
+                for key in list(self.tag_index.get(tag, ())):
+                    entry = self.entries.get(key)
+                    if entry is not None:
+                        self.counters[entry.route]["invalidations"] += 1
+                        self._remove(key)
+                        removed += 1
+                self.tag_index.pop(tag, None)
+        return removed
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tag_index.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            routes = {}
+            total_hits = total_lookups = 0
+            for route, counts in self.counters.items():
+                lookups = counts["hits"] + counts["misses"]
+                total_hits += counts["hits"]
+                total_lookups += lookups
+                routes[route] = dict(counts, hit_ratio=round(counts["hits"] / lookups, 4) if lookups else 0.0)
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hit_ratio": round(total_hits / total_lookups, 4) if total_lookups else 0.0,
+                "routes": routes,
+            }
+
+    def _get(self, request: Request, key: str, route: str) -> Optional[_Entry]:
+        # Caller holds the lock
+        request.state.cache_sequence = self.sequence
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires_at <= time.time():
+            self._remove(key)
+            entry = None
+
+        if entry is None:
+            self.counters[route]["misses"] += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.counters[route]["hits"] += 1
+        return entry
+
+    def _put(self, request: Request, key: str, entry: _Entry, ttl: Optional[float]):
+        """Insert an entry unless one of its tags was invalidated since the lookup"""
+        started_at = getattr(request.state, "cache_sequence", self.sequence)
+        entry.expires_at = time.time() + (self.ttl if ttl is None else ttl)
+
+        with self.lock:
+            stale = self.invalidated_floor > started_at or any(
+                self.tag_invalidated_at.get(tag, -1) > started_at for tag in entry.tags
+            )
+            if stale:
+                return
+            self._remove(key)
+            self.entries[key] = entry
+            for tag in entry.tags:
+                self.tag_index[tag].add(key)
+            self.counters[entry.route]["stores"] += 1
+
+            while len(self.entries) > self.max_entries:
+                oldest = next(iter(self.entries))
+                self.counters[self.entries[oldest].route]["evictions"] += 1
+                self._remove(oldest)
+
+    def _remove(self, key: str):
+        # Caller holds the lock
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry.tags:
+            keys = self.tag_index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tag_index[tag]
+
+
+def _route_of(request: Request) -> str:
+    route = request.scope.get("route")
+    return getattr(route, "path", request.url.path)
+
+
+def _http_date(timestamp: float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+
+def _not_modified(request: Request, etag: str, last_modified: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in candidates or etag in candidates
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return last_modified <= since
+    return False
+
+
+def _headers(etag: str, last_modified: float) -> dict:
+    return {
+        "ETag": etag,
+        "Last-Modified": _http_date(last_modified),
+        "Cache-Control": CACHE_CONTROL,
+    }
+
+
+def _not_modified_response(etag: str, last_modified: float) -> Response:
+    return Response(status_code=304, headers=_headers(etag, last_modified))
+
+
+def _full_response(body: bytes, etag: str, last_modified: float, status_code: int) -> Response:
+    return Response(content=body, status_code=status_code, media_type="application/json",
+                    headers=_headers(etag, last_modified))
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,195 @@
+"""Semantic product search over the vector index.
+
+The query text is embedded (through a small LRU of recent query vectors,
+so popular searches skip the model), and category, price range and
+location filters are sent with the vector query as Pinecone metadata
+filters. The index only returns matching products instead of the top K
+being filtered afterwards. Matches are then loaded from `products` with
+one `$in` read and returned in score order.
+
+Pinecone has no geo filter, so every vector carries `geo_cells`: the keys of
+the grid cells containing the product at a few cell sizes. A radius search
+asks for the cells covering the circle's bounding box at the finest size
+that needs at most MAX_COVER_CELLS cells, then drops the few products in the
+corners by exact distance. Those searches ask the index for
+RADIUS_OVERFETCH times as many matches, so trimming the corners still
+leaves `limit` results when enough products are in range.
+
+Categories are matched case-insensitively, as on `/products`: the vector
+metadata holds them lowercased (`normalize_categories`) and so does the
+filter. Vectors written before that need `python reembed.py`.
+"""
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+# Cell sizes in degrees: roughly 111 km, 28 km and 5.5 km at the equator
+GEO_CELL_DEGREES = [1.0, 0.25, 0.05]
+MAX_COVER_CELLS = 36
+RADIUS_OVERFETCH = int(os.getenv("SEARCH_RADIUS_OVERFETCH", "3"))
+EARTH_RADIUS_M = 6371000.0
+
+QUERY_CACHE_TTL = float(os.getenv("SEARCH_QUERY_CACHE_TTL", "3600"))
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_QUERY_CACHE_MAX_ENTRIES", "5000"))
+
+# These will be set in setup_search
+products_collection = None
+embed_query: Optional[Callable[[str], List[float]]] = None
+query_index: Optional[Callable[..., dict]] = None
+
+
+def setup_search(db, embed, query):
+    """Wire search to the database, the text embedder and the index query"""
+    global products_collection, embed_query, query_index
+    products_collection = db["products"]
+    embed_query = embed
+    query_index = query
+
+
+def normalize_categories(categories: List[str]) -> List[str]:
+    """Categories as stored in vector metadata and matched by filters"""
+    return sorted({c.strip().lower() for c in categories if c and c.strip()})
+
+
+def _cell(lat: float, lng: float, size: float) -> str:
+    return f"{size:g}:{math.floor(lat / size)}:{math.floor(lng / size)}"
+
+
+def geo_cells(lat: float, lng: float) -> List[str]:
+    """Vector metadata: the product's cell at every cell size"""
+    return [_cell(lat, lng, size) for size in GEO_CELL_DEGREES]
+
+
+def covering_cells(lat: float, lng: float, radius_m: float) -> List[str]:
+    """Cells that together cover a circle, at the finest size that needs
+    at most MAX_COVER_CELLS of them"""
+    dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+    dlng = dlat / max(math.cos(math.radians(lat)), 0.01)
+
+    for size in reversed(GEO_CELL_DEGREES):
+        rows = range(math.floor((lat - dlat) / size), math.floor((lat + dlat) / size) + 1)
+        cols = range(math.floor((lng - dlng) / size), math.floor((lng + dlng) / size) + 1)
+        if len(rows) * len(cols) <= MAX_COVER_CELLS or size == GEO_CELL_DEGREES[0]:
+            return [f"{size:g}:{row}:{col}" for row in rows for col in cols]
+    return []
+
+
+def distance_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def build_filter(categories: Optional[List[str]] = None, min_price: Optional[float] = None,
+                 max_price: Optional[float] = None, near: Optional[tuple] = None) -> Optional[dict]:
+    """Pinecone metadata filter; `near` is (lat, lng, radius_m)"""
+    clauses = []
+    if categories:
+        clauses.append({"categories": {"$in": normalize_categories(categories)}})
+    price = {}
+    if min_price is not None:
+        price["$gte"] = min_price
+    if max_price is not None:
+        price["$lte"] = max_price
+    if price:
+        clauses.append({"price": price})
+    if near:
+        clauses.append({"geo_cells": {"$in": covering_cells(*near)}})
+
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+class QueryEmbeddingCache:
+    """LRU of query vectors keyed by the normalized query text"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return re.sub(r"\s+", " ", query.strip().lower())
+
+    def get(self, query: str) -> List[float]:
+        key = self.normalize(query)
+        now = time.time()
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None and item[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+
+        vector = embed_query(key)
+        with self.lock:
+            self.entries[key] = (now + self.ttl, vector)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return vector
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0
+        }
+
+
+query_cache = QueryEmbeddingCache(QUERY_CACHE_TTL, QUERY_CACHE_MAX_ENTRIES)
+
+
+def search(query: str, limit: int = 20, categories: Optional[List[str]] = None,
+           min_price: Optional[float] = None, max_price: Optional[float] = None,
+           near: Optional[tuple] = None, projection: Optional[dict] = None) -> List[dict]:
+    """Products matching `query` best, with the filters applied in the index"""
+    vector = query_cache.get(query)
+    result = query_index(
+        vector=vector,
+        top_k=limit * RADIUS_OVERFETCH if near else limit,
+        include_values=False,
+        include_metadata=False,
+        filter=build_filter(categories, min_price, max_price, near)
+    )
+    scores = {match["id"]: match["score"] for match in result.get("matches", [])}
+    if not scores:
+        return []
+
+    products = {
+        product["id"]: product
+        for product in products_collection.find({"id": {"$in": list(scores)}}, projection)
+    }
+
+    results = []
+    for product_id, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+        product = products.get(product_id)
+        if product is None:
+            continue  # deleted, and vector_sync has not caught up yet
+        if near:
+            coordinates = (product.get("location") or {}).get("coordinates")
+            if not coordinates:
+                continue
+            distance = distance_m(near[0], near[1], coordinates[1], coordinates[0])
+            if distance > near[2]:
+                continue
+            product["distance_m"] = round(distance)
+        product["score"] = round(score, 4)
+        results.append(product)
+        if len(results) == limit:
+            break
+    return results
@@ -0,0 +1,284 @@
+"""Background propagation of denormalized user snapshots.
+
+Products embed a `user` snapshot, donations a `donor`, and chat rooms
+`buyer` and `seller` snapshots, so reads never need a join. When a user's
+name or avatar changes, the write endpoint only calls `enqueue_user(id)`.
+That upserts the id into the `snapshot_sync_queue` collection. The queue
+therefore survives restarts, and repeated edits coalesce into one entry.
+The worker reads queued ids oldest first and loads the current users with
+one `$in` query. It then rewrites the stale embedded copies in chunks of at
+most CHUNK_SIZE documents per collection, with one `bulk_write` per chunk.
+A token bucket charged per rewritten document paces the chunks, so neither
+a burst of profile edits nor one user with thousands of listings can flood
+the primary. An entry is removed only after its rewrite succeeded, and only
+if it was not re-queued in the meantime.
+
+When a batch fails, its entries are retried one by one. An entry that
+fails is retried with exponential backoff (`retry_at`), so it does not
+block the entries behind it. After MAX_ATTEMPTS failures it is moved to
+`snapshot_sync_dead_letters`.
+"""
+import asyncio
+import os
+import time
+from datetime import datetime
+from datetime import timedelta
+from typing import List, Optional, Tuple
+
+from pymongo import DeleteOne, UpdateMany
+
+BATCH_SIZE = int(os.getenv("SNAPSHOT_SYNC_BATCH_SIZE", "100"))
+# Maximum embedded copies rewritten per second, and per bulk_write
+DOCS_PER_SECOND = float(os.getenv("SNAPSHOT_SYNC_DOCS_PER_SECOND", "500"))
+CHUNK_SIZE = int(os.getenv("SNAPSHOT_SYNC_CHUNK_SIZE", "200"))
+# How long to wait for more changes to coalesce before flushing
+FLUSH_INTERVAL = float(os.getenv("SNAPSHOT_SYNC_FLUSH_INTERVAL", "1.0"))
+# Failures before an entry is dead-lettered, and the cap on its backoff
+MAX_ATTEMPTS = int(os.getenv("SNAPSHOT_SYNC_MAX_ATTEMPTS", "8"))
+MAX_RETRY_DELAY = 300.0
+
+# These will be set in setup_collection
+db = None
+queue_collection = None
+dead_letters_collection = None
+
+stats = {"users_propagated": 0, "operations": 0, "documents_modified": 0, "errors": 0,
+         "dead_lettered": 0, "last_flush_at": None}
+
+_wakeup = None
+_worker = None
+
+
+def setup_collection(database):
+    global db, queue_collection, dead_letters_collection
+    db = database
+    queue_collection = database["snapshot_sync_queue"]
+    dead_letters_collection = database["snapshot_sync_dead_letters"]
+
+
+def enqueue_user(user_id: str):
+    """Schedule the embedded copies of a user's name/avatar for a rewrite"""
+    if user_id:
+        now = datetime.utcnow()
+        # A new edit is due at once, even if an older one was backing off
+        queue_collection.update_one(
+            {"user_id": user_id}, {"$set": {"enqueued_at": now, "retry_at": now, "attempts": 0}}, upsert=True
+        )
+        _notify()
+
+
+def _notify():
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+# Rewrite = (collection, owner id field, filter for stale copies, update)
+Rewrite = Tuple[str, str, dict, dict]
+
+
+def user_rewrites(user: dict) -> List[Rewrite]:
+    """The embedded copies of `user` and how to bring them up to date"""
+    user_id = user["id"]
+    name = user.get("name", "User")
+    avatar = user.get("avatar", "")
+    snapshot = {"id": user_id, "name": name, "avatar": avatar}
+    return [
+        ("products", "user.id",
+         {"user.id": user_id, "$or": [{"user.name": {"$ne": name}}, {"user.avatar": {"$ne": avatar}}]},
+         {"$set": {"user.name": name, "user.avatar": avatar}}),
+        ("donated_products", "donor.id",
+         {"donor.id": user_id, "$or": [{"donor.name": {"$ne": name}}, {"donor.avatar": {"$ne": avatar}}]},
+         {"$set": {"donor.name": name, "donor.avatar": avatar}}),
+        ("chat_rooms", "buyer_id", {"buyer_id": user_id, "buyer": {"$ne": snapshot}}, {"$set": {"buyer": snapshot}}),
+        ("chat_rooms", "seller_id", {"seller_id": user_id, "seller": {"$ne": snapshot}}, {"$set": {"seller": snapshot}}),
+    ]
+
+
+def _field(document: dict, path: str):
+    for part in path.split("."):
+        document = (document or {}).get(part)
+    return document
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    async def take(self, amount: float):
+        amount = min(amount, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+_bucket = _TokenBucket(DOCS_PER_SECOND, max(DOCS_PER_SECOND, CHUNK_SIZE))
+
+
+async def _rewrite(rewrites: List[Rewrite]):
+    """Apply rewrites of one kind (same collection and owner field) chunk by chunk"""
+    collection, owner_field = rewrites[0][0], rewrites[0][1]
+    updates = {stale[owner_field]: update for _, _, stale, update in rewrites}
+    stale = {"$or": [stale for _, _, stale, _ in rewrites]}
+
+    while True:
+        documents = await asyncio.to_thread(
+            lambda: list(db[collection].find(stale, {"_id": 1, owner_field: 1}).limit(CHUNK_SIZE))
+        )
+        if not documents:
+            return
+        by_owner = {}
+        for document in documents:
+            by_owner.setdefault(_field(document, owner_field), []).append(document["_id"])
+        operations = [UpdateMany({"_id": {"$in": ids}}, updates[owner]) for owner, ids in by_owner.items()]
+
+        await _bucket.take(len(documents))
+        result = await asyncio.to_thread(db[collection].bulk_write, operations, ordered=False)
+        stats["operations"] += len(operations)
+        stats["documents_modified"] += result.modified_count
+        if len(documents) < CHUNK_SIZE:
+            return
+
+
+async def _propagate(user_ids: List[str]) -> int:
+    users = await asyncio.to_thread(
+        lambda: list(db["users"].find({"id": {"$in": user_ids}}, {"_id": 0, "id": 1, "name": 1, "avatar": 1}))
+    )
+
+    by_kind = {}
+    for user in users:
+        for rewrite in user_rewrites(user):
+            by_kind.setdefault(rewrite[:2], []).append(rewrite)
+    for rewrites in by_kind.values():
+        await _rewrite(rewrites)
+    return len(users)
+
+
+def _retry_delay(attempts: int) -> float:
+    return min(MAX_RETRY_DELAY, FLUSH_INTERVAL * 2 ** attempts)
+
+
+def _record_failure(entry: dict, error: Exception):
+    """Back an entry off, or dead-letter it once it has failed MAX_ATTEMPTS times"""
+    attempts = entry.get("attempts", 0) + 1
+    # Matching enqueued_at leaves an entry alone if it was re-queued meanwhile
+    current = {"_id": entry["_id"], "enqueued_at": entry["enqueued_at"]}
+    if attempts < MAX_ATTEMPTS:
+        queue_collection.update_one(current, {"$set": {
+            "attempts": attempts, "error": str(error),
+            "retry_at": datetime.utcnow() + timedelta(seconds=_retry_delay(attempts))
+        }})
+        return
+
+    dead_letters_collection.update_one(
+        {"user_id": entry["user_id"]},
+        {"$set": {"error": str(error), "attempts": attempts, "failed_at": datetime.utcnow()}},
+        upsert=True
+    )
+    queue_collection.delete_one(current)
+    stats["dead_lettered"] += 1
+    print(f"Dead-lettered snapshot sync for user {entry['user_id']} after {attempts} attempts: {str(error)}")
+
+
+async def _propagate_each(entries: List[dict]):
+    """Retry a failed batch one entry at a time, so one bad entry fails alone"""
+    for entry in entries:
+        try:
+            stats["users_propagated"] += await _propagate([entry["user_id"]])
+            await asyncio.to_thread(
+                queue_collection.delete_one, {"_id": entry["_id"], "enqueued_at": entry["enqueued_at"]}
+            )
+        except Exception as e:
+            stats["errors"] += 1
+            print(f"Error propagating snapshot of user {entry['user_id']}: {str(e)}")
+            await asyncio.to_thread(_record_failure, entry, e)
+
+
+async def flush() -> Optional[float]:
+    """Propagate every entry that is due; returns seconds until the next
+    backed-off entry is due, or None when nothing is waiting"""
+    while True:
+        now = datetime.utcnow()
+        try:
+            # Entries queued before retry_at existed have none and are due
+            entries = await asyncio.to_thread(
+                lambda: list(queue_collection.find({"retry_at": {"$not": {"$gt": now}}},
+                                                   {"user_id": 1, "enqueued_at": 1, "attempts": 1})
+                             .sort("retry_at", 1).limit(BATCH_SIZE))
+            )
+            if not entries:
+                break
+            try:
+                stats["users_propagated"] += await _propagate([e["user_id"] for e in entries])
+            except Exception as e:
+                stats["errors"] += 1
+                print(f"Error propagating user snapshots: {str(e)}")
+                await _propagate_each(entries)
+                continue
+            # An entry re-queued during the rewrite keeps its newer timestamp and stays
+            await asyncio.to_thread(queue_collection.bulk_write, [
+                DeleteOne({"_id": e["_id"], "enqueued_at": e["enqueued_at"]}) for e in entries
+            ], ordered=False)
+        except Exception as e:
+            # The queue itself is unreachable: try again after a pause
+            stats["errors"] += 1
+            print(f"Error reading the snapshot sync queue: {str(e)}")
+            stats["last_flush_at"] = time.time()
+            return _retry_delay(1)
+    stats["last_flush_at"] = time.time()
+
+    upcoming = await asyncio.to_thread(
+        queue_collection.find_one, {"retry_at": {"$gt": datetime.utcnow()}}, {"retry_at": 1}, sort=[("retry_at", 1)]
+    )
+    if upcoming is None:
+        return None
+    return max((upcoming["retry_at"] - datetime.utcnow()).total_seconds(), 0)
+
+
+async def _run():
+    delay = None
+    while True:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        # Give closely spaced edits a moment to coalesce
+        await asyncio.sleep(FLUSH_INTERVAL)
+        _wakeup.clear()
+        delay = await flush()
+
+
+def start():
+    """Start the background worker (called on app startup)"""
+    global _wakeup, _worker
+    if _worker is not None:
+        return
+    _wakeup = asyncio.Event()
+    # Pick up whatever was queued before the last shutdown
+    _wakeup.set()
+    _worker = asyncio.create_task(_run())
+
+
+async def stop():
+    """Stop the worker, propagating whatever is still queued"""
+    global _worker
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+        _worker = None
+    await flush()
+
+
+def get_stats() -> dict:
+    return dict(stats, pending_users=queue_collection.estimated_document_count(),
+                dead_letters=dead_letters_collection.estimated_document_count())
@@ -0,0 +1,143 @@
+"""Claim, reservation and waitlist races in donation_service.
+
+mongomock does not make a single find_one_and_update atomic across threads
+the way mongod does for one document, so the collection is wrapped to run
+each call under a lock. The races under test are between calls. The
+wrapper also returns the updated document by `_id`: mongomock re-runs the
+filter for ReturnDocument.AFTER, which misses when the update changed a
+filtered field (as every claim does).
+"""
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+from pymongo import ReturnDocument
+
+import donation_service
+from donation_service import claim, release, reserve
+
+THREADS = 16
+
+
+class AtomicCollection:
+    def __init__(self, collection):
+        self.collection = collection
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+
+        def locked(*args, **kwargs):
+            with self.lock:
+                return method(*args, **kwargs)
+        return locked
+
+    def find_one_and_update(self, filter, update, projection=None,
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        with self.lock:
+            if return_document == ReturnDocument.BEFORE:
+                return self.collection.find_one_and_update(filter, update, projection, **kwargs)
+            before = self.collection.find_one_and_update(filter, update, {"_id": 1}, **kwargs)
+            return None if before is None else self.collection.find_one({"_id": before["_id"]}, projection)
+
+
+@pytest.fixture
+def donations(monkeypatch):
+    collection = mongomock.MongoClient().db["donated_products"]
+    monkeypatch.setattr(donation_service, "donated_products_collection", AtomicCollection(collection))
+    collection.insert_one({"id": "d1", "is_available": True, "reservation": None, "waitlist": []})
+    return collection
+
+
+def _user(i):
+    return donation_service._person(f"u{i}", f"User {i}", f"u{i}@example.com", "")
+
+
+def _all_at_once(call, users):
+    barrier = threading.Barrier(len(users))
+
+    def run(user):
+        barrier.wait()
+        return user["id"], call("d1", user)[0]
+
+    with ThreadPoolExecutor(len(users)) as pool:
+        return list(pool.map(run, users))
+
+
+def _expire_reservation(collection):
+    collection.update_one({"id": "d1"},
+                          {"$set": {"reservation.expires_at": datetime.utcnow() - timedelta(seconds=1)}})
+
+
+def test_concurrent_claims_have_one_winner(donations):
+    outcomes = dict(_all_at_once(claim, [_user(i) for i in range(THREADS)]))
+
+    assert Counter(outcomes.values()) == {"claimed": 1, "unavailable": THREADS - 1}
+    winner = next(user_id for user_id, outcome in outcomes.items() if outcome == "claimed")
+    assert donations.find_one({"id": "d1"})["claim"]["claimed_by"]["id"] == winner
+
+
+def test_concurrent_reservations_form_one_holder_and_a_bounded_waitlist(donations, monkeypatch):
+    monkeypatch.setattr(donation_service, "WAITLIST_LIMIT", 5)
+
+    outcomes = dict(_all_at_once(reserve, [_user(i) for i in range(THREADS)]))
+
+    assert Counter(outcomes.values()) == {"reserved": 1, "waitlisted": 5, "waitlist_full": THREADS - 6}
+    donation = donations.find_one({"id": "d1"})
+    holder = next(user_id for user_id, outcome in outcomes.items() if outcome == "reserved")
+    assert donation["reservation"]["user"]["id"] == holder
+    waitlist = [w["id"] for w in donation["waitlist"]]
+    assert sorted(waitlist) == sorted(u for u, outcome in outcomes.items() if outcome == "waitlisted")
+    assert holder not in waitlist
+
+
+def test_only_the_holder_can_claim_a_reserved_donation(donations):
+    reserve("d1", _user(1))
+    reserve("d1", _user(2))
+
+    outcomes = dict(_all_at_once(claim, [_user(i) for i in range(THREADS)]))
+
+    assert outcomes["u1"] == "claimed"
+    # Losers see the reservation or, after u1's claim, a claimed donation
+    assert Counter(outcomes.values())["claimed"] == 1
+    assert set(outcomes.values()) <= {"claimed", "reserved", "unavailable"}
+    assert donations.find_one({"id": "d1"})["claim"]["claimed_by"]["id"] == "u1"
+
+
+def test_lapsed_reservation_passes_to_the_head_of_the_waitlist(donations):
+    reserve("d1", _user(1))
+    reserve("d1", _user(2))
+    reserve("d1", _user(3))
+    _expire_reservation(donations)
+
+    # A stranger racing the waitlist does not get in ahead of it
+    outcomes = dict(_all_at_once(claim, [_user(2), _user(9)]))
+
+    assert outcomes["u2"] == "claimed"
+    assert outcomes["u9"] in ("reserved", "unavailable")
+    assert donations.find_one({"id": "d1"})["claim"]["claimed_by"]["id"] == "u2"
+
+
+def test_release_promotes_the_next_in_line(donations):
+    reserve("d1", _user(1))
+    reserve("d1", _user(2))
+    reserve("d1", _user(3))
+
+    assert release("d1", "u1")
+    donation = donations.find_one({"id": "d1"})
+    assert donation["reservation"]["user"]["id"] == "u2"
+    assert [w["id"] for w in donation["waitlist"]] == ["u3"]
+    assert claim("d1", _user(3))[0] == "reserved"
+    assert claim("d1", _user(2))[0] == "claimed"
+
+
+def test_waitlisted_user_cannot_join_twice(donations):
+    reserve("d1", _user(1))
+
+    outcomes = _all_at_once(reserve, [_user(2)] * 4)
+
+    assert outcomes == [("u2", "waitlisted")] * 4
+    assert [w["id"] for w in donations.find_one({"id": "d1"})["waitlist"]] == ["u2"]
@@ -0,0 +1,152 @@
+"""index_manager catalog reconciliation and explain-plan verification,
+against in-memory stand-ins for a collection and `db.command("explain")`.
+
+mongomock drops index collations from index_information(), so the
+collection stand-in keeps index documents the way mongod reports them.
+"""
+from pymongo.collation import Collation
+
+import index_manager
+from index_manager import INDEXES, apply_indexes, missing_indexes, verify_query_plans
+
+
+class FakeCollection:
+    def __init__(self):
+        self.indexes = {"_id_": {"key": [("_id", 1)], "v": 2}}
+
+    def index_information(self):
+        return {name: dict(info) for name, info in self.indexes.items()}
+
+    def create_indexes(self, models):
+        names = []
+        for model in models:
+            document = dict(model.document)
+            name = document.pop("name")
+            info = {"key": list(document.pop("key").items()), "v": 2}
+            collation = document.pop("collation", None)
+            if isinstance(collation, Collation):
+                collation = collation.document
+            if collation:
+                # mongod reports every collation field, defaults included
+                info["collation"] = {"locale": collation["locale"], "caseLevel": False,
+                                     "strength": collation.get("strength", 3), "version": "57.1"}
+            info.update(document)
+            self.indexes[name] = info
+            names.append(name)
+        return names
+
+    def drop_index(self, name):
+        del self.indexes[name]
+
+
+class FakeDb(dict):
+    def __missing__(self, name):
+        self[name] = FakeCollection()
+        return self[name]
+
+
+def test_apply_builds_catalog_once():
+    db = FakeDb()
+
+    first = apply_indexes(db)
+    assert all(not r["conflicts"] and not r["extra"] for r in first.values())
+    assert missing_indexes(db) == []
+
+    second = apply_indexes(db)
+    assert all(not r["created"] and not r["extra"] for r in second.values())
+
+
+def test_uncollated_category_index_is_not_the_collated_one():
+    db = FakeDb()
+    db["products"].indexes["categories_1_view_count_-1"] = {
+        "key": [("categories", 1), ("view_count", -1)], "v": 2
+    }
+
+    assert ("products", "categories_1_view_count_-1_ci") in missing_indexes(db)
+
+    report = apply_indexes(db, prune=True, collections=["products"])["products"]
+    assert "categories_1_view_count_-1_ci" in report["created"]
+    assert report["dropped"] == ["categories_1_view_count_-1"]
+    assert "collation" in db["products"].indexes["categories_1_view_count_-1_ci"]
+
+
+def test_option_mismatch_is_a_conflict_and_left_in_place():
+    db = FakeDb()
+    db["users"].indexes["id_1"] = {"key": [("id", 1)], "v": 2}
+
+    report = apply_indexes(db, collections=["users"])["users"]
+    assert report["conflicts"] == ["id_1"]
+    assert "unique" not in db["users"].indexes["id_1"]
+
+
+def test_extra_indexes_are_only_dropped_on_prune():
+    db = FakeDb()
+    db["messages"].indexes["sender_id_1"] = {"key": [("sender_id", 1)], "v": 2}
+
+    report = apply_indexes(db, collections=["messages"])["messages"]
+    assert report["extra"] == ["sender_id_1"] and report["dropped"] == []
+    assert "sender_id_1" in db["messages"].indexes
+
+
+def test_every_catalog_index_has_a_unique_name():
+    for name, models in INDEXES.items():
+        names = [model.document["name"] for model in models]
+        assert len(names) == len(set(names)), name
+
+
+class ExplainDb:
+    """Answers explain with a canned plan per command"""
+
+    def __init__(self, explain):
+        self.explain = explain
+        self.commands = []
+
+    def command(self, name, command, verbosity=None):
+        assert name == "explain"
+        self.commands.append(command)
+        return self.explain(command)
+
+
+def _find_plan(stage, n_returned, examined):
+    return {"queryPlanner": {"winningPlan": {"stage": "LIMIT", "inputStage": {"stage": stage}}},
+            "executionStats": {"nReturned": n_returned, "totalKeysExamined": examined,
+                               "totalDocsExamined": examined}}
+
+
+def test_verify_flags_collection_scans_and_examined_budget():
+    shapes = [
+        {"name": "indexed", "collection": "products", "filter": {"id": "x"}, "limit": 1},
+        {"name": "scan", "collection": "products", "filter": {"price": 1}},
+        {"name": "wide", "collection": "products", "filter": {"user.id": "u"}, "limit": 10},
+    ]
+    plans = {"indexed": _find_plan("IXSCAN", 1, 1), "scan": _find_plan("COLLSCAN", 1, 500),
+             "wide": _find_plan("IXSCAN", 10, 400)}
+    db = ExplainDb(lambda command: plans[next(s["name"] for s in shapes if s["filter"] == command["filter"])])
+
+    failures = verify_query_plans(db, shapes)
+    assert failures == [
+        ("scan", "COLLSCAN in plan ['LIMIT', 'COLLSCAN']"),
+        ("wide", "keys_examined=400 exceeds 25 for 10 returned"),
+        ("wide", "docs_examined=400 exceeds 25 for 10 returned"),
+    ]
+
+
+def test_explain_sends_collation_and_reads_geo_near_cursor_stage():
+    shape = {"name": "feed", "collection": "donated_products", "collation": {"locale": "en", "strength": 2},
+             "pipeline": [{"$geoNear": {"near": {"type": "Point", "coordinates": [0, 0]}, "key": "location",
+                                        "distanceField": "distance_m", "spherical": True}}]}
+    cursor_stage = {"queryPlanner": {"winningPlan": {"stage": "GEO_NEAR_2DSPHERE"}},
+                    "executionStats": {"nReturned": 3, "totalKeysExamined": 7, "totalDocsExamined": 3}}
+    db = ExplainDb(lambda command: {"stages": [{"$geoNearCursor": cursor_stage}, {"$limit": 3}]})
+
+    summary = index_manager.explain_shape(db, shape)
+    assert db.commands[0]["aggregate"] == "donated_products"
+    assert db.commands[0]["collation"] == {"locale": "en", "strength": 2}
+    assert summary == {"stages": ["GEO_NEAR_2DSPHERE"], "n_returned": 3, "keys_examined": 7,
+                       "docs_examined": 3}
+
+
+def test_query_shapes_pass_collation_wherever_they_filter_on_categories():
+    for shape in index_manager.QUERY_SHAPES:
+        if shape["collection"] == "products" and "categories" in shape.get("filter", {}):
+            assert shape.get("collation") == index_manager.CATEGORY_COLLATION.document, shape["name"]
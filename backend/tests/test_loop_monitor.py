@@ -0,0 +1,70 @@
+"""LoopMonitor stall detection on a real event loop, with blocking calls
+made from a fake ASGI handler."""
+import asyncio
+import re
+import sys
+import time
+
+import pytest
+
+from loop_monitor import BlockingCallError, LoopMonitor, request_for_stack
+
+
+class Route:
+    path = "/products/{product_id}"
+
+
+async def blocking_handler(seconds):
+    # Named like the ASGI argument the monitor looks for on the stack
+    scope = {"type": "http", "method": "GET", "path": "/products/p1", "route": Route()}
+    time.sleep(seconds)
+    return scope
+
+
+def run_with_monitor(monitor, body):
+    async def main():
+        monitor.start()
+        try:
+            # Let the ticker arm before blocking
+            await asyncio.sleep(monitor.interval * 2)
+            await body()
+            await asyncio.sleep(monitor.interval * 2)
+        finally:
+            await monitor.stop()
+
+    asyncio.run(main())
+
+
+def test_stall_is_attributed_to_the_route_on_the_stack():
+    monitor = LoopMonitor(interval=0.02, threshold=0.05, fail_threshold=None)
+
+    run_with_monitor(monitor, lambda: blocking_handler(0.3))
+
+    stalls = monitor.report()["recent_stalls"]
+    assert len(stalls) == 1
+    stall = stalls[0]
+    assert (stall["method"], stall["path"], stall["route"]) == ("GET", "/products/p1", "/products/{product_id}")
+    assert stall["duration_ms"] >= 200
+    assert any("time.sleep" in line for line in stall["stack"])
+
+
+def test_short_pauses_are_not_stalls():
+    monitor = LoopMonitor(interval=0.02, threshold=0.2, fail_threshold=None)
+
+    run_with_monitor(monitor, lambda: blocking_handler(0.01))
+
+    report = monitor.report()
+    assert report["stalls"] == 0 and report["recent_stalls"] == []
+    assert report["ticks"] > 0
+
+
+def test_stop_raises_for_stalls_over_the_fail_threshold():
+    monitor = LoopMonitor(interval=0.02, threshold=0.05, fail_threshold=0.1)
+
+    with pytest.raises(BlockingCallError, match=re.escape("/products/{product_id}")):
+        run_with_monitor(monitor, lambda: blocking_handler(0.3))
+    assert monitor.violations == []
+
+
+def test_background_work_has_no_route():
+    assert request_for_stack(sys._getframe())["route"] == "background"
@@ -0,0 +1,97 @@
+"""Retry classification in media_uploader, against a stub store."""
+import asyncio
+import errno
+import socket
+
+import cloudinary.exceptions
+import pytest
+import requests
+
+from media_uploader import MediaUploader, MediaUploadError, is_transient
+from upload_spool import SpooledUpload
+
+
+@pytest.mark.parametrize("error", [
+    requests.exceptions.ConnectionError("Connection aborted"),
+    requests.exceptions.ReadTimeout("Read timed out"),
+    ConnectionResetError(errno.ECONNRESET, "Connection reset by peer"),
+    TimeoutError(),
+    socket.timeout("timed out"),
+    cloudinary.exceptions.RateLimited("Rate limit exceeded"),
+    cloudinary.exceptions.GeneralError("Bad gateway"),
+    cloudinary.exceptions.Error("Socket error: ConnectionResetError(104)"),
+    cloudinary.exceptions.Error("Unexpected error - MaxRetryError"),
+])
+def test_network_failures_are_transient(error):
+    assert is_transient(error)
+
+
+@pytest.mark.parametrize("error", [
+    FileNotFoundError(errno.ENOENT, "No such file or directory"),
+    PermissionError(errno.EACCES, "Permission denied"),
+    OSError(errno.ENOSPC, "No space left on device"),
+    cloudinary.exceptions.BadRequest("Invalid image file"),
+    cloudinary.exceptions.AuthorizationRequired("Invalid API key"),
+    cloudinary.exceptions.Error("Invalid Signature"),
+    ValueError("bad folder"),
+])
+def test_other_failures_are_not_transient(error):
+    assert not is_transient(error)
+
+
+@pytest.fixture
+def spooled(tmp_path):
+    path = tmp_path / "image.jpg"
+    path.write_bytes(b"image")
+    return SpooledUpload(str(path), "image.jpg", 5, "digest", "jpg")
+
+
+def _uploader(errors):
+    calls = []
+
+    def put(contents, folder="", digest=None):
+        calls.append(bytes(contents))
+        if errors:
+            raise errors.pop(0)
+        return {"url": f"https://stub/{digest}.jpg", "public_id": digest}
+
+    return MediaUploader(put=put, max_attempts=3, base_delay=0, max_delay=0), calls
+
+
+def test_transient_failures_are_retried(spooled):
+    uploader, calls = _uploader([ConnectionResetError(), requests.exceptions.Timeout()])
+
+    result = asyncio.run(uploader.upload(spooled, "check"))
+
+    assert result["public_id"] == "digest"
+    assert calls == [b"image"] * 3
+
+
+def test_permanent_failure_is_not_retried(spooled):
+    uploader, calls = _uploader([PermissionError(errno.EACCES, "Permission denied")])
+
+    with pytest.raises(MediaUploadError) as raised:
+        asyncio.run(uploader.upload(spooled, "check"))
+
+    assert (raised.value.transient, raised.value.attempts) == (False, 1)
+    assert len(calls) == 1
+
+
+def test_exhausted_retries_report_a_transient_error(spooled):
+    uploader, calls = _uploader([TimeoutError()] * 3)
+
+    with pytest.raises(MediaUploadError) as raised:
+        asyncio.run(uploader.upload(spooled, "check"))
+
+    assert (raised.value.transient, raised.value.attempts) == (True, 3)
+    assert len(calls) == 3
+
+
+def test_missing_spool_file_fails_without_retrying(tmp_path):
+    uploader, calls = _uploader([])
+    missing = SpooledUpload(str(tmp_path / "gone.jpg"), "gone.jpg", 5, "gone", "jpg")
+
+    with pytest.raises(MediaUploadError) as raised:
+        asyncio.run(uploader.upload(missing, "check"))
+
+    assert raised.value.transient is False and calls == []
@@ -0,0 +1,120 @@
+"""vector_sync batching and dead-lettering, with mongomock for the state
+collections and an in-memory dict for the vector index."""
+import mongomock
+import pytest
+from bson import Timestamp
+
+import vector_sync
+
+
+class FakeIndex:
+    def __init__(self, rejected=()):
+        self.records = {}
+        self.rejected = set(rejected)
+
+    def upsert(self, records):
+        for record in records:
+            # Stands in for the index rejecting oversized metadata
+            if record["id"] in self.rejected:
+                raise ValueError("Metadata size exceeds the limit")
+        self.records.update({r["id"]: r for r in records})
+
+    def delete(self, ids):
+        for product_id in ids:
+            self.records.pop(product_id, None)
+
+
+@pytest.fixture
+def sync(monkeypatch):
+    db = mongomock.MongoClient().db
+    index = FakeIndex()
+    monkeypatch.setattr(vector_sync, "products_collection", db["products"])
+    monkeypatch.setattr(vector_sync, "state_collection", db["sync_state"])
+    monkeypatch.setattr(vector_sync, "dead_letters_collection", db["vector_sync_dead_letters"])
+    monkeypatch.setattr(vector_sync, "embed_batch", lambda texts: [[float(len(t)), 1.0] for t in texts])
+    monkeypatch.setattr(vector_sync, "upsert_vectors", index.upsert)
+    monkeypatch.setattr(vector_sync, "delete_vectors", index.delete)
+    monkeypatch.setattr(vector_sync, "upsert_image_vectors", None)
+    monkeypatch.setattr(vector_sync, "MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(vector_sync, "_attempts", 0)
+    monkeypatch.setattr(vector_sync, "pending", {})
+    monkeypatch.setattr(vector_sync, "stats", dict(vector_sync.stats, batches=0, upserts=0, deletes=0,
+                                                   skipped_deletes=0, dead_lettered=0,
+                                                   oldest_pending_at=None))
+    return db, index
+
+
+def _product(i, **fields):
+    return dict({"id": f"p{i}", "name": f"Item {i}", "description": "desc", "price": i,
+                 "categories": ["other"], "images": [], "image_categories": []}, **fields)
+
+
+def test_flush_applies_batch_and_saves_token(sync):
+    db, index = sync
+    index.records["p9"] = {"id": "p9"}
+    vector_sync.pending.update({"p1": _product(1), "p2": _product(2), "p9": None})
+
+    vector_sync._flush({"_data": "t1"})
+
+    assert set(index.records) == {"p1", "p2"}
+    assert index.records["p1"]["metadata"]["productName"] == "Item 1"
+    assert vector_sync._load_token() == {"_data": "t1"}
+    assert vector_sync.pending == {}
+    assert (vector_sync.stats["upserts"], vector_sync.stats["deletes"]) == (2, 1)
+
+
+def test_failing_batch_is_retried_then_dead_lettered(sync):
+    db, index = sync
+    index.rejected.add("p2")
+    batch = {"p1": _product(1), "p2": _product(2), "p3": _product(3)}
+    vector_sync._save_token({"_data": "t0"})
+
+    # Earlier attempts re-raise so the consumer replays from the saved token
+    for attempt in range(1, vector_sync.MAX_ATTEMPTS):
+        vector_sync.pending.update(batch)
+        with pytest.raises(ValueError):
+            vector_sync._flush({"_data": "t1"})
+        assert vector_sync._attempts == attempt
+        assert vector_sync._load_token() == {"_data": "t0"}
+        vector_sync.pending.clear()
+
+    vector_sync.pending.update(batch)
+    vector_sync._flush({"_data": "t1"})
+
+    assert set(index.records) == {"p1", "p3"}
+    dead = list(db["vector_sync_dead_letters"].find({}, {"_id": 0, "product_id": 1, "operation": 1}))
+    assert dead == [{"product_id": "p2", "operation": "upsert"}]
+    assert vector_sync.stats["dead_lettered"] == 1
+    assert vector_sync._attempts == 0
+    assert vector_sync._load_token() == {"_data": "t1"}
+
+
+def test_recovered_batch_resets_attempts(sync):
+    db, index = sync
+    index.rejected.add("p1")
+    vector_sync.pending["p1"] = _product(1)
+    with pytest.raises(ValueError):
+        vector_sync._flush({"_data": "t1"})
+
+    index.rejected.clear()
+    vector_sync._flush({"_data": "t1"})
+
+    assert vector_sync._attempts == 0
+    assert "p1" in index.records
+    assert db["vector_sync_dead_letters"].count_documents({}) == 0
+
+
+def test_collect_keeps_latest_state_per_product(sync):
+    def change(operation, document=None, before=None):
+        return {"operationType": operation, "fullDocument": document,
+                "fullDocumentBeforeChange": before, "clusterTime": Timestamp(1700000000, 1)}
+
+    vector_sync._collect(change("insert", _product(1)))
+    vector_sync._collect(change("update", _product(1, name="Renamed")))
+    vector_sync._collect(change("delete", before={"id": "p2"}))
+    vector_sync._collect(change("delete", before=None))
+
+    assert vector_sync.pending["p1"]["name"] == "Renamed"
+    assert vector_sync.pending["p2"] is None
+    assert vector_sync.stats["skipped_deletes"] == 1
+    assert vector_sync.stats["oldest_pending_at"] == 1700000000
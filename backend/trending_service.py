@@ -0,0 +1,390 @@
+import asyncio
+import heapq
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from index_manager import CATEGORY_COLLATION
+
+# Tunables (can be overridden through the environment)
+HALF_LIFE_HOURS = float(os.getenv("TRENDING_HALF_LIFE_HOURS", "24"))
+TOP_K = int(os.getenv("TRENDING_TOP_K", "100"))
+REGION_DEGREES = float(os.getenv("TRENDING_REGION_DEGREES", "1.0"))
+
+# How far back to replay product_views when warming the engine on startup
+WARM_HALF_LIVES = 7
+
+# Scores are kept relative to a reference time so that ordering never changes
+# as time passes. Once the exponent grows past this we rebase everything.
+_MAX_EXPONENT = 600.0
+
+# Decayed scores below this are dropped during pruning
+_MIN_SCORE = 1e-3
+
+# How often the background task prunes decayed products
+PRUNE_INTERVAL = float(os.getenv("TRENDING_PRUNE_INTERVAL_SECONDS", "600"))
+
+Bucket = Tuple[Optional[str], Optional[str]]
+
+
+def region_for(location) -> Optional[str]:
+    """Map a GeoJSON point (or a [lng, lat] pair) to a coarse grid cell key"""
+    if not location:
+        return None
+    coords = location.get("coordinates") if isinstance(location, dict) else location
+    try:
+        lng, lat = float(coords[0]), float(coords[1])
+    except (TypeError, ValueError, IndexError):
+        return None
+    return region_for_point(lat, lng)
+
+
+def region_for_point(lat: Optional[float], lng: Optional[float]) -> Optional[str]:
+    if lat is None or lng is None:
+        return None
+    row = math.floor(lat / REGION_DEGREES)
+    col = math.floor(lng / REGION_DEGREES)
+    return f"{row}:{col}"
+
+
+def region_polygon(region: str) -> dict:
+    """GeoJSON polygon of a region cell"""
+    row, col = (int(part) for part in region.split(":"))
+    south, west = row * REGION_DEGREES, col * REGION_DEGREES
+    north, east = south + REGION_DEGREES, west + REGION_DEGREES
+    return {"type": "Polygon",
+            "coordinates": [[[west, south], [east, south], [east, north], [west, north], [west, south]]]}
+
+
+class _TopK:
+    """Bounded min-heap of the K highest scoring products in one bucket.
+
+    Scores only ever grow (they are stored relative to the engine's reference
+    time), so an update either bumps an existing member or may displace the
+    current minimum. Bumped members leave stale heap entries behind which are
+    skipped on eviction and compacted once the heap grows too large.
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self.members: Dict[str, float] = {}
+        self.heap: List[Tuple[float, str]] = []
+
+    def offer(self, product_id: str, score: float):
+        if product_id in self.members:
+            self.members[product_id] = score
+            heapq.heappush(self.heap, (score, product_id))
+            if len(self.heap) > 4 * self.k:
+                self._compact()
+            return
+
+        if len(self.members) < self.k:
+            self.members[product_id] = score
+            heapq.heappush(self.heap, (score, product_id))
+            return
+
+        if score <= self._min_score():
+            return
+
+        self._evict_min()
+        self.members[product_id] = score
+        heapq.heappush(self.heap, (score, product_id))
+
+    def discard(self, product_id: str):
+        # Stale heap entries are skipped lazily
+        self.members.pop(product_id, None)
+
+    def ranked(self) -> List[Tuple[str, float]]:
+        return sorted(self.members.items(), key=lambda item: item[1], reverse=True)
+
+    def rescale(self, factor: float):
+        self.members = {pid: score * factor for pid, score in self.members.items()}
+        self._compact()
+
+    def _min_score(self) -> float:
+        self._drop_stale()
+        return self.heap[0][0] if self.heap else 0.0
+
+    def _evict_min(self):
+        self._drop_stale()
+        if self.heap:
+            _, product_id = heapq.heappop(self.heap)
+            self.members.pop(product_id, None)
+
+    def _drop_stale(self):
+        while self.heap:
+            score, product_id = self.heap[0]
+            if self.members.get(product_id) == score:
+                return
+            heapq.heappop(self.heap)
+
+    def _compact(self):
+        self.heap = [(score, pid) for pid, score in self.members.items()]
+        heapq.heapify(self.heap)
+
+
+class TrendingEngine:
+    """Exponentially decayed popularity scores with per-bucket top-K heaps.
+
+    Every view adds exp(lambda * (t - t0)) to the product's score, where t0 is
+    a fixed reference time. The decayed score at time `now` is that sum times
+    exp(-lambda * (now - t0)), which scales every product equally, so ranking
+    in reference space is the same as ranking by decayed score.
+    """
+
+    def __init__(self, half_life_hours: float = HALF_LIFE_HOURS, k: int = TOP_K):
+        self.decay_rate = math.log(2) / (half_life_hours * 3600.0)
+        self.k = k
+        self.reference_time = time.time()
+        self.scores: Dict[str, float] = {}
+        self.product_buckets: Dict[str, List[Bucket]] = {}
+        self.buckets: Dict[Bucket, _TopK] = {}
+        self.lock = threading.Lock()
+
+    def record_view(self, product_id: str, categories: Iterable[str] = (),
+                    location=None, timestamp: Optional[float] = None, weight: float = 1.0):
+        """Fold one view event into the product's score and its buckets"""
+        timestamp = time.time() if timestamp is None else timestamp
+        buckets = self._buckets_for(categories, region_for(location))
+
+        with self.lock:
+            exponent = self.decay_rate * (timestamp - self.reference_time)
+            if exponent > _MAX_EXPONENT:
+                self._rebase(timestamp)
+                exponent = 0.0
+
+            score = self.scores.get(product_id, 0.0) + weight * math.exp(exponent)
+            self.scores[product_id] = score
+            self.product_buckets[product_id] = buckets
+
+            for bucket in buckets:
+                heap = self.buckets.get(bucket)
+                if heap is None:
+                    heap = self.buckets[bucket] = _TopK(self.k)
+                heap.offer(product_id, score)
+
+    def remove(self, product_id: str):
+        """Forget a product entirely (e.g. when it is deleted)"""
+        with self.lock:
+            self.scores.pop(product_id, None)
+            for bucket in self.product_buckets.pop(product_id, []):
+                heap = self.buckets.get(bucket)
+                if heap:
+                    heap.discard(product_id)
+
+    def top(self, limit: int, category: Optional[str] = None, region: Optional[str] = None,
+            exclude: Optional[Set[str]] = None) -> List[Tuple[str, float]]:
+        """Return up to `limit` (product_id, decayed_score) pairs for a bucket"""
+        exclude = exclude or set()
+        key = (category.lower() if category else None, region)
+        with self.lock:
+            heap = self.buckets.get(key)
+            if heap is None:
+                return []
+            factor = self._decay_factor(time.time())
+            results = []
+            for product_id, score in heap.ranked():
+                if product_id in exclude:
+                    continue
+                results.append((product_id, score * factor))
+                if len(results) >= limit:
+                    break
+            return results
+
+    def top_with_fallback(self, limit: int, category: Optional[str] = None,
+                          region: Optional[str] = None,
+                          exclude: Optional[Set[str]] = None) -> List[str]:
+        """Fill `limit` ids from the most specific bucket outwards"""
+        seen = set(exclude or ())
+        ids: List[str] = []
+        for bucket_category, bucket_region in self._widening(category, region):
+            if len(ids) >= limit:
+                break
+            for product_id, _ in self.top(limit - len(ids), bucket_category, bucket_region, seen):
+                ids.append(product_id)
+                seen.add(product_id)
+        return ids
+
+    def score(self, product_id: str) -> float:
+        with self.lock:
+            return self.scores.get(product_id, 0.0) * self._decay_factor(time.time())
+
+    def prune(self):
+        """Drop products whose decayed score has fallen below the threshold"""
+        with self.lock:
+            factor = self._decay_factor(time.time())
+            dead = [pid for pid, score in self.scores.items() if score * factor < _MIN_SCORE]
+        for product_id in dead:
+            self.remove(product_id)
+        return len(dead)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "tracked_products": len(self.scores),
+                "buckets": len(self.buckets),
+                "top_k": self.k,
+                "half_life_hours": math.log(2) / self.decay_rate / 3600.0,
+            }
+
+    def _buckets_for(self, categories: Iterable[str], region: Optional[str]) -> List[Bucket]:
+        names = {c.lower() for c in (categories or []) if isinstance(c, str) and c}
+        buckets: List[Bucket] = [(None, None)]
+        if region:
+            buckets.append((None, region))
+        for name in names:
+            buckets.append((name, None))
+            if region:
+                buckets.append((name, region))
+        return buckets
+
+    def _widening(self, category: Optional[str], region: Optional[str]) -> List[Bucket]:
+        order: List[Bucket] = []
+        if category and region:
+            order.append((category, region))
+        if category:
+            order.append((category, None))
+        if region:
+            order.append((None, region))
+        order.append((None, None))
+        return order
+
+    def _decay_factor(self, now: float) -> float:
+        return math.exp(-self.decay_rate * (now - self.reference_time))
+
+    def _rebase(self, now: float):
+        # Caller holds the lock
+        factor = self._decay_factor(now)
+        self.reference_time = now
+        self.scores = {pid: score * factor for pid, score in self.scores.items()}
+        for heap in self.buckets.values():
+            heap.rescale(factor)
+
+
+engine = TrendingEngine()
+
+# Set in setup_collection
+products_collection = None
+
+_pruner: Optional[asyncio.Task] = None
+
+
+def setup_collection(db):
+    """Warm the engine from recent product views (called from main.py)"""
+    global products_collection
+    products_collection = db["products"]
+
+    try:
+        since = datetime.utcnow() - timedelta(hours=HALF_LIFE_HOURS * WARM_HALF_LIVES)
+        views = db["product_views"].aggregate([
+            {"$match": {"timestamp": {"$gte": since}}},
+            {"$group": {
+                "_id": "$product_id",
+                "timestamps": {"$push": "$timestamp"}
+            }}
+        ])
+        per_product = {doc["_id"]: doc["timestamps"] for doc in views if doc["_id"]}
+        if not per_product:
+            return
+
+        metadata = products_collection.find(
+            {"id": {"$in": list(per_product)}},
+            {"_id": 0, "id": 1, "categories": 1, "location": 1}
+        )
+        for product in metadata:
+            for ts in per_product.get(product["id"], []):
+                engine.record_view(
+                    product["id"],
+                    product.get("categories") or [],
+                    product.get("location"),
+                    timestamp=_epoch(ts)
+                )
+        print(f"Trending engine warmed with {len(engine.scores)} products")
+    except Exception as e:
+        print(f"Warning: Could not warm trending engine: {str(e)}")
+
+
+def fetch_trending_products(limit: int, category: Optional[str] = None,
+                            region: Optional[str] = None, exclude_ids: Iterable[str] = (),
+                            exclude_user_id: Optional[str] = None,
+                            projection: Optional[dict] = None) -> List[dict]:
+    """Return trending product documents in score order.
+
+    Ids come from the in-memory heaps; the documents are hydrated with a
+    single `$in` query on `id`. When the heaps hold fewer than `limit`
+    products, the rest are the most viewed products (`view_count` indexes)
+    in the same category and region, so popular lists are not empty after
+    a restart. The list is shorter when those run out too.
+    """
+    if limit <= 0:
+        return []
+
+    exclude = {pid for pid in exclude_ids if pid}
+    # Over-fetch a little to survive owner filtering and deleted products
+    ids = engine.top_with_fallback(limit * 2, category, region, exclude)
+
+    owner_filter = {"user.id": {"$ne": exclude_user_id}} if exclude_user_id else {}
+    products = []
+    if ids:
+        by_id = {p["id"]: p for p in products_collection.find({"id": {"$in": ids}, **owner_filter}, projection)}
+        products = [by_id[pid] for pid in ids if pid in by_id][:limit]
+
+    if len(products) < limit:
+        # Too few recent views (fresh deploy, restart, quiet period):
+        # fill up with all-time most viewed products
+        skip_ids = list(exclude | {p["id"] for p in products})
+        query = {"id": {"$nin": skip_ids}, **owner_filter}
+        if category:
+            query["categories"] = category
+        if region:
+            query["location"] = {"$geoWithin": {"$geometry": region_polygon(region)}}
+        wanted = limit - len(products)
+        cursor = products_collection.find(query, projection).sort("view_count", -1)
+        if category:
+            cursor = cursor.collation(CATEGORY_COLLATION)
+        if region:
+            # Polygon edges are geodesics, not parallels: check the cell exactly
+            cursor = cursor.limit(wanted * 2)
+            products += [p for p in cursor if region_for(p.get("location")) == region][:wanted]
+        else:
+            products += cursor.limit(wanted)
+    return products
+
+
+async def _prune_periodically():
+    while True:
+        await asyncio.sleep(PRUNE_INTERVAL)
+        try:
+            pruned = await asyncio.to_thread(engine.prune)
+            if pruned:
+                print(f"Trending engine pruned {pruned} products")
+        except Exception as e:
+            print(f"Warning: Trending prune failed: {str(e)}")
+
+
+def start():
+    """Start pruning decayed products (called on app startup)"""
+    global _pruner
+    if _pruner is None:
+        _pruner = asyncio.create_task(_prune_periodically())
+
+
+async def stop():
+    global _pruner
+    if _pruner is not None:
+        _pruner.cancel()
+        try:
+            await _pruner
+        except asyncio.CancelledError:
+            pass
+        _pruner = None
+
+
+def _epoch(value) -> float:
+    if isinstance(value, datetime):
+        # Stored timestamps are naive UTC
+        return (value - datetime(1970, 1, 1)).total_seconds()
+    return float(value)
@@ -0,0 +1,179 @@
+"""Streaming upload handling.
+
+Uploads are copied chunk by chunk into a spool file while the SHA-256 is
+computed and the image header is sniffed, so no endpoint ever holds a whole
+image as one `bytes` object. Per-file limits are enforced during the copy and
+the per-request limit is enforced by `UploadSizeLimitMiddleware` before the
+multipart body is parsed. Downstream code gets the spool file's path or a
+read-only memory map (`SpooledUpload.view()`), never a copy.
+"""
+import hashlib
+import mmap
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Optional
+
+from fastapi import HTTPException, UploadFile
+
+SPOOL_DIR = os.getenv(
+    "UPLOAD_TMP_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads", "spool")
+)
+MAX_FILE_BYTES = int(os.getenv("MAX_UPLOAD_FILE_BYTES", str(10 * 1024 * 1024)))
+MAX_REQUEST_BYTES = int(os.getenv("MAX_UPLOAD_REQUEST_BYTES", str(32 * 1024 * 1024)))
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes needed to recognise every supported image format
+_SNIFF_BYTES = 16
+
+
+def sniff_image_type(header: bytes) -> Optional[str]:
+    """Image format from the first bytes of a file, or None"""
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header.startswith(b"BM"):
+        return "bmp"
+    if header[4:8] == b"ftyp" and header[8:12] in (b"heic", b"heix", b"mif1", b"avif"):
+        return "avif" if header[8:12] == b"avif" else "heic"
+    return None
+
+
+class SpooledUpload:
+    """An uploaded file on disk with its hash, size and sniffed type"""
+
+    def __init__(self, path: str, filename: str, size: int, sha256: str, kind: str):
+        self.path = path
+        self.filename = filename
+        self.size = size
+        self.sha256 = sha256
+        self.kind = kind
+
+    @contextmanager
+    def view(self):
+        """Read-only memory map of the file contents"""
+        with open(self.path, "rb") as f:
+            if self.size == 0:
+                yield b""
+                return
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield mapped
+            finally:
+                mapped.close()
+
+    def move_to(self, path: str):
+        """Move the spool file (same filesystem, so no copy)"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.path, path)
+        self.path = path
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+async def spool_upload(upload: UploadFile, max_bytes: int = MAX_FILE_BYTES,
+                       require_image: bool = True) -> SpooledUpload:
+    """Copy an UploadFile to the spool directory in chunks.
+
+    Raises 413 as soon as the file passes `max_bytes` and 415 if the header
+    is not a recognised image.
+    """
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=SPOOL_DIR, suffix=".part")
+    digest = hashlib.sha256()
+    header = b""
+    size = 0
+    kind = None
+
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = await upload.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"{upload.filename} is larger than {max_bytes} bytes")
+
+                if len(header) < _SNIFF_BYTES:
+                    # Reject non-images as soon as the header is in
+                    header += chunk[:_SNIFF_BYTES - len(header)]
+                    if len(header) >= _SNIFF_BYTES:
+                        kind = sniff_image_type(header)
+                        if require_image and kind is None:
+                            raise HTTPException(status_code=415, detail=f"{upload.filename} is not a supported image")
+
+                digest.update(chunk)
+                out.write(chunk)
+
+        if kind is None:
+            kind = sniff_image_type(header)
+        if require_image and kind is None:
+            raise HTTPException(status_code=415, detail=f"{upload.filename} is not a supported image")
+    except BaseException:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    return SpooledUpload(path, upload.filename or "", size, digest.hexdigest(), kind or "bin")
+
+
+class UploadSizeLimitMiddleware:
+    """Reject multipart requests whose body exceeds `max_bytes`.
+
+    Requests that declare a larger Content-Length get a 413 before any of the
+    body is read; chunked bodies are counted as they stream in. `path_limits`
+    overrides the limit for specific paths (e.g. catalog imports).
+    """
+
+    def __init__(self, app, max_bytes: int = MAX_REQUEST_BYTES, path_limits: Optional[dict] = None):
+        self.app = app
+        self.default_max_bytes = max_bytes
+        self.path_limits = path_limits or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        if not headers.get(b"content-type", b"").startswith(b"multipart/"):
+            return await self.app(scope, receive, send)
+
+        max_bytes = self.path_limits.get(scope.get("path"), self.default_max_bytes)
+        declared = headers.get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > max_bytes:
+            return await self._reject(send, max_bytes)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"Request body is larger than {max_bytes} bytes")
+            return message
+
+        return await self.app(scope, limited_receive, send)
+
+    async def _reject(self, send, max_bytes: int):
+        body = b'{"detail":"Request body is larger than %d bytes"}' % max_bytes
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,153 @@
+"""Maintained per-user statistics.
+
+`statistics.items_listed` on the user document is kept up to date by the
+product create and delete paths, which write the product and bump the
+counter in one transaction. Profile reads then just return the stored
+counters. `reconcile` recomputes the counters from `products` to repair any
+drift and can be run on a schedule:
+
+    python user_stats.py reconcile [--dry-run]
+"""
+import os
+import sys
+from typing import Dict
+
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+DEFAULT_STATISTICS = {
+    "total_trades": 0,
+    "successful_trades": 0,
+    "items_listed": 0
+}
+
+# Server error code for "transactions are not supported" (standalone mongod)
+_ILLEGAL_OPERATION = 20
+
+# These will be set in setup_collection
+mongo_client = None
+products_collection = None
+users_collection = None
+transactions_supported = True
+
+
+def setup_collection(client, db):
+    global mongo_client, products_collection, users_collection
+    mongo_client = client
+    products_collection = db["products"]
+    users_collection = db["users"]
+
+
+def _in_transaction(callback):
+    """Run callback(session) in a transaction, or without one on a standalone server"""
+    global transactions_supported
+    if transactions_supported:
+        try:
+            with mongo_client.start_session() as session:
+                return session.with_transaction(callback)
+        except OperationFailure as e:
+            if e.code != _ILLEGAL_OPERATION:
+                raise
+            transactions_supported = False
+            print("Warning: MongoDB transactions unavailable; updating statistics without them")
+    return callback(None)
+
+
+def insert_product(product: dict):
+    """Insert a product and count it against its owner's listings"""
+    user_id = (product.get("user") or {}).get("id")
+
+    def callback(session):
+        products_collection.insert_one(product, session=session)
+        if user_id:
+            users_collection.update_one(
+                {"id": user_id},
+                {"$inc": {"statistics.items_listed": 1}},
+                session=session
+            )
+
+    _in_transaction(callback)
+    return product
+
+
+def delete_product(product_id: str):
+    """Delete a product and uncount it; returns the deleted document or None"""
+
+    def callback(session):
+        deleted = products_collection.find_one_and_delete({"id": product_id}, session=session)
+        user_id = ((deleted or {}).get("user") or {}).get("id")
+        if user_id:
+            users_collection.update_one(
+                {"id": user_id, "statistics.items_listed": {"$gt": 0}},
+                {"$inc": {"statistics.items_listed": -1}},
+                session=session
+            )
+        return deleted
+
+    return _in_transaction(callback)
+
+
+def count_listings(counts: Dict[str, int]):
+    """Add bulk-inserted products to their owners' items_listed.
+
+    Not transactional with the inserts; `reconcile` repairs any drift left
+    by an interrupted import.
+    """
+    updates = [
+        UpdateOne({"id": user_id}, {"$inc": {"statistics.items_listed": count}})
+        for user_id, count in counts.items() if user_id and count
+    ]
+    if updates:
+        users_collection.bulk_write(updates, ordered=False)
+
+
+def with_default_statistics(user: dict) -> dict:
+    """Fill in zeroed counters for users created before statistics existed"""
+    statistics = dict(DEFAULT_STATISTICS)
+    statistics.update(user.get("statistics") or {})
+    user["statistics"] = statistics
+    return user
+
+
+def reconcile(dry_run: bool = False) -> dict:
+    """Recompute items_listed from products and fix users that drifted"""
+    counts = {
+        doc["_id"]: doc["count"]
+        for doc in products_collection.aggregate([
+            {"$match": {"user.id": {"$ne": None}}},
+            {"$group": {"_id": "$user.id", "count": {"$sum": 1}}}
+        ])
+    }
+
+    updates = []
+    checked = 0
+    for user in users_collection.find({}, {"_id": 0, "id": 1, "statistics.items_listed": 1}):
+        checked += 1
+        actual = counts.get(user["id"], 0)
+        stored = (user.get("statistics") or {}).get("items_listed")
+        if stored != actual:
+            updates.append(UpdateOne(
+                {"id": user["id"]},
+                {"$set": {"statistics.items_listed": actual}}
+            ))
+
+    if updates and not dry_run:
+        for start in range(0, len(updates), 1000):
+            users_collection.bulk_write(updates[start:start + 1000], ordered=False)
+
+    return {"checked_users": checked, "drifted": len(updates), "dry_run": dry_run}
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    import mongo_config
+
+    load_dotenv()
+    if len(sys.argv) < 2 or sys.argv[1] != "reconcile":
+        print("usage: python user_stats.py reconcile [--dry-run]")
+        sys.exit(2)
+
+    client = mongo_config.connect()
+    setup_collection(client, mongo_config.database(client))
+    print(reconcile(dry_run="--dry-run" in sys.argv))
@@ -0,0 +1,478 @@
+"""Keeps the vector index eventually consistent with `products`.
+
+This consumer is the only writer of product vectors. Request handlers and
+the ingestion and import pipelines just write `products`. The consumer
+tails a change stream on `products` for inserts, replaces, deletes, and
+updates that touch a field held in the index (name, description, price,
+categories, image_categories, images, location, image_embeddings). View
+counters and snapshot rewrites are filtered out on the server. When image
+index hooks are given, the products' stored image embeddings are written to
+the image index (see image_search) in the same batch.
+
+Changes are coalesced per product into batches of up to BATCH_SIZE (or
+whatever arrived within FLUSH_INTERVAL). Each batch is embedded in one
+call, upserted in chunks of VECTOR_CHUNK and deleted in chunks, and only
+then is the stream's resume token saved in `sync_state`. A crash therefore
+replays the unsaved batch, and both upserts and deletes are idempotent.
+
+A batch that keeps failing is retried from the saved token with growing
+delays. After MAX_ATTEMPTS, its products are applied one at a time. Those
+that still fail (say, metadata over the index's size limit) go to
+`vector_sync_dead_letters` with the error, and the stream moves past them.
+Syncing therefore never stalls on one bad product. Editing the product
+again, or a reembed run, syncs it once the cause is fixed.
+
+Deletes need the product's `id` from the pre-image. `setup_sync` enables
+pre-images on the collection, which needs MongoDB 6.0 or newer and the
+collMod privilege. Without them, deletes are skipped and their vectors are
+orphaned. Where the app's user may not run collMod, enable them once by
+hand:
+
+    db.runCommand({collMod: "products", changeStreamPreAndPostImages: {enabled: true}})
+
+Change streams need a replica set. `python vector_sync.py check` runs the
+consumer against a scratch database on a local one. It covers inserts,
+updates, deletes, a resume from the saved token and a dead-lettered batch.
+It fails when pre-images are off. With `--spawn` it starts a throwaway
+single-node replica set itself (`mongod` must be on PATH), so it can run
+unattended.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+import image_search
+import ingestion
+
+BATCH_SIZE = int(os.getenv("VECTOR_SYNC_BATCH_SIZE", "256"))
+FLUSH_INTERVAL = float(os.getenv("VECTOR_SYNC_FLUSH_INTERVAL", "1.0"))
+VECTOR_CHUNK = 100
+RETRY_DELAY = 5.0
+MAX_RETRY_DELAY = 60.0
+# Failed attempts at one batch before its failing products are dead-lettered
+MAX_ATTEMPTS = int(os.getenv("VECTOR_SYNC_MAX_ATTEMPTS", "5"))
+# Save the stream position at least this often even when nothing changes
+IDLE_CHECKPOINT_INTERVAL = 60.0
+
+STATE_ID = "vector_sync"
+EMBEDDED_FIELDS = ["name", "description", "price", "categories", "image_categories", "images", "location",
+                   "image_embeddings"]
+
+# Server error code when a resume token has fallen off the oplog
+_CHANGE_STREAM_HISTORY_LOST = 286
+
+# These will be set in setup_sync
+products_collection = None
+state_collection = None
+dead_letters_collection = None
+embed_batch: Optional[Callable[[List[str]], List[List[float]]]] = None
+upsert_vectors: Optional[Callable[[List[dict]], None]] = None
+delete_vectors: Optional[Callable[[List[str]], None]] = None
+upsert_image_vectors: Optional[Callable[[List[dict]], None]] = None
+delete_image_vectors: Optional[Callable[[List[str]], None]] = None
+pre_images_enabled = False
+
+# product id -> document to upsert, or None to delete
+pending: Dict[str, Optional[dict]] = {}
+stats = {"batches": 0, "upserts": 0, "deletes": 0, "skipped_deletes": 0, "errors": 0,
+         "dead_lettered": 0, "history_lost": 0, "last_applied_at": None, "last_event_at": None,
+         "oldest_pending_at": None, "last_error": None}
+# Consecutive failed attempts at the current batch
+_attempts = 0
+
+_stop = threading.Event()
+_task = None
+
+
+def setup_sync(db, embed, upsert, delete, image_upsert=None, image_delete=None):
+    """Wire the consumer to the database, the batch embedder and the vector indexes"""
+    global products_collection, state_collection, dead_letters_collection, embed_batch, upsert_vectors
+    global delete_vectors, upsert_image_vectors, delete_image_vectors, pre_images_enabled
+    products_collection = db["products"]
+    state_collection = db["sync_state"]
+    dead_letters_collection = db["vector_sync_dead_letters"]
+    embed_batch = embed
+    upsert_vectors = upsert
+    delete_vectors = delete
+    upsert_image_vectors = image_upsert
+    delete_image_vectors = image_delete
+
+    try:
+        db.command("collMod", "products", changeStreamPreAndPostImages={"enabled": True})
+        pre_images_enabled = True
+    except PyMongoError as e:
+        pre_images_enabled = False
+        print(f"Warning: Could not enable change stream pre-images on products "
+              f"(deletes will not reach the vector index): {str(e)}. Run "
+              f'db.runCommand({{collMod: "products", changeStreamPreAndPostImages: {{enabled: true}}}}) '
+              f"as an admin on MongoDB 6.0+")
+
+
+def change_pipeline() -> List[dict]:
+    """Server-side filter: only changes that alter a product's vector"""
+    touched = [{f"updateDescription.updatedFields.{field}": {"$exists": True}} for field in EMBEDDED_FIELDS]
+    touched.append({"updateDescription.removedFields": {"$in": EMBEDDED_FIELDS}})
+    return [{"$match": {"$or": [
+        {"operationType": {"$in": ["insert", "replace", "delete"]}},
+        {"operationType": "update", "$or": touched}
+    ]}}]
+
+
+def _open_stream(resume_token):
+    options = {"full_document": "updateLookup", "batch_size": BATCH_SIZE,
+               "max_await_time_ms": int(FLUSH_INTERVAL * 1000)}
+    if pre_images_enabled:
+        options["full_document_before_change"] = "whenAvailable"
+    return products_collection.watch(change_pipeline(), resume_after=resume_token, **options)
+
+
+def _load_token():
+    state = state_collection.find_one({"id": STATE_ID}, {"_id": 0, "resume_token": 1})
+    return (state or {}).get("resume_token")
+
+
+def _save_token(token):
+    state_collection.update_one(
+        {"id": STATE_ID},
+        {"$set": {"resume_token": token, "updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+
+def _collect(change: dict):
+    """Record the latest wanted state of the changed product"""
+    if change["operationType"] == "delete":
+        product_id = (change.get("fullDocumentBeforeChange") or {}).get("id")
+        if not product_id:
+            stats["skipped_deletes"] += 1
+            return
+        pending[product_id] = None
+    else:
+        product = change.get("fullDocument")
+        # None: deleted again before the lookup; its delete event follows
+        if not product or not product.get("id"):
+            return
+        pending[product["id"]] = product
+
+    if stats["oldest_pending_at"] is None:
+        stats["oldest_pending_at"] = change["clusterTime"].time
+
+
+def vector_records(products: List[dict]) -> List[dict]:
+    """Embed products in one call and build their index records"""
+    listings = [ingestion.listing_from_product(p) for p in products]
+    vectors = embed_batch([
+        ingestion.embedding_text(l["productName"], l["productDescription"], l["categories"])
+        for l in listings
+    ])
+    return [
+        {
+            "id": product["id"],
+            "values": vector,
+            "metadata": ingestion.vector_metadata(
+                listing, product["id"], product.get("images") or [], product.get("image_categories") or []
+            )
+        }
+        for product, listing, vector in zip(products, listings, vectors)
+    ]
+
+
+def _apply(upserts: List[dict], deletes: List[str]):
+    if upserts:
+        records = vector_records(upserts)
+        for start in range(0, len(records), VECTOR_CHUNK):
+            upsert_vectors(records[start:start + VECTOR_CHUNK])
+    for start in range(0, len(deletes), VECTOR_CHUNK):
+        delete_vectors(deletes[start:start + VECTOR_CHUNK])
+    if upsert_image_vectors is not None:
+        _flush_images(upserts, deletes)
+
+
+def _apply_each(upserts: List[dict], deletes: List[str]) -> int:
+    """Apply products one at a time, dead-lettering the ones that fail"""
+    failed = 0
+    changes = [(p["id"], "upsert", [p], []) for p in upserts] + [(i, "delete", [], [i]) for i in deletes]
+    for product_id, operation, upsert, delete in changes:
+        try:
+            _apply(upsert, delete)
+        except Exception as e:
+            failed += 1
+            print(f"Vector sync: dead-lettering {operation} of product {product_id}: {str(e)}")
+            dead_letters_collection.update_one(
+                {"product_id": product_id},
+                {"$set": {"operation": operation, "error": str(e), "attempts": MAX_ATTEMPTS,
+                          "failed_at": datetime.utcnow()}},
+                upsert=True
+            )
+    return failed
+
+
+def _flush(token):
+    global _attempts
+    upserts = [product for product in pending.values() if product is not None]
+    deletes = [product_id for product_id, product in pending.items() if product is None]
+
+    try:
+        _apply(upserts, deletes)
+    except Exception:
+        _attempts += 1
+        if _attempts < MAX_ATTEMPTS:
+            # Replayed from the saved token after a delay
+            raise
+        stats["dead_lettered"] += _apply_each(upserts, deletes)
+    _attempts = 0
+
+    # Only now is the batch durable in the index (or dead-lettered)
+    _save_token(token)
+    pending.clear()
+    stats["batches"] += 1
+    stats["upserts"] += len(upserts)
+    stats["deletes"] += len(deletes)
+    stats["last_applied_at"] = time.time()
+    stats["oldest_pending_at"] = None
+
+
+def _flush_images(upserts: List[dict], deletes: List[str]):
+    """Write stored image embeddings, and drop ids of removed images"""
+    records = [record for product in upserts for record in image_search.vector_records(product)]
+    kept = {record["id"] for record in records}
+    stale = [vector_id for product in upserts for vector_id in image_search.vector_ids(product["id"])
+             if vector_id not in kept]
+    stale += [vector_id for product_id in deletes for vector_id in image_search.vector_ids(product_id)]
+
+    for start in range(0, len(records), VECTOR_CHUNK):
+        upsert_image_vectors(records[start:start + VECTOR_CHUNK])
+    for start in range(0, len(stale), VECTOR_CHUNK):
+        delete_image_vectors(stale[start:start + VECTOR_CHUNK])
+
+
+def _consume():
+    """Tail the change stream until stopped (runs in its own thread)"""
+    token = _load_token()
+    while not _stop.is_set():
+        deadline = None
+        last_checkpoint = time.monotonic()
+        try:
+            with _open_stream(token) as stream:
+                while not _stop.is_set():
+                    change = stream.try_next()
+                    if change is not None:
+                        _collect(change)
+                        stats["last_event_at"] = change["clusterTime"].time
+                        if deadline is None:
+                            deadline = time.monotonic() + FLUSH_INTERVAL
+
+                    if pending and (len(pending) >= BATCH_SIZE or time.monotonic() >= deadline):
+                        _flush(stream.resume_token)
+                        token = stream.resume_token
+                        deadline = None
+                        last_checkpoint = time.monotonic()
+                    elif not pending and change is None:
+                        deadline = None
+                        if time.monotonic() - last_checkpoint >= IDLE_CHECKPOINT_INTERVAL:
+                            # Nothing buffered: advance past filtered-out oplog entries
+                            _save_token(stream.resume_token)
+                            token = stream.resume_token
+                            last_checkpoint = time.monotonic()
+        except OperationFailure as e:
+            if e.code == _CHANGE_STREAM_HISTORY_LOST:
+                print("Warning: vector sync resume token is no longer in the oplog; restarting from now. "
+                      "Run reembed.py to backfill missed changes")
+                stats["history_lost"] += 1
+                token = None
+                pending.clear()
+                continue
+            _record_error(e)
+        except Exception as e:
+            _record_error(e)
+
+        # Replay from the last saved token
+        pending.clear()
+        stats["oldest_pending_at"] = None
+        token = _load_token() if state_collection is not None else token
+        _stop.wait(_retry_delay())
+
+
+def _retry_delay() -> float:
+    return min(RETRY_DELAY * 2 ** max(_attempts - 1, 0), MAX_RETRY_DELAY)
+
+
+def _record_error(e: Exception):
+    stats["errors"] += 1
+    stats["last_error"] = str(e)
+    print(f"Vector sync error (attempt {_attempts} of {MAX_ATTEMPTS}, retrying in {_retry_delay()}s): {str(e)}")
+
+
+def start():
+    """Start the consumer thread (called on app startup)"""
+    global _task
+    if _task is not None:
+        return
+    _stop.clear()
+    _task = asyncio.create_task(asyncio.to_thread(_consume))
+
+
+async def stop():
+    global _task
+    if _task is None:
+        return
+    _stop.set()
+    await asyncio.gather(_task, return_exceptions=True)
+    _task = None
+
+
+def get_stats() -> dict:
+    """Counters plus lag: how long the oldest unapplied change has waited"""
+    oldest = stats["oldest_pending_at"]
+    return dict(
+        stats,
+        running=_task is not None and not _task.done(),
+        pending=len(pending),
+        pre_images_enabled=pre_images_enabled,
+        lag_seconds=round(max(time.time() - oldest, 0.0), 3) if oldest else 0.0
+    )
+
+
+def _check(uri: str) -> int:
+    """Run the consumer against a scratch database on a local replica set"""
+    global MAX_ATTEMPTS, RETRY_DELAY
+    import uuid
+
+    from pymongo import MongoClient
+
+    client = MongoClient(uri)
+    db_name = f"vector_sync_check_{uuid.uuid4().hex[:8]}"
+    db = client[db_name]
+    db.create_collection("products")
+    index = {}
+
+    def upsert(records):
+        for record in records:
+            # Stands in for the index rejecting oversized metadata
+            if record["metadata"].get("productName") == "Too big":
+                raise ValueError("Metadata size exceeds the limit")
+        index.update({r["id"]: r for r in records})
+
+    setup_sync(
+        db,
+        embed=lambda texts: [[float(len(text)), float(sum(map(ord, text)) % 997)] for text in texts],
+        upsert=upsert,
+        delete=lambda ids: [index.pop(i, None) for i in ids]
+    )
+    MAX_ATTEMPTS, RETRY_DELAY = 2, 0.2
+
+    def run_until(condition, timeout=30.0):
+        _stop.clear()
+        thread = threading.Thread(target=_consume)
+        thread.start()
+        deadline = time.time() + timeout
+        while time.time() < deadline and not condition():
+            time.sleep(0.2)
+        _stop.set()
+        thread.join()
+        return condition()
+
+    def product(i, **fields):
+        return dict({"id": f"p{i}", "name": f"Item {i}", "description": "desc", "price": i,
+                     "categories": ["other"], "images": [], "image_categories": []}, **fields)
+
+    failures = []
+    if not pre_images_enabled:
+        failures.append("change stream pre-images are off on products, so deletes never reach the index; "
+                        "needs MongoDB 6.0+ and collMod (see the module docstring)")
+    try:
+        # Start from "now" so exactly the changes below are seen
+        with products_collection.watch() as probe:
+            _save_token(probe.resume_token)
+
+        products_collection.insert_many([product(i) for i in range(10)])
+        products_collection.update_one({"id": "p1"}, {"$set": {"name": "Renamed"}})
+        products_collection.delete_one({"id": "p3"})
+        ok = run_until(lambda: len(index) == 9 and index.get("p1", {}).get("metadata", {}).get("productName") == "Renamed")
+        if not ok:
+            failures.append(f"first pass: index has {sorted(index)}")
+        if "p3" in index:
+            failures.append("delete of p3 did not reach the index")
+
+        # Resume: changes made while stopped are applied from the saved
+        # token, and a view-count update is filtered out on the server
+        upserts_before = stats["upserts"]
+        products_collection.update_one({"id": "p2"}, {"$inc": {"view_count": 1}})
+        products_collection.insert_one(product(42))
+        products_collection.delete_one({"id": "p4"})
+        if not run_until(lambda: "p42" in index and "p4" not in index):
+            failures.append("resume from saved token missed changes")
+        if stats["upserts"] - upserts_before != 1:
+            failures.append(f"expected 1 upsert after resume, got {stats['upserts'] - upserts_before}")
+
+        # A product the index always rejects is dead-lettered; the rest of
+        # its batch and later changes still go through
+        products_collection.insert_many([product(50, name="Too big"), product(51)])
+        products_collection.update_one({"id": "p5"}, {"$set": {"name": "After the bad batch"}})
+        if not run_until(lambda: "p51" in index
+                         and index.get("p5", {}).get("metadata", {}).get("productName") == "After the bad batch"):
+            failures.append("sync stalled behind a batch with a rejected product")
+        if "p50" in index or not dead_letters_collection.find_one({"product_id": "p50", "operation": "upsert"}):
+            failures.append("rejected product p50 was not dead-lettered")
+    finally:
+        client.drop_database(db_name)
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    print("vector sync check passed" if not failures else f"{len(failures)} failures")
+    print(get_stats())
+    return 1 if failures else 0
+
+
+@contextmanager
+def _local_replica_set():
+    """A throwaway single-node replica set on a free port; yields its URI"""
+    import shutil
+    import socket
+    import subprocess
+    import tempfile
+
+    from pymongo import MongoClient
+
+    mongod = shutil.which("mongod")
+    if mongod is None:
+        raise SystemExit("mongod not found on PATH")
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    dbpath = tempfile.mkdtemp(prefix="vector-sync-check-")
+    process = subprocess.Popen(
+        [mongod, "--replSet", "rs0", "--port", str(port), "--bind_ip", "127.0.0.1", "--dbpath", dbpath],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        client = MongoClient(f"mongodb://127.0.0.1:{port}/?directConnection=true", serverSelectionTimeoutMS=30000)
+        client.admin.command("replSetInitiate", {"_id": "rs0", "members": [{"_id": 0, "host": f"127.0.0.1:{port}"}]})
+        deadline = time.time() + 30
+        while not client.admin.command("hello").get("isWritablePrimary"):
+            if time.time() > deadline:
+                raise SystemExit("local replica set did not elect a primary")
+            time.sleep(0.2)
+        client.close()
+        yield f"mongodb://127.0.0.1:{port}/?replicaSet=rs0"
+    finally:
+        process.terminate()
+        process.wait(30)
+        shutil.rmtree(dbpath, True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "check":
+        print("usage: python vector_sync.py check [--spawn]")
+        sys.exit(2)
+    if "--spawn" in sys.argv:
+        with _local_replica_set() as spawned_uri:
+            sys.exit(_check(spawned_uri))
+    sys.exit(_check(os.getenv("VECTOR_SYNC_CHECK_MONGODB_URI", "mongodb://localhost:27017/?replicaSet=rs0")))
@@ -13,6 +13,29 @@ import { SignUpForm } from './Auth/SignUpForm.tsx'
 import { Tabs, TabsContent, TabsList, TabsTrigger } from './ui/tabs.tsx'
 
 const API_URL = 'https://bartrade.koyeb.app'
+const JOB_POLL_INTERVAL_MS = 2000
+const JOB_POLL_TIMEOUT_MS = 60000
+
+interface UploadJob {
+  status: 'queued' | 'running' | 'completed' | 'failed';
+  error: string | null;
+  retry_at?: string | null;
+}
+
+// Polls an ingestion job until it completes or fails; null if it is still
+// pending at the deadline (e.g. waiting to retry an image upload)
+const waitForUploadJob = async (statusUrl: string): Promise<UploadJob | null> => {
+  const deadline = Date.now() + JOB_POLL_TIMEOUT_MS
+  while (Date.now() < deadline) {
+    const response = await fetch(`${API_URL}${statusUrl}`)
+    if (response.ok) {
+      const job: UploadJob = await response.json()
+      if (job.status === 'completed' || job.status === 'failed') return job
+    }
+    await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS))
+  }
+  return null
+}
 
 interface LocationState {
   latitude: number | null;
@@ -634,7 +657,17 @@ export const ProductUploadModal = forwardRef<HTMLButtonElement, ProductUploadMod
       }
       
       const responseData = await response.json()
-      console.log("✅ Upload successful:", responseData)
+      console.log("📨 Upload accepted:", responseData)
+
+      // The listing is processed in the background; wait for the job result
+      const job = await waitForUploadJob(responseData.status_url)
+      if (job?.status === 'failed') {
+        throw new Error(job.error || "Processing failed")
+      }
+      if (!job) {
+        toast.info("Your listing is still processing and will appear shortly")
+      }
+      console.log("✅ Upload successful:", job)
       
       // Only show success and reset if no errors
       setStep(4)